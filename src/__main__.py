@@ -1,4 +1,11 @@
 #!/usr/bin/env python
 
+import os
+import sys
+
 if __name__ == '__main__':
-    print "Hello World!"
+    # The go-backup modules import each other as top-level modules, both
+    # from a source checkout and from the archive built by package.sh.
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'go_backup'))
+    import cli
+    sys.exit(cli.main(sys.argv))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Asynchronous access to a go-backup CAS.
+
+Every CAS operation blocks until its file system calls (or, for a
+remote_cas.RemoteCAS, its round trip) are done. On NFS or over the
+network, latency rather than bandwidth then bounds walking a snapshot
+one blob at a time. An AsyncCAS issues operations from a pool of
+threads and returns immediately with a multiprocessing AsyncResult
+(call get() for the result), so that many operations are in flight at
+once.
+
+The number of operations in flight is limited to max_in_flight: once
+that many are queued or running, the next call blocks until one of
+them completes. Producers that walk huge trees thus never queue an
+unbounded amount of work.
+
+Python 2 has no asyncio, so this is a thread pool rather than an event
+loop; the CAS operations release the GIL while they wait.
+"""
+
+import multiprocessing.pool
+import threading
+
+import profiling
+import stats
+
+"""Default limit on the number of operations in flight."""
+DEFAULT_MAX_IN_FLIGHT = 32
+
+
+class AsyncCAS(object):
+
+    def __init__(self, source_cas, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        """Create an asynchronous view of source_cas (a cas.CAS or any
+        object with the same interface) with at most max_in_flight
+        operations in flight."""
+        self.cas = source_cas
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._pool = multiprocessing.pool.ThreadPool(max_in_flight,
+                                                     profiling.init_worker)
+
+    def submit(self, f, *args):
+        """Call f(*args) in the pool, blocking while max_in_flight calls
+        are in flight.
+
+        Returns:
+          A multiprocessing.pool.AsyncResult; its get() returns the
+          result of f or raises the exception f raised.
+        """
+        self._slots.acquire()
+        try:
+            return self._pool.apply_async(self._run, (f, args))
+        except:
+            self._slots.release()
+            raise
+
+    def _run(self, f, args):
+        try:
+            stats.count('async_cas.operations')
+            return f(*args)
+        finally:
+            self._slots.release()
+
+    def has_file(self, hash_digest):
+        return self.submit(self.cas.has_file, hash_digest)
+
+    def has_files(self, hash_digests):
+        return self.submit(self.cas.has_files, hash_digests)
+
+    def retrieve(self, hash_digest):
+        """Open a blob; the result is the file-like object returned by
+        CAS.retrieve."""
+        return self.submit(self.cas.retrieve, hash_digest)
+
+    def read(self, hash_digest):
+        """Read an entire blob; the result is its contents."""
+        return self.submit(_read, self.cas, hash_digest)
+
+    def store(self, fileobj, hash_digest):
+        return self.submit(self.cas.store, fileobj, hash_digest)
+
+    def close(self):
+        """Wait for the operations in flight and stop the pool."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _read(source_cas, hash_digest):
+    with source_cas.retrieve(hash_digest) as blob:
+        return blob.read()
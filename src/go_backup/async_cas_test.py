@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Tests for asynchronous access to a go-backup CAS."""
+
+import async_cas
+import cas
+import hashing
+import pytest
+import StringIO
+import threading
+import time
+
+class SlowCAS(cas.CAS):
+    """CAS whose has_file takes a while and records its concurrency."""
+
+    def __init__(self, root):
+        super(SlowCAS, self).__init__(root)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+
+    def has_file(self, hash_digest):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.01)
+        with self.lock:
+            self.running -= 1
+        return super(SlowCAS, self).has_file(hash_digest)
+
+def test_in_flight_limit(tmpdir):
+    test_cas = SlowCAS(tmpdir)
+    with async_cas.AsyncCAS(test_cas, max_in_flight=4) as async_source:
+        results = [async_source.has_file(hashing.hash_str(str(i)))
+                   for i in xrange(20)]
+        assert [r.get() for r in results] == [False] * 20
+    assert test_cas.max_running == 4
+
+def test_store_and_read(tmpdir):
+    test_cas = cas.CAS(tmpdir)
+    digest = hashing.hash_str('contents')
+    with async_cas.AsyncCAS(test_cas) as async_source:
+        async_source.store(StringIO.StringIO('contents'), digest).get()
+        assert async_source.has_files([digest, 'f' * 64]).get() == set([digest])
+        assert async_source.read(digest).get() == 'contents'
+        with async_source.retrieve(digest).get() as blob:
+            assert blob.read() == 'contents'
+        with pytest.raises(LookupError):
+            async_source.read('f' * 64).get()
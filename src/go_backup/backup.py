@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Backup of a directory tree into a go-backup CAS.
+
+A backup runs the stages described in README.md: the tree is walked
+(honoring a pattern file), all files are hashed (hard links to the same
+inode only once), files whose contents are not yet in the CAS are
+stored, and finally the directory metadata blobs are written bottom-up.
+The hash of the root directory blob identifies the snapshot. With a
+change journal (see the journal module), only the directories that
+changed are walked.
+"""
+
+import os
+
+import cas
+import cas_tree
+import catalog
+import directory_blob
+import hashing
+import journal
+import metadata
+import pattern
+import profiling
+import progress
+import refcount
+import stats
+import sys
+import utils
+
+
+def backup(target_cas, rootdir, patterns, num_processes=None, num_threads=None,
+           journal_dir=None, chunk_threshold=None):
+    """Store a snapshot of a directory tree.
+
+    Args:
+      target_cas: CAS to store the snapshot in.
+      rootdir: Root of the tree to back up.
+      patterns: Include / exclude patterns as returned by
+        pattern.parse_pattern_file.
+      num_processes: Number of parallel hashing processes.
+      num_threads: Number of parallel store workers.
+      journal_dir: Journal directory of a journal.Watcher of rootdir.
+        If given, only the directories that changed since the previous
+        snapshot are walked when possible (see journal.Scan).
+      chunk_threshold: If not None, files larger than this many bytes
+        are stored in chunks (see cas.store_chunked_file).
+
+    Returns:
+      The catalog.Snapshot recorded for the snapshot; its root_hash is
+      the hash of the root directory blob. When backup returns, the
+      snapshot is durable.
+    """
+    rootdir = os.path.normpath(rootdir)
+    snapshots = catalog.Catalog(target_cas.root)
+    # Blobs found in the CAS must not be freed until the snapshot is
+    # recorded.
+    with refcount.writer_lock(target_cas.root):
+        scan = None
+        if journal_dir is not None:
+            source = os.path.abspath(rootdir)
+            scan = journal.Scan(journal_dir, source, patterns,
+                                cas_tree.CASTree(target_cas),
+                                snapshots.latest(source))
+        try:
+            snapshot = _backup(target_cas, rootdir, patterns, num_processes,
+                               num_threads, snapshots, scan, chunk_threshold)
+            if scan is not None:
+                scan.finish(snapshot.root_hash)
+        finally:
+            if scan is not None:
+                scan.close()
+    return snapshot
+
+
+def _backup(target_cas, rootdir, patterns, num_processes, num_threads,
+            snapshots, scan, chunk_threshold):
+    incremental = scan is not None and scan.incremental
+    if incremental:
+        paths = pattern.assemble_paths(rootdir, patterns, walk=scan.walk)
+    else:
+        paths = pattern.assemble_paths(rootdir, patterns)
+
+    # Each inode is hashed and stored once, however many hard links to
+    # it there are.
+    native_digests = hashing.hash_list_of_files(
+        [utils.build_native_path(rootdir, p)
+         for p in pattern.unique_filenames(paths)],
+        num_processes)
+    digest_map = {}
+    for native_path, digest in native_digests.iteritems():
+        digest_map[utils.get_path_from_native_path(rootdir, native_path)] = digest
+    pattern.add_hardlink_digests(paths, digest_map)
+
+    cas.store_list_of_files(target_cas, native_digests.items(), num_threads,
+                            chunk_threshold=chunk_threshold)
+    uid_map = utils.get_uid_name_map()
+    gid_map = utils.get_gid_name_map()
+    tree = metadata.get_metadata_tree(rootdir, paths.filenames, paths.symlinks,
+                                      paths.directories, digest_map,
+                                      uid_map, gid_map)
+    if incremental:
+        scan.graft(tree, uid_map, gid_map)
+    root_hash = directory_blob.store_tree(target_cas, tree)
+
+    if incremental:
+        files, num_bytes = scan.totals(tree)
+    else:
+        sizes = [node.size for node in metadata.flatten_tree(tree).itervalues()
+                 if isinstance(node, metadata.FileNode)]
+        files, num_bytes = len(sizes), sum(sizes)
+    return snapshots.record(target_cas, root_hash, os.path.abspath(rootdir),
+                            files, num_bytes)
+
+
+def main(argv):
+    argv = profiling.handle_options(
+        progress.handle_options(stats.handle_options(argv)))
+    args = []
+    journal_dir = None
+    chunk_threshold = None
+    compression = None
+    argv_iter = iter(argv[1:])
+    try:
+        for arg in argv_iter:
+            if arg == '--journal':
+                journal_dir = os.path.abspath(next(argv_iter))
+            elif arg == '--chunk':
+                chunk_threshold = cas.CHUNKING_THRESHOLD
+            elif arg == '--chunk-threshold':
+                chunk_threshold = int(next(argv_iter))
+            elif arg == '--compress':
+                compression = next(argv_iter)
+            else:
+                args.append(arg)
+    except StopIteration:
+        args = []
+    if compression is not None and compression not in cas.supported_codecs():
+        print 'Unsupported compression codec "%s", use one of: %s' % (
+            compression, ', '.join(cas.supported_codecs()))
+        args = []
+    if len(args) not in (2, 3):
+        print ("usage: %s [--stats] [--stats-json FILE] [--progress] "
+               "[--progress-file FILE] [--profile DIR [--profile-memory]] "
+               "[--journal DIR] [--chunk | --chunk-threshold BYTES] "
+               "[--compress CODEC] cas_root rootdir [patterns_file]" % argv[0])
+        return 1
+
+    if len(args) == 3:
+        with open(args[2]) as patterns_file:
+            patterns = pattern.parse_pattern_file(patterns_file)
+    else:
+        patterns = []
+    target_cas = cas.CAS(os.path.abspath(args[0]), compression=compression)
+    print backup(target_cas, os.path.abspath(args[1]), patterns,
+                 journal_dir=journal_dir,
+                 chunk_threshold=chunk_threshold).root_hash
+    _count_store_statistics(target_cas.stats)
+    if compression is not None:
+        print >>sys.stderr, target_cas.stats.report()
+    return 0
+
+
+def _count_store_statistics(store_stats):
+    """Add the blob counters of a cas.StoreStatistics to the --stats
+    report."""
+    stats.count('cas.store.blobs', store_stats.blobs)
+    stats.count('cas.store.compressed_blobs', store_stats.compressed_blobs)
+    stats.count('cas.store.bytes_in', store_stats.bytes_in)
+    stats.count('cas.store.bytes_out', store_stats.bytes_out)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
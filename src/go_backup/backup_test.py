@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Tests for go-backup backups."""
+
+import backup
+import cas
+import cas_tree
+import catalog
+import hashing
+import metadata
+import os
+import pattern
+import stats
+import StringIO
+from restore_test import make_source
+
+def test_backup(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    snapshot = backup.backup(test_cas, str(source), [], num_processes=2)
+    root_hash = snapshot.root_hash
+    assert snapshot.files == 3
+    assert snapshot.bytes == len('top level file') + len('file a') + len('#!/bin/sh\n')
+    assert snapshot.parent is None
+
+    nodes = metadata.flatten_tree(cas_tree.CASTree(test_cas).root(root_hash))
+    assert sorted(nodes) == ['/', '/sub', '/sub/a.txt', '/sub/deeper',
+                             '/sub/deeper/b.sh', '/sub/link', '/top.txt']
+    assert nodes['/top.txt'].hash == hashing.hash_str('top level file')
+    with test_cas.retrieve(nodes['/sub/a.txt'].hash) as f:
+        assert f.read() == 'file a'
+    assert nodes['/sub/link'].link_target == 'a.txt'
+
+    # an unchanged tree results in the same snapshot
+    second = backup.backup(test_cas, str(source), [])
+    assert second.root_hash == root_hash
+    assert second.parent == root_hash
+    assert catalog.Catalog(test_cas.root).snapshots() == [snapshot, second]
+
+def test_backup_patterns(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    patterns = pattern.parse_pattern_file(StringIO.StringIO('+ /\n- /sub\n'))
+    root_hash = backup.backup(test_cas, str(source), patterns).root_hash
+    nodes = metadata.flatten_tree(cas_tree.CASTree(test_cas).root(root_hash))
+    assert sorted(nodes) == ['/', '/top.txt']
+    assert not test_cas.has_file(hashing.hash_str('file a'))
+
+def test_backup_hashes_each_inode_once(tmpdir, monkeypatch):
+    source = make_source(tmpdir)
+    os.link(str(source.join('sub', 'a.txt')), str(source.join('a-link.txt')))
+    os.link(str(source.join('sub', 'a.txt')), str(source.join('sub', 'a2.txt')))
+
+    paths = pattern.assemble_paths(str(source), [])
+    # the walk is top-down, so the link in the root is found first
+    assert paths.hardlinks == {'/sub/a.txt': '/a-link.txt',
+                               '/sub/a2.txt': '/a-link.txt'}
+    assert sorted(pattern.unique_filenames(paths)) == [
+        '/a-link.txt', '/sub/deeper/b.sh', '/top.txt']
+
+    hashed = []
+    original_hash_list_of_files = hashing.hash_list_of_files
+    def recording_hash_list_of_files(file_list, num_processes=None):
+        hashed.extend(file_list)
+        return original_hash_list_of_files(file_list, num_processes)
+    monkeypatch.setattr(hashing, 'hash_list_of_files',
+                        recording_hash_list_of_files)
+
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    snapshot = backup.backup(test_cas, str(source), [], num_processes=2)
+    assert len(hashed) == 3
+    # the metadata records every link as a file of its own
+    assert snapshot.files == 5
+    nodes = metadata.flatten_tree(
+        cas_tree.CASTree(test_cas).root(snapshot.root_hash))
+    for path in ['/a-link.txt', '/sub/a.txt', '/sub/a2.txt']:
+        assert nodes[path].hash == hashing.hash_str('file a')
+        assert nodes[path].size == len('file a')
+
+def test_backup_chunking_is_opt_in(tmpdir):
+    source = make_source(tmpdir)
+    contents = 'x' * (cas.CHUNK_SIZE + 1)
+    source.join('big').write(contents)
+    digest = hashing.hash_str(contents)
+    plain_cas = cas.CAS(str(tmpdir.join('plain')))
+    backup.backup(plain_cas, str(source), [])
+    assert plain_cas.chunk_list(digest) is None
+
+    chunked_cas = cas.CAS(str(tmpdir.join('chunked')))
+    backup.backup(chunked_cas, str(source), [], chunk_threshold=1000)
+    assert [size for _, size in chunked_cas.chunk_list(digest)] == [
+        cas.CHUNK_SIZE, 1]
+
+def test_main_compress(tmpdir, capsys):
+    source = make_source(tmpdir)
+    source.join('text').write('compressible ' * 1000)
+    cas_root = str(tmpdir.join('cas'))
+    stats.enable()
+    try:
+        assert backup.main(['backup', '--compress', 'zlib', cas_root,
+                            str(source)]) == 0
+        counters = stats.report()['counters']
+    finally:
+        stats.disable()
+    out, err = capsys.readouterr()
+    assert 'ratio' in err
+    assert counters['cas.store.compressed_blobs'] >= 1
+    assert counters['cas.store.bytes_out'] < counters['cas.store.bytes_in']
+
+    digest = hashing.hash_str('compressible ' * 1000)
+    test_cas = cas.CAS(cas_root)
+    with open(test_cas._get_cas_path(digest), 'rb') as f:
+        assert cas.read_blob_header(f) == 'zlib'
+    with test_cas.retrieve(digest) as f:
+        assert f.read() == 'compressible ' * 1000
+
+def test_main_rejects_unknown_codec(tmpdir, capsys):
+    source = make_source(tmpdir)
+    assert backup.main(['backup', '--compress', 'rar', str(tmpdir.join('cas')),
+                        str(source)]) == 1
+    assert 'Unsupported compression codec' in capsys.readouterr()[0]
@@ -0,0 +1,554 @@
+#!/usr/bin/env python
+"""Benchmarks for go-backup.
+
+Each benchmark runs in a scratch directory and returns its results, so
+that the numbers can be compared between revisions.
+
+benchmark_suite generates synthetic trees of several shapes (see
+TREE_SHAPES) and times the main stages of go-backup on each of them.
+The trees are generated from a fixed seed, so two runs at the same
+scale process identical data. Every stage runs in a child process of
+its own, so that its peak memory use can be measured, too.
+
+Results can be appended to a history file (one JSON object per line);
+find_regressions compares a run with the previous one in the history.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import random
+import shutil
+import StringIO
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+import async_cas
+import backup
+import cas
+import cas_tree
+import directory_blob
+import hashdeep
+import hashing
+import metadata
+import pattern
+import restore
+import stats
+import utils
+import verify
+
+"""Seed of the random generator used for synthetic trees."""
+SEED = 20140101
+
+"""Relative change in throughput or peak memory use that
+find_regressions reports."""
+REGRESSION_TOLERANCE = 0.25
+
+
+def benchmark_cas_durability(workdir, num_blobs=2000, blob_size=4096,
+                             batch_size=1000):
+    """Measure CAS ingest throughput for each durability mode.
+
+    Args:
+      workdir: Directory in which scratch CASes are created. It should
+      be on the file system whose performance is of interest.
+      num_blobs: Number of distinct blobs stored per mode.
+      blob_size: Size of each blob in bytes.
+      batch_size: Batch size used for cas.DURABILITY_BATCH.
+
+    Returns:
+      Dictionary mapping each durability mode to the number of blobs
+      stored (and made durable) per second.
+    """
+    blobs = [os.urandom(blob_size) for _ in xrange(num_blobs)]
+    digests = [hashing.hash_str(blob) for blob in blobs]
+
+    result = {}
+    for mode in cas.DURABILITY_MODES:
+        root = tempfile.mkdtemp(dir=workdir)
+        try:
+            test_cas = cas.CAS(os.path.abspath(root), durability=mode,
+                               batch_size=batch_size)
+            start_time = time.time()
+            for blob, digest in zip(blobs, digests):
+                test_cas.store(StringIO.StringIO(blob), digest)
+            test_cas.sync()
+            result[mode] = num_blobs / (time.time() - start_time)
+        finally:
+            shutil.rmtree(root)
+    return result
+
+
+class LatencyCAS(cas.CAS):
+    """Local CAS that sleeps before every operation, standing in for a
+    CAS on NFS or a remote_cas server."""
+
+    def __init__(self, root, latency):
+        super(LatencyCAS, self).__init__(root)
+        self._latency = latency
+
+    def has_file(self, hash_digest):
+        time.sleep(self._latency)
+        return super(LatencyCAS, self).has_file(hash_digest)
+
+    def retrieve(self, hash_digest):
+        time.sleep(self._latency)
+        return super(LatencyCAS, self).retrieve(hash_digest)
+
+
+@contextlib.contextmanager
+def _scratch_directory(workdir):
+    """Create a scratch directory that is removed afterwards.
+
+    The stat caches (see stat_cache) of trees restored or verified
+    meanwhile are kept in it, too, rather than in the user's cache
+    directory.
+    """
+    scratch = tempfile.mkdtemp(dir=workdir)
+    cache_home = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = os.path.join(scratch, 'cache')
+    try:
+        yield scratch
+    finally:
+        if cache_home is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = cache_home
+        shutil.rmtree(scratch)
+
+
+def benchmark_cas_latency(workdir, latency=0.005, num_files=1000,
+                          in_flight_limits=(1, 4,
+                                            async_cas.DEFAULT_MAX_IN_FLIGHT)):
+    """Measure restore and verify from a CAS with latency for several
+    limits on the number of CAS operations in flight.
+
+    Args:
+      workdir: Directory in which the scratch CAS and trees are created.
+      latency: Seconds added to each CAS operation.
+      num_files: Number of small files in the backed up tree, 50 per
+        directory.
+      in_flight_limits: Values of max_in_flight to measure.
+
+    Returns:
+      An OrderedDict mapping each limit to a pair (restore seconds,
+      verify seconds).
+    """
+    rng = random.Random(SEED)
+    with _scratch_directory(workdir) as scratch:
+        rootdir = os.path.join(scratch, 'tree')
+        os.mkdir(rootdir)
+        for i in xrange(num_files):
+            directory = os.path.join(rootdir, 'd{:04}'.format(i // 50))
+            if i % 50 == 0:
+                os.mkdir(directory)
+            _write_small_file(os.path.join(directory, 'f{:06}'.format(i)), rng,
+                              rng.randint(0, 1024))
+        cas_root = os.path.join(scratch, 'cas')
+        root_hash = backup.backup(cas.CAS(cas_root), rootdir, []).root_hash
+
+        results = collections.OrderedDict()
+        for max_in_flight in in_flight_limits:
+            source_cas = LatencyCAS(cas_root, latency)
+            destination = os.path.join(scratch, 'restore{}'.format(
+                max_in_flight))
+            start = time.time()
+            restore.restore(source_cas, root_hash, os.sep, destination,
+                            max_in_flight=max_in_flight)
+            restore_seconds = time.time() - start
+
+            start = time.time()
+            with async_cas.AsyncCAS(source_cas, max_in_flight) as async_source:
+                tree = cas_tree.CASTree(source_cas, async_source=async_source)
+                verify.verify_backup(destination, tree.root(root_hash))
+            results[max_in_flight] = (restore_seconds, time.time() - start)
+        return results
+
+
+def _random_bytes(rng, size):
+    if size == 0:
+        return ''
+    return ('%0*x' % (2 * size, rng.getrandbits(8 * size))).decode('hex')
+
+
+def _write_file(native_path, rng, size):
+    """Write a file of pseudo-random contents. Every 64 KiB block starts
+    with its offset, so that no two blocks of a file are equal."""
+    block = _random_bytes(rng, 64 * 1024)
+    with open(native_path, 'wb') as f:
+        offset = 0
+        while offset < size:
+            data = (struct.pack('>Q', offset) + block)[:min(len(block), size - offset)]
+            f.write(data)
+            offset += len(data)
+
+
+def _write_small_file(native_path, rng, size):
+    with open(native_path, 'wb') as f:
+        f.write(_random_bytes(rng, size))
+
+
+def make_tiny_files(root, rng, scale):
+    """Many tiny files, 100 per directory."""
+    for i in xrange(int(5000 * scale)):
+        directory = os.path.join(root, 'd{:04}'.format(i // 100))
+        if i % 100 == 0:
+            os.mkdir(directory)
+        _write_small_file(os.path.join(directory, 'f{:06}'.format(i)), rng,
+                          rng.randint(0, 4096))
+
+
+def make_huge_files(root, rng, scale):
+    """A few huge files."""
+    for i in xrange(4):
+        _write_file(os.path.join(root, 'huge{}'.format(i)), rng,
+                    int(64 * 1024 * 1024 * scale))
+
+
+def make_deep_tree(root, rng, scale):
+    """Chains of nested directories with a file at every level."""
+    for chain in xrange(10):
+        directory = root
+        for depth in xrange(max(1, int(50 * scale))):
+            directory = os.path.join(directory, 'c{}l{}'.format(chain, depth))
+            os.mkdir(directory)
+            _write_small_file(os.path.join(directory, 'file'), rng,
+                              rng.randint(0, 1024))
+
+
+def make_wide_tree(root, rng, scale):
+    """A single directory with many entries."""
+    for i in xrange(int(10000 * scale)):
+        _write_small_file(os.path.join(root, 'f{:06}'.format(i)), rng,
+                          rng.randint(0, 256))
+
+
+"""Generators of synthetic trees; each is called as f(root, rng, scale)
+with an existing empty directory root, a random.Random and a scale
+factor."""
+TREE_SHAPES = collections.OrderedDict([
+    ('tiny_files', make_tiny_files),
+    ('huge_files', make_huge_files),
+    ('deep_tree', make_deep_tree),
+    ('wide_tree', make_wide_tree),
+])
+
+
+def make_pattern_file(rng, paths, num_patterns=500):
+    """Return the text of a long pattern file for a tree.
+
+    Most patterns exclude paths that do not exist, so that nearly all
+    of the tree is still included, but every path has to be matched
+    against every pattern.
+    """
+    lines = ['+ /']
+    for i in xrange(num_patterns):
+        if paths and i % 50 == 0:
+            lines.append('- {}'.format(rng.choice(paths)))
+        else:
+            lines.append('- /excluded/{}/{}'.format(i, rng.getrandbits(32)))
+    return '\n'.join(lines) + '\n'
+
+
+def _run_isolated(f, *args):
+    """Run f(*args) in a child process with stats enabled.
+
+    f must return a pair (number of files, number of bytes) processed.
+
+    Returns:
+      A dictionary with wall and CPU seconds, throughput, peak memory
+      use and the counters of the stats module. The peak memory use is
+      that above the memory the child inherited from this process.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        data = {}
+        try:
+            stats.enable()
+            # A forked child starts with the resident memory of its
+            # parent, which ru_maxrss includes.
+            inherited_rss = stats.report()['peak_rss_bytes']
+            with stats.stage('benchmark'):
+                files, num_bytes = f(*args)
+            report = stats.report()
+            wall = report['stages']['benchmark']['wall_seconds']
+            data = {
+                'seconds': wall,
+                'cpu_seconds': report['stages']['benchmark']['cpu_seconds'],
+                'files_per_second': files / wall if wall > 0 else None,
+                'bytes_per_second': num_bytes / wall if wall > 0 else None,
+                'peak_rss_bytes': max(report['peak_rss_bytes'],
+                                      report['peak_rss_children_bytes'],
+                                      inherited_rss) - inherited_rss,
+                'counters': report['counters'],
+            }
+            status = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            with os.fdopen(write_fd, 'w') as out:
+                json.dump(data, out)
+            os._exit(status)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as inp:
+        data = inp.read()
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError('Benchmark {} failed.'.format(f.__name__))
+    return json.loads(data)
+
+
+def _assemble_paths(rootdir, patterns):
+    paths = pattern.assemble_paths(rootdir, patterns)
+    return len(paths.filenames), 0
+
+
+def _hash_list_of_files(native_paths, num_bytes):
+    hashing.hash_list_of_files(native_paths)
+    return len(native_paths), num_bytes
+
+
+def _hashdeep(rootdir, paths, num_bytes):
+    hashdeep.compute_digests(rootdir, paths)
+    return len(paths), num_bytes
+
+
+def _metadata_tree(rootdir, paths, digest_map):
+    metadata.get_metadata_tree(rootdir, paths.filenames, paths.symlinks,
+                               paths.directories, digest_map,
+                               utils.get_uid_name_map(),
+                               utils.get_gid_name_map())
+    return len(paths.filenames), 0
+
+
+def _cas_store(cas_root, native_paths, digest_map, num_bytes):
+    target_cas = cas.CAS(cas_root)
+    for path, native_path in native_paths:
+        if target_cas.has_file(digest_map[path]):
+            continue
+        with open(native_path, 'rb') as f:
+            target_cas.store(f, digest_map[path])
+    target_cas.sync()
+    return len(native_paths), num_bytes
+
+
+def _cas_ilist(cas_root):
+    return sum(1 for _ in cas.CAS(cas_root).ilist()), 0
+
+
+def _verify(rootdir, cas_root, root_hash, num_files, num_bytes, full):
+    tree = cas_tree.CASTree(cas.CAS(cas_root))
+    result = verify.verify_backup(rootdir, tree.root(root_hash), full=full)
+    if result.changed or result.missing or result.unexpected:
+        raise ValueError('Verification of the synthetic tree failed.')
+    return num_files, num_bytes
+
+
+def benchmark_tree(workdir, shape, scale=1.0):
+    """Generate a synthetic tree and time the go-backup stages on it.
+
+    Args:
+      workdir: Directory in which the tree and a scratch CAS are
+        created.
+      shape: Key of TREE_SHAPES.
+      scale: Factor applied to the number or size of generated files.
+
+    Returns:
+      An OrderedDict mapping stage names to the results of
+      _run_isolated.
+    """
+    rng = random.Random(SEED)
+    with _scratch_directory(workdir) as scratch:
+        rootdir = os.path.join(scratch, 'tree')
+        cas_root = os.path.join(scratch, 'cas')
+        os.mkdir(rootdir)
+        TREE_SHAPES[shape](rootdir, rng, scale)
+
+        paths = pattern.assemble_paths(rootdir, [])
+        native_paths = [(p, utils.build_native_path(rootdir, p))
+                        for p in paths.filenames]
+        num_bytes = sum(os.path.getsize(n) for _, n in native_paths)
+        native_digests = hashing.hash_list_of_files([n for _, n in native_paths])
+        digest_map = dict((p, native_digests[n]) for p, n in native_paths)
+        patterns = pattern.parse_pattern_file(StringIO.StringIO(
+            make_pattern_file(rng, paths.filenames)))
+
+        result = collections.OrderedDict()
+        result['assemble_paths'] = _run_isolated(_assemble_paths, rootdir, [])
+        result['assemble_paths_patterns'] = _run_isolated(
+            _assemble_paths, rootdir, patterns)
+        result['hash_list_of_files'] = _run_isolated(
+            _hash_list_of_files, [n for _, n in native_paths], num_bytes)
+        if hashdeep.is_supported_version(hashdeep.version()):
+            result['hashdeep'] = _run_isolated(_hashdeep, rootdir,
+                                               paths.filenames, num_bytes)
+        result['metadata_tree'] = _run_isolated(_metadata_tree, rootdir, paths,
+                                                digest_map)
+        result['cas_store'] = _run_isolated(_cas_store, cas_root, native_paths,
+                                            digest_map, num_bytes)
+        result['cas_ilist'] = _run_isolated(_cas_ilist, cas_root)
+
+        tree = metadata.get_metadata_tree(rootdir, paths.filenames,
+                                          paths.symlinks, paths.directories,
+                                          digest_map, utils.get_uid_name_map(),
+                                          utils.get_gid_name_map())
+        root_hash = directory_blob.store_tree(cas.CAS(cas_root), tree)
+        result['verify_full'] = _run_isolated(_verify, rootdir, cas_root,
+                                              root_hash, len(native_paths),
+                                              num_bytes, True)
+        # A full verify does not record the stat cache, so a first
+        # verify without it records the cache the measured one uses.
+        _run_isolated(_verify, rootdir, cas_root, root_hash,
+                      len(native_paths), num_bytes, False)
+        result['verify_cached'] = _run_isolated(_verify, rootdir, cas_root,
+                                                root_hash, len(native_paths),
+                                                num_bytes, False)
+        return result
+
+
+def benchmark_suite(workdir, scale=1.0, shapes=None):
+    """Run benchmark_tree for several tree shapes.
+
+    Returns:
+      A dictionary mapping each shape to the result of benchmark_tree.
+    """
+    if shapes is None:
+        shapes = TREE_SHAPES.keys()
+    return collections.OrderedDict(
+        (shape, benchmark_tree(workdir, shape, scale)) for shape in shapes)
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    """Return the list of runs recorded in a history file."""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def append_history(path, scale, results):
+    """Append a run of benchmark_suite to a history file and return the
+    recorded entry."""
+    entry = {
+        'time': time.time(),
+        'revision': _revision(),
+        'scale': scale,
+        'results': results,
+    }
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def find_regressions(previous, current, tolerance=REGRESSION_TOLERANCE):
+    """Compare two runs of benchmark_suite.
+
+    Returns:
+      A list of human-readable descriptions of stages whose throughput
+      dropped, or whose peak memory use grew, by more than tolerance.
+    """
+    regressions = []
+    for shape, stages in current.iteritems():
+        for stage_name, now in stages.iteritems():
+            before = previous.get(shape, {}).get(stage_name)
+            if before is None:
+                continue
+            for key in ['files_per_second', 'bytes_per_second']:
+                if before.get(key) and now.get(key) is not None and \
+                        now[key] < before[key] * (1 - tolerance):
+                    regressions.append('{}/{}: {} dropped from {:.1f} to {:.1f}'.format(
+                        shape, stage_name, key, before[key], now[key]))
+            if now['peak_rss_bytes'] > before['peak_rss_bytes'] * (1 + tolerance):
+                regressions.append('{}/{}: peak RSS grew from {} to {} bytes'.format(
+                    shape, stage_name, before['peak_rss_bytes'],
+                    now['peak_rss_bytes']))
+    return regressions
+
+
+def format_results(results):
+    lines = ['{:<12} {:<24} {:>9} {:>12} {:>12} {:>10}'.format(
+        'tree', 'stage', 'seconds', 'files/s', 'MiB/s', 'peak MiB')]
+    for shape, stages in results.iteritems():
+        for stage_name, r in stages.iteritems():
+            lines.append('{:<12} {:<24} {:>9.3f} {:>12.1f} {:>12.1f} {:>10.1f}'.format(
+                shape, stage_name, r['seconds'], r['files_per_second'] or 0,
+                (r['bytes_per_second'] or 0) / 1048576.0,
+                r['peak_rss_bytes'] / 1048576.0))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    usage = ('usage: %s [--durability] [--latency] [--scale S] [--history FILE] '
+             '[--shape NAME]... [workdir]' % sys.argv[0])
+    scale = 1.0
+    history_path = None
+    shapes = []
+    durability = False
+    latency = False
+    args = []
+    argv = iter(sys.argv[1:])
+    try:
+        for arg in argv:
+            if arg == '--durability':
+                durability = True
+            elif arg == '--latency':
+                latency = True
+            elif arg == '--scale':
+                scale = float(next(argv))
+            elif arg == '--history':
+                history_path = next(argv)
+            elif arg == '--shape':
+                shapes.append(next(argv))
+            else:
+                args.append(arg)
+    except (StopIteration, ValueError):
+        print usage
+        sys.exit(1)
+    if len(args) > 1 or any(shape not in TREE_SHAPES for shape in shapes):
+        print usage
+        sys.exit(1)
+    workdir = args[0] if args else tempfile.gettempdir()
+
+    if durability:
+        result = benchmark_cas_durability(workdir)
+        for mode in cas.DURABILITY_MODES:
+            print '%-10s %10.1f blobs/s' % (mode, result[mode])
+        sys.exit(0)
+    if latency:
+        result = benchmark_cas_latency(workdir)
+        for max_in_flight, (restore_seconds, verify_seconds) in result.items():
+            print '%3d in flight: restore %6.2f s, verify %6.2f s' % (
+                max_in_flight, restore_seconds, verify_seconds)
+        sys.exit(0)
+
+    results = benchmark_suite(workdir, scale, shapes or None)
+    print format_results(results)
+    if history_path is not None:
+        previous = [entry for entry in load_history(history_path)
+                    if entry['scale'] == scale]
+        append_history(history_path, scale, results)
+        if previous:
+            regressions = find_regressions(previous[-1]['results'], results)
+            for regression in regressions:
+                print 'REGRESSION: {}'.format(regression)
+            if regressions:
+                sys.exit(2)
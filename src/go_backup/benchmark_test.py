@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Tests for go-backup's benchmarks."""
+
+import benchmark
+import mmap
+import os
+import random
+
+def test_tree_shapes_are_reproducible(tmpdir):
+    for shape, make_tree in benchmark.TREE_SHAPES.iteritems():
+        contents = []
+        for run in ['a', 'b']:
+            root = tmpdir.mkdir(shape + run)
+            make_tree(str(root), random.Random(benchmark.SEED), 0.01)
+            contents.append(sorted((f.relto(root), f.read('rb'))
+                                   for f in root.visit() if f.isfile()))
+        assert contents[0] == contents[1]
+        assert contents[0]
+
+def test_benchmark_tree(tmpdir):
+    result = benchmark.benchmark_tree(str(tmpdir), 'deep_tree', 0.1)
+    for stage in ['assemble_paths', 'assemble_paths_patterns',
+                  'hash_list_of_files', 'metadata_tree', 'cas_store',
+                  'cas_ilist', 'verify_full', 'verify_cached']:
+        assert result[stage]['seconds'] >= 0
+        assert result[stage]['peak_rss_bytes'] > 0
+    assert result['cas_store']['counters']['cas.blobs_written'] > 0
+    # the scratch directory is removed
+    assert os.listdir(str(tmpdir)) == []
+
+def test_peak_memory_excludes_inherited_memory():
+    inherited = os.urandom(64 * 1048576)
+    def allocate():
+        # fresh pages, rather than ones the allocator may have kept
+        data = mmap.mmap(-1, 16 * 1048576)
+        data.write('x' * len(data))
+        return 1, len(data)
+    result = benchmark._run_isolated(allocate)
+    assert 16 * 1048576 <= result['peak_rss_bytes'] < len(inherited)
+
+def test_benchmark_cas_latency(tmpdir):
+    result = benchmark.benchmark_cas_latency(str(tmpdir), latency=0.01,
+                                             num_files=40,
+                                             in_flight_limits=(1, 8))
+    # 40 files need at least 80 sequential CAS operations
+    assert result[1][0] > 0.8
+    assert result[8][0] < result[1][0]
+    assert os.listdir(str(tmpdir)) == []
+
+def test_history_and_regressions(tmpdir):
+    path = str(tmpdir.join('history'))
+    before = {'tree': {'stage': {'files_per_second': 100.0,
+                                 'bytes_per_second': None,
+                                 'peak_rss_bytes': 1000}}}
+    after = {'tree': {'stage': {'files_per_second': 50.0,
+                                'bytes_per_second': None,
+                                'peak_rss_bytes': 2000},
+                      'new_stage': {'files_per_second': 1.0,
+                                    'bytes_per_second': None,
+                                    'peak_rss_bytes': 1}}}
+    benchmark.append_history(path, 1.0, before)
+    benchmark.append_history(path, 1.0, after)
+    history = benchmark.load_history(path)
+    assert [entry['results'] for entry in history] == [before, after]
+
+    regressions = benchmark.find_regressions(before, after)
+    assert len(regressions) == 2
+    assert 'files_per_second' in regressions[0]
+    assert 'peak RSS' in regressions[1]
+    assert benchmark.find_regressions(after, after) == []
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Incremental bundles: shipping snapshots between go-backup CASes.
+
+A bundle carries one snapshot from one CAS to another (e.g. to an
+offsite disk) as a single sequential tar stream, so that it can be
+written to a pipe, a tape or a remote shell. It consists of
+
+  - SNAPSHOT_MEMBER, the catalog entry of the snapshot as a JSON
+    object, with the additional field 'base' holding the root hash of
+    the snapshot the bundle is relative to (or null);
+  - 'blobs/<hash>' members with the contents of file blobs (or
+    chunks), uncompressed;
+  - 'directories/<hash>' members with directory metadata blobs;
+  - 'manifests/<hash>' members with the chunk lists of chunked files,
+    in the format of CHUNKS_CODEC blobs (see the cas module).
+
+Only blobs that differ from the base snapshot at the same path are
+included. They are found by walking both snapshots in lock-step, like
+snapshot_diff does: a directory whose blob has the same hash in both
+snapshots is skipped without reading its blob. (Contents moved to a
+new path are thus sent again; import skips blobs it already has.)
+Blobs follow the blobs they reference (chunks before their manifest,
+files and subdirectories before their directory, the root directory
+last), so the bundle can be imported as it is read, without staging
+anything on disk.
+
+Import verifies the hash of every blob before storing it, checks that
+the blobs referenced by each directory are present and finally records
+the snapshot in the catalog of the target CAS. The target CAS must
+already hold the base snapshot, i.e. bundles are imported in the order
+in which they were exported. An interrupted import leaves only
+complete, verified blobs behind and can simply be repeated.
+"""
+
+import json
+import os
+import StringIO
+import sys
+import tarfile
+
+import cas
+import cas_tree
+import catalog
+import directory_blob
+import hashing
+import metadata
+import refcount
+import stats
+
+SNAPSHOT_MEMBER = 'snapshot.json'
+BLOB_PREFIX = 'blobs/'
+DIRECTORY_PREFIX = 'directories/'
+MANIFEST_PREFIX = 'manifests/'
+
+
+def _iter_new_nodes(new_root, old_root):
+    """Yield the file and directory nodes of the snapshot rooted at
+    new_root that differ from the node at the same path in the snapshot
+    rooted at old_root (which may be None), referenced nodes first."""
+    stack = [(new_root, old_root, False)]
+    while stack:
+        new_dir, old_dir, expanded = stack.pop()
+        if expanded:
+            yield new_dir
+            continue
+        stack.append((new_dir, old_dir, True))
+        old_children = {}
+        if isinstance(old_dir, metadata.DirectoryNode):
+            old_children = cas_tree.transient_children(old_dir)
+        for name, child in sorted(
+                cas_tree.transient_children(new_dir).iteritems(), reverse=True):
+            old_child = old_children.get(name)
+            if isinstance(child, metadata.DirectoryNode):
+                if (isinstance(old_child, metadata.DirectoryNode) and
+                        old_child.hash == child.hash):
+                    continue
+                stack.append((child, old_child, False))
+            elif isinstance(child, metadata.FileNode):
+                if (isinstance(old_child, metadata.FileNode) and
+                        old_child.hash == child.hash):
+                    continue
+                yield child
+
+
+def _add_member(tar, name, size, fileobj, mtime):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0o644
+    tar.addfile(info, fileobj)
+
+
+def _format_manifest(chunks):
+    return ''.join('%s %d\n' % (chunk_digest, size)
+                   for chunk_digest, size in chunks)
+
+
+def _parse_manifest(data):
+    chunks = []
+    for line in data.splitlines():
+        chunk_digest, size = line.split()
+        chunks.append((chunk_digest, int(size)))
+    return chunks
+
+
+def export_bundle(source_cas, snapshot, base_root_hash, fileobj):
+    """Write a bundle of a snapshot to a file-like object.
+
+    Args:
+      source_cas: CAS holding the snapshot and its base.
+      snapshot: catalog.Snapshot to export.
+      base_root_hash: Root hash of the snapshot the bundle is relative
+        to, or None for a bundle of the entire snapshot.
+      fileobj: File-like object to write the tar stream to; it is only
+        written sequentially.
+
+    Returns:
+      The number of blobs in the bundle.
+    """
+    tree = cas_tree.CASTree(source_cas)
+    new_root = tree.root(snapshot.root_hash)
+    old_root = tree.root(base_root_hash) if base_root_hash is not None else None
+    mtime = int(snapshot.time)
+    sent = set()
+
+    tar = tarfile.open(fileobj=fileobj, mode='w|')
+    try:
+        header = snapshot._asdict()
+        header['base'] = base_root_hash
+        data = json.dumps(header, sort_keys=True)
+        _add_member(tar, SNAPSHOT_MEMBER, len(data), StringIO.StringIO(data),
+                    mtime)
+
+        for node in _iter_new_nodes(new_root, old_root):
+            hash_digest = node.hash
+            if hash_digest in sent:
+                continue
+            sent.add(hash_digest)
+
+            if isinstance(node, metadata.DirectoryNode):
+                with source_cas.retrieve(hash_digest) as blob:
+                    data = blob.read()
+                _add_member(tar, DIRECTORY_PREFIX + hash_digest, len(data),
+                            StringIO.StringIO(data), mtime)
+                stats.count('bundle.directories_exported')
+                continue
+
+            chunks = source_cas.chunk_list(hash_digest)
+            if chunks is None:
+                with source_cas.retrieve(hash_digest) as blob:
+                    _add_member(tar, BLOB_PREFIX + hash_digest, node.size,
+                                blob, mtime)
+            else:
+                for chunk_digest, size in chunks:
+                    if chunk_digest in sent:
+                        continue
+                    sent.add(chunk_digest)
+                    with source_cas.retrieve(chunk_digest) as blob:
+                        _add_member(tar, BLOB_PREFIX + chunk_digest, size,
+                                    blob, mtime)
+                data = _format_manifest(chunks)
+                _add_member(tar, MANIFEST_PREFIX + hash_digest, len(data),
+                            StringIO.StringIO(data), mtime)
+            stats.count('bundle.files_exported')
+    finally:
+        tar.close()
+    return len(sent)
+
+
+def _import_directory(target_cas, fileobj, hash_digest):
+    data = fileobj.read()
+    if hashing.hash_str(data) != hash_digest:
+        raise ValueError('Blob {} in the bundle is corrupted.'.format(
+            hash_digest))
+    for entry in directory_blob.decode(StringIO.StringIO(data)):
+        if entry.get('hash') and not target_cas.has_file(entry['hash']):
+            raise LookupError('Blob {} referenced by directory {} is neither '
+                              'in the bundle nor in the CAS.'.format(
+                                  entry['hash'], hash_digest))
+    target_cas.store(StringIO.StringIO(data), hash_digest)
+
+
+def _import_manifest(target_cas, fileobj, hash_digest):
+    chunks = _parse_manifest(fileobj.read())
+    for chunk_digest, _ in chunks:
+        if not target_cas.has_file(chunk_digest):
+            raise LookupError('Chunk {} of file {} is neither in the bundle '
+                              'nor in the CAS.'.format(chunk_digest,
+                                                       hash_digest))
+
+    def contents():
+        for chunk_digest, _ in chunks:
+            with target_cas.retrieve(chunk_digest) as blob:
+                while True:
+                    data = blob.read(hashing.READ_BLOCK_SIZE)
+                    if not data:
+                        break
+                    yield data
+    if hashing.hash_chunks(contents()) != hash_digest:
+        raise ValueError('Chunk list of file {} in the bundle is '
+                         'corrupted.'.format(hash_digest))
+    target_cas.store_chunk_list(chunks, hash_digest)
+
+
+def import_bundle(target_cas, fileobj):
+    """Read a bundle from a file-like object into a CAS.
+
+    Args:
+      target_cas: CAS to import into. It must hold the base snapshot
+        of the bundle, if any.
+      fileobj: File-like object to read the tar stream from; it is only
+        read sequentially.
+
+    Returns:
+      The catalog.Snapshot recorded in the catalog of target_cas.
+      Raises a ValueError if the bundle is malformed or a blob in it is
+      corrupted and a LookupError if a referenced blob is missing.
+    """
+    with refcount.writer_lock(target_cas.root):
+        return _import_bundle(target_cas, fileobj)
+
+
+def _import_bundle(target_cas, fileobj):
+    tar = tarfile.open(fileobj=fileobj, mode='r|')
+    try:
+        header = None
+        for member in tar:
+            if header is None:
+                if member.name != SNAPSHOT_MEMBER:
+                    raise ValueError('Not a go-backup bundle.')
+                entry = json.load(tar.extractfile(member))
+                base_root_hash = entry.pop('base')
+                if (base_root_hash is not None and
+                        not target_cas.has_file(base_root_hash)):
+                    raise LookupError('The base snapshot {} of the bundle is '
+                                      'not in the CAS; import it first.'.format(
+                                          base_root_hash))
+                header = catalog.snapshot_from_json(entry)
+                continue
+
+            prefix, _, hash_digest = member.name.partition('/')
+            prefix += '/'
+            if target_cas.has_file(hash_digest):
+                continue
+            member_file = tar.extractfile(member)
+            if prefix == BLOB_PREFIX:
+                target_cas.store(
+                    hashing.VerifyingReader(member_file, hash_digest),
+                    hash_digest)
+                stats.count('bundle.blobs_imported')
+            elif prefix == DIRECTORY_PREFIX:
+                _import_directory(target_cas, member_file, hash_digest)
+                stats.count('bundle.directories_imported')
+            elif prefix == MANIFEST_PREFIX:
+                _import_manifest(target_cas, member_file, hash_digest)
+                stats.count('bundle.manifests_imported')
+            else:
+                raise ValueError('Unexpected bundle member "{}".'.format(
+                    member.name))
+    finally:
+        tar.close()
+
+    if header is None:
+        raise ValueError('Not a go-backup bundle.')
+    if not target_cas.has_file(header.root_hash):
+        raise LookupError('The bundle is incomplete; the root of snapshot {} '
+                          'is missing.'.format(header.root_hash))
+    return catalog.Catalog(target_cas.root).record(
+        target_cas, header.root_hash, header.source, header.files,
+        header.bytes, host=header.host, timestamp=header.time)
+
+
+def export_main(argv):
+    args = []
+    base_root_hash = None
+    source = None
+    argv_iter = iter(argv[1:])
+    try:
+        for arg in argv_iter:
+            if arg == '--base':
+                base_root_hash = next(argv_iter)
+            elif arg == '--source':
+                source = next(argv_iter)
+            else:
+                args.append(arg)
+    except StopIteration:
+        args = []
+    if len(args) != (1 if source is not None else 2):
+        print >>sys.stderr, (
+            "usage: %s [--base ROOT_HASH] (cas_root root_hash | "
+            "--source PATH cas_root) > bundle.tar" % argv[0])
+        return 1
+
+    source_cas = cas.CAS(os.path.abspath(args[0]))
+    snapshots = catalog.Catalog(source_cas.root)
+    if source is not None:
+        snapshot = snapshots.latest(os.path.abspath(source))
+    else:
+        snapshot = snapshots.find(args[1])
+    if snapshot is None:
+        print >>sys.stderr, 'No such snapshot in the catalog.'
+        return 1
+    if base_root_hash is None:
+        base_root_hash = snapshot.parent
+    export_bundle(source_cas, snapshot, base_root_hash, sys.stdout)
+    sys.stdout.flush()
+    return 0
+
+
+def import_main(argv):
+    if len(argv) not in (2, 3):
+        print "usage: %s cas_root [bundle.tar] (default: stdin)" % argv[0]
+        return 1
+
+    target_cas = cas.CAS(os.path.abspath(argv[1]))
+    try:
+        if len(argv) == 3:
+            with open(argv[2], 'rb') as f:
+                snapshot = import_bundle(target_cas, f)
+        else:
+            snapshot = import_bundle(target_cas, sys.stdin)
+    except (LookupError, ValueError, tarfile.TarError) as e:
+        print >>sys.stderr, 'import-next-incremental: {}'.format(e)
+        return 1
+    print snapshot.root_hash
+    return 0
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Tests for go-backup incremental bundles."""
+
+import backup
+import bundle
+import cas
+import catalog
+import hashing
+import pytest
+import restore
+import snapshot_diff
+import cas_tree
+import StringIO
+import tarfile
+
+def make_snapshots(tmpdir):
+    """Back up a tree twice, changing one file in between; return the
+    CAS and the two catalog entries."""
+    source = tmpdir.mkdir('source')
+    source.join('unchanged').mkdir().join('a.txt').write('file a')
+    changed = source.mkdir('changed')
+    changed.join('b.txt').write('version 1')
+    changed.join('big').write('x' * 20000)
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    # stored in three chunks, which backup then finds in the CAS
+    cas.store_chunked_file(test_cas, str(changed.join('big')),
+                           hashing.hash_str('x' * 20000), chunk_size=8192)
+    first = backup.backup(test_cas, str(source), [], num_processes=1,
+                          num_threads=1)
+    changed.join('b.txt').write('version 2')
+    changed.join('c.txt').write('file c')
+    second = backup.backup(test_cas, str(source), [], num_processes=1,
+                           num_threads=1)
+    return test_cas, first, second
+
+def export(test_cas, snapshot, base_root_hash):
+    out = StringIO.StringIO()
+    bundle.export_bundle(test_cas, snapshot, base_root_hash, out)
+    return out.getvalue()
+
+def member_names(data):
+    with tarfile.open(fileobj=StringIO.StringIO(data), mode='r|') as tar:
+        return [member.name for member in tar]
+
+def test_export_import_round_trip(tmpdir):
+    source_cas, first, second = make_snapshots(tmpdir)
+    full = export(source_cas, first, None)
+    incremental = export(source_cas, second, second.parent)
+
+    names = member_names(incremental)
+    assert names[0] == bundle.SNAPSHOT_MEMBER
+    # the new files and the blobs of /changed and /, root last
+    assert sorted(names[1:3]) == sorted([
+        bundle.BLOB_PREFIX + hashing.hash_str('version 2'),
+        bundle.BLOB_PREFIX + hashing.hash_str('file c')])
+    assert names[3:] == [
+        bundle.DIRECTORY_PREFIX + cas_tree.CASTree(source_cas).root(
+            second.root_hash).children['changed'].hash,
+        bundle.DIRECTORY_PREFIX + second.root_hash]
+    assert bundle.MANIFEST_PREFIX + hashing.hash_str('x' * 20000) in (
+        member_names(full))
+
+    target_cas = cas.CAS(tmpdir.mkdir('target'), compression='zlib')
+    with pytest.raises(LookupError):
+        # the base snapshot must be imported first
+        bundle.import_bundle(target_cas, StringIO.StringIO(incremental))
+    assert bundle.import_bundle(target_cas, StringIO.StringIO(full)) == first
+    imported = bundle.import_bundle(target_cas, StringIO.StringIO(incremental))
+    assert imported == second
+    assert catalog.Catalog(target_cas.root).snapshots() == [first, second]
+
+    tree = cas_tree.CASTree(target_cas)
+    assert list(snapshot_diff.iter_diff(
+        cas_tree.CASTree(source_cas).root(second.root_hash),
+        tree.root(second.root_hash))) == []
+    restore.restore(target_cas, second.root_hash, '/changed/big',
+                    str(tmpdir.join('big')))
+    assert tmpdir.join('big').read() == 'x' * 20000
+
+def test_import_rejects_corrupted_blob(tmpdir):
+    source_cas, first, _ = make_snapshots(tmpdir)
+    full = export(source_cas, first, None)
+    corrupted = full.replace('version 1', 'version X')
+
+    target_cas = cas.CAS(tmpdir.mkdir('target'))
+    with pytest.raises(ValueError):
+        bundle.import_bundle(target_cas, StringIO.StringIO(corrupted))
+    assert not target_cas.has_file(hashing.hash_str('version 1'))
+    assert catalog.Catalog(target_cas.root).snapshots() == []
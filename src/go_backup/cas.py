@@ -20,16 +20,355 @@ level of 1, this holds approximately 14K files before directories are
 over-subscribed.  Since most home directories are expected to hold
 more files, the sharding is recommended to be set to 2, which will
 hold 3.6M files. A sharding of 3 or higher is not recommended.
+
+Blobs may optionally be stored compressed. A compressed blob starts
+with the header BLOB_HEADER % codec, followed by the output of the
+codec's compressor; all other blobs are stored verbatim. The hash of a
+blob is always HASH of its uncompressed contents. An uncompressed blob
+whose contents happen to start with BLOB_HEADER_PREFIX is stored with
+the 'none' codec header, so that reading the header is never
+ambiguous.
+
+Blobs stored verbatim keep the holes of sparse files: holes (and other
+blocks of zeros) are skipped over rather than written, see the sparse
+module.
+
+Blobs are written to a temporary file in the TEMP_DIRECTORY
+subdirectory of the CAS root and atomically renamed into place once
+complete, so any number of threads or processes may store into the
+same CAS concurrently. Temporary files left behind by a crashed writer
+are never visible as blobs and may be deleted at any time no writer is
+running.
+
+How eagerly stored blobs are made durable is chosen by the durability
+mode (see DURABILITY_MODES). In the deferred modes a stored blob stays
+in its temporary file, visible only to the CAS object that stored it,
+until sync() has flushed it to disk and renamed it into place. A crash
+thus loses recent blobs but never leaves a blob with wrong contents.
+Callers must call sync() before recording a root hash anywhere, so
+that a snapshot never references blobs that are not durable.
+
+Directories in the CAS root other than shard directories (such as
+TEMP_DIRECTORY and the snapshot catalog, see the catalog module) are
+ignored by list() and ilist().
 """
+import bz2
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import multiprocessing
+import multiprocessing.pool
 import os
-import shutil
+import re
+import StringIO
+import tempfile
+import threading
+import time
+import zlib
+
+import hashing
+import profiling
+import progress
+import sparse
+import stats
 import utils
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+BLOB_HEADER_PREFIX = 'go-backup blob (codec '
+BLOB_HEADER = BLOB_HEADER_PREFIX + '%s)\n'
+MAX_BLOB_HEADER_LENGTH = 64
+
+"""Size of the prefix of a blob that is test-compressed to decide
+whether compressing the entire blob is worthwhile."""
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024
+
+"""Blobs whose sample does not shrink below this fraction of its
+original size (e.g. JPEG images, video, archives) are stored
+uncompressed."""
+COMPRESSIBILITY_THRESHOLD = 0.9
+
+"""Codec name of chunk manifests. The contents of a chunk manifest are
+lines "<chunk hash> <chunk size>\n", one for each chunk in order."""
+CHUNKS_CODEC = 'chunks'
+
+"""Default size of chunks and default size above which store_list_of_files
+splits files into chunks, if chunking is requested."""
+CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKING_THRESHOLD = 256 * 1024 * 1024
+
+"""Constants for the durability modes of a CAS.
+
+DURABILITY_BLOB flushes every blob to disk before store() returns.
+DURABILITY_BATCH flushes stored blobs together once batch_size of them
+have accumulated. DURABILITY_SNAPSHOT flushes only on explicit sync()
+calls, normally once at the end of a snapshot."""
+DURABILITY_BLOB = 'blob'
+DURABILITY_BATCH = 'batch'
+DURABILITY_SNAPSHOT = 'snapshot'
+DURABILITY_MODES = [DURABILITY_BLOB, DURABILITY_BATCH, DURABILITY_SNAPSHOT]
+
+"""Form of a hash digest: a SHA-256 digest in lowercase hex."""
+_DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}\Z')
+
+
+def check_digest(hash_digest):
+    """Raise ValueError unless hash_digest is a well-formed hash digest.
+
+    Digests name files in the CAS, so anything else (such as a digest
+    containing "../") must never reach the file system.
+    """
+    if (not isinstance(hash_digest, basestring) or
+            not _DIGEST_PATTERN.match(hash_digest)):
+        raise ValueError('Invalid hash digest "{}".'.format(hash_digest))
+
+
+def _new_compressor(codec):
+    if codec == 'zlib':
+        return zlib.compressobj(6)
+    elif codec == 'bz2':
+        return bz2.BZ2Compressor(9)
+    elif codec == 'lzma' and lzma is not None:
+        return lzma.LZMACompressor()
+    else:
+        raise ValueError('Unsupported compression codec "{}".'.format(codec))
+
+
+def _new_decompressor(codec):
+    if codec == 'zlib':
+        return zlib.decompressobj()
+    elif codec == 'bz2':
+        return bz2.BZ2Decompressor()
+    elif codec == 'lzma' and lzma is not None:
+        return lzma.LZMADecompressor()
+    else:
+        raise ValueError('Unsupported compression codec "{}".'.format(codec))
+
+
+def supported_codecs():
+    """Return the list of compression codecs usable in this Python."""
+    codecs = ['zlib', 'bz2']
+    if lzma is not None:
+        codecs.append('lzma')
+    return codecs
+
+
+def is_compressible(sample):
+    """Guess whether a blob starting with sample is worth compressing.
+
+    The guess compresses the sample with a fast zlib setting and
+    checks if it shrinks noticeably. Already-compressed media
+    (images, video, archives) does not.
+    """
+    sample = sample[:COMPRESSIBILITY_SAMPLE_SIZE]
+    if not sample:
+        return False
+    compressed_size = len(zlib.compress(sample, 1))
+    return compressed_size < COMPRESSIBILITY_THRESHOLD * len(sample)
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _syncfs(path):
+    """Flush the entire file system containing path to disk.
+
+    Returns:
+      True on success and False if syncfs(2) is not available, in
+      which case the caller has to fsync individual files instead.
+    """
+    if _libc is None or not hasattr(_libc, 'syncfs'):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+    finally:
+        os.close(fd)
+    return True
+
+
+def _read_full(fileobj, size):
+    """Read from fileobj until size bytes or end of file are reached."""
+    parts = []
+    remaining = size
+    while remaining > 0:
+        data = fileobj.read(remaining)
+        if not data:
+            break
+        parts.append(data)
+        remaining -= len(data)
+    return ''.join(parts)
+
+
+class DecompressingReader(object):
+    """Read-only file-like object returning the decompressed contents
+    of a compressed blob."""
+
+    def __init__(self, fileobj, codec):
+        self._fileobj = fileobj
+        self._decompressor = _new_decompressor(codec)
+        self._buffer = ''
+        self._eof = False
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self._fileobj.read(hashing.READ_BLOCK_SIZE)
+            if data:
+                self._buffer += self._decompressor.decompress(data)
+            else:
+                if hasattr(self._decompressor, 'flush'):
+                    self._buffer += self._decompressor.flush()
+                self._eof = True
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self._buffer)
+        data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ChunkedReader(object):
+    """Read-only file-like object returning the concatenated contents
+    of the chunks of a chunked blob."""
+
+    def __init__(self, source_cas, chunks):
+        self._cas = source_cas
+        self._chunks = list(chunks)
+        self._current = None
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            if self._current is None:
+                if not self._chunks:
+                    break
+                chunk_digest, _ = self._chunks.pop(0)
+                self._current = self._cas.retrieve(chunk_digest)
+            data = self._current.read(size)
+            if not data:
+                self._current.close()
+                self._current = None
+                continue
+            parts.append(data)
+            if size > 0:
+                size -= len(data)
+        return ''.join(parts)
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _parse_chunk_list(fileobj):
+    chunks = []
+    for line in fileobj:
+        chunk_digest, size = line.split()
+        chunks.append((chunk_digest, int(size)))
+    return chunks
+
+
+class StoreStatistics(object):
+    """Counters describing the blobs stored in a CAS during one run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.blobs = 0
+        self.compressed_blobs = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def add(self, bytes_in, bytes_out, compressed, seconds):
+        with self._lock:
+            self.blobs += 1
+            if compressed:
+                self.compressed_blobs += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.seconds += seconds
+
+    def ratio(self):
+        """Return bytes_in / bytes_out, or 1.0 if nothing was stored."""
+        if self.bytes_out == 0:
+            return 1.0
+        return float(self.bytes_in) / self.bytes_out
+
+    def throughput(self):
+        """Return the number of uncompressed bytes stored per second."""
+        if self.seconds == 0:
+            return 0.0
+        return self.bytes_in / self.seconds
+
+    def report(self):
+        return ('Stored {} blobs ({} compressed): {} bytes in, {} bytes on disk, '
+                'ratio {:.2f}, {:.1f} MiB/s'.format(
+                    self.blobs, self.compressed_blobs, self.bytes_in,
+                    self.bytes_out, self.ratio(),
+                    self.throughput() / (1024 * 1024)))
+
+
+def read_blob_header(fileobj):
+    """Consume the blob header of an open blob file, if there is one.
+
+    Args:
+      fileobj: Blob file opened for reading, positioned at its start.
+
+    Returns:
+      The codec named in the header, or None if the blob is stored
+      verbatim. On return fileobj is positioned at the start of the
+      (possibly compressed) blob contents.
+    """
+    prefix = _read_full(fileobj, len(BLOB_HEADER_PREFIX))
+    if prefix != BLOB_HEADER_PREFIX:
+        fileobj.seek(0)
+        return None
+    rest = fileobj.readline(MAX_BLOB_HEADER_LENGTH)
+    if not rest.endswith(')\n'):
+        raise ValueError('Malformed blob header.')
+    return rest[:-len(')\n')]
+
 
 class CAS(object):
     NIBBLES_PER_SHARD = 2
+    TEMP_DIRECTORY = 'tmp'
 
-    def __init__(self, root, sharding=2):
+    def __init__(self, root, sharding=2, compression=None,
+                 durability=DURABILITY_BLOB, batch_size=1000):
         """Create a new CAS.
 
         The CAS class is initialized by two main parameters: the root
@@ -41,13 +380,38 @@ class CAS(object):
         Args:
           root: Absolute path to the root directory of the CAS
           sharding: The depth of the sharding in the CAS. Defaults to 2.
+          compression: Codec used to compress newly stored blobs
+            ('zlib', 'bz2' or 'lzma'), or None to store them
+            verbatim. Blobs are read back regardless of this setting.
+          durability: One of DURABILITY_MODES. Defaults to
+            DURABILITY_BLOB.
+          batch_size: Number of blobs flushed together in
+            DURABILITY_BATCH mode.
         """
         # wrap in str() as PyTest's LocalPath does not have e.g. startswith()
         self._root = str(root)
         self._sharding = sharding
+        if compression is not None and compression not in supported_codecs():
+            raise ValueError('Unsupported compression codec "{}".'.format(
+                compression))
+        self._compression = compression
+        if durability not in DURABILITY_MODES:
+            raise ValueError('Unknown durability mode "{}".'.format(durability))
+        self._durability = durability
+        self._batch_size = batch_size
+        # Maps hash digests of stored, but not yet durable blobs to
+        # their temporary files.
+        self._pending = {}
+        self._pending_lock = threading.RLock()
+        self.stats = StoreStatistics()
 
         assert self._root == os.path.abspath(self._root)
 
+    @property
+    def root(self):
+        """Absolute path to the root directory of the CAS."""
+        return self._root
+
     def _get_cas_path_components(self, hash_digest):
         """Compute the file system path components corresponding to this hash
         digest at the specified sharding level.
@@ -79,7 +443,11 @@ class CAS(object):
 
         Returns:
           File system path for hash_digest.
+
+        Raises:
+          ValueError: hash_digest is not a well-formed digest.
         """
+        check_digest(hash_digest)
         return os.path.join(self._root, os.path.join(
             *self._get_cas_path_components(hash_digest)))
 
@@ -93,14 +461,26 @@ class CAS(object):
           True if the file with hash hash_digest is present in the CAS
           and False otherwise.
         """
-        return os.path.exists(self._get_cas_path(hash_digest))
+        stats.count('syscalls.stat')
+        return (hash_digest in self._pending or
+                os.path.exists(self._get_cas_path(hash_digest)))
+
+    def has_files(self, hash_digests):
+        """Return the set of those of hash_digests that are present in
+        the CAS. Ingest asks for all files of a snapshot at once, which
+        a remote CAS (see the remote_cas module) answers in a few round
+        trips."""
+        return set(hash_digest for hash_digest in hash_digests
+                   if self.has_file(hash_digest))
 
     def store(self, fileobj, hash_digest):
         """Store the specified file in the CAS.
 
         This method stores the specified file in the CAS. The
         hash_digest provided is assumed to be correct (i.e. equal to
-        HASH on the file contents).
+        HASH on the file contents). If the CAS was created with
+        compression enabled and the beginning of the file looks
+        compressible, the blob is compressed on the fly.
 
         Args:
           fileobj: File-like object to store in CAS.
@@ -108,17 +488,161 @@ class CAS(object):
 
         Returns:
           This function raises LookupError if the specified file is
-          already in the CAS.
+          already in the CAS. Storing the same file concurrently from
+          several threads or processes is safe; all but the last
+          writer either raise LookupError or harmlessly replace the
+          blob with an identical copy.
+        """
+        if self.has_file(hash_digest):
+            raise LookupError("File already present in the CAS.")
+
+        blocks = sparse.iter_blocks(fileobj, hashing.READ_BLOCK_SIZE)
+        first_block = next(blocks, ('', False))
+        data = first_block[0]
+        codec = None
+        if self._compression is not None and is_compressible(data):
+            codec = self._compression
+        elif data.startswith(BLOB_HEADER_PREFIX):
+            codec = 'none'
+        self._store(itertools.chain([first_block], blocks), hash_digest, codec)
+
+    def store_chunk_list(self, chunks, hash_digest):
+        """Store a file as the list of its chunks.
+
+        The chunks must already be present in the CAS. The blob for
+        hash_digest becomes a manifest (with CHUNKS_CODEC as its codec)
+        listing the chunks, and retrieve() returns their concatenation.
+
+        Args:
+          chunks: List of pairs (hash digest, size) of the chunks of
+            the file, in order.
+          hash_digest: Hash digest of the entire file.
+
+        Returns:
+          This function raises LookupError if the specified file is
+          already in the CAS or if a chunk is missing.
         """
         if self.has_file(hash_digest):
             raise LookupError("File already present in the CAS.")
+        for chunk_digest, _ in chunks:
+            if not self.has_file(chunk_digest):
+                raise LookupError("Chunk not present in the CAS.")
+
+        # The manifest must never become durable before its chunks.
+        self.sync()
+        manifest = ''.join('%s %d\n' % (chunk_digest, size)
+                           for chunk_digest, size in chunks)
+        self._store([(manifest, False)], hash_digest, CHUNKS_CODEC)
 
+    def chunk_list(self, hash_digest):
+        """Return the chunks of a file stored with store_chunk_list.
+
+        Returns:
+          List of pairs (hash digest, size), or None if the blob for
+          hash_digest is not a chunk manifest.
+        """
+        with self._open_blob(hash_digest) as fileobj:
+            if read_blob_header(fileobj) != CHUNKS_CODEC:
+                return None
+            return _parse_chunk_list(fileobj)
+
+    def _store(self, blocks, hash_digest, codec):
+        """Write a blob with the given codec header.
+
+        Args:
+          blocks: Iterable of pairs (data, is_hole) with the blob
+            contents; see sparse.iter_blocks.
+          hash_digest: Hash digest of the blob.
+          codec: Codec named in the blob header, or None for no header.
+        """
         destination_path = self._get_cas_path(hash_digest)
         destination_dir = os.path.dirname(destination_path)
         utils.mkdir_p(destination_dir)
-
-        with open(destination_path, 'wb') as destination_fileobj:
-            shutil.copyfileobj(fileobj, destination_fileobj)
+        temp_dir = os.path.join(self._root, CAS.TEMP_DIRECTORY)
+        utils.mkdir_p(temp_dir)
+
+        start_time = time.time()
+        compressor = None
+        if codec in supported_codecs():
+            compressor = _new_compressor(codec)
+
+        # The blob is written to a private temporary file, which is
+        # only renamed to its final name once it is complete and on
+        # disk. Thus a blob present in the CAS is never truncated,
+        # even if the writer crashes or another writer stores the same
+        # blob concurrently.
+        fd, temp_path = tempfile.mkstemp(dir=temp_dir)
+        try:
+            bytes_in = 0
+            with os.fdopen(fd, 'wb') as destination_fileobj:
+                if codec is not None:
+                    destination_fileobj.write(BLOB_HEADER % codec)
+                if compressor is not None:
+                    for data, _ in blocks:
+                        bytes_in += len(data)
+                        destination_fileobj.write(compressor.compress(data))
+                    destination_fileobj.write(compressor.flush())
+                else:
+                    for data in sparse.write_blocks(blocks,
+                                                    destination_fileobj):
+                        bytes_in += len(data)
+                bytes_out = destination_fileobj.tell()
+                if self._durability == DURABILITY_BLOB:
+                    destination_fileobj.flush()
+                    os.fsync(destination_fileobj.fileno())
+            if self._durability == DURABILITY_BLOB:
+                os.rename(temp_path, destination_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        if self._durability == DURABILITY_BLOB:
+            _fsync_path(destination_dir)
+
+        if self._durability != DURABILITY_BLOB:
+            with self._pending_lock:
+                if hash_digest in self._pending:
+                    # Another thread stored the same blob meanwhile.
+                    os.remove(temp_path)
+                else:
+                    self._pending[hash_digest] = temp_path
+                if (self._durability == DURABILITY_BATCH and
+                    len(self._pending) >= self._batch_size):
+                    self.sync()
+
+        self.stats.add(bytes_in, bytes_out, compressor is not None,
+                       time.time() - start_time)
+        stats.count('cas.blobs_written')
+        stats.count('cas.bytes_in', bytes_in)
+        stats.count('cas.bytes_written', bytes_out)
+
+    @stats.timed('cas_sync')
+    def sync(self):
+        """Make all blobs stored so far durable.
+
+        The blobs' temporary files are flushed to disk first and only
+        then renamed into place, after which the renames are flushed,
+        too. Where available, syncfs(2) is used for flushing; it is
+        much cheaper than fsyncing many small files one by one.
+        """
+        with self._pending_lock:
+            if not self._pending:
+                return
+            pending = sorted(self._pending.items())
+
+            if not _syncfs(self._root):
+                for _, temp_path in pending:
+                    _fsync_path(temp_path)
+
+            destination_dirs = set()
+            for hash_digest, temp_path in pending:
+                destination_path = self._get_cas_path(hash_digest)
+                os.rename(temp_path, destination_path)
+                destination_dirs.add(os.path.dirname(destination_path))
+                del self._pending[hash_digest]
+
+            if not _syncfs(self._root):
+                for destination_dir in sorted(destination_dirs):
+                    _fsync_path(destination_dir)
 
     def retrieve(self, hash_digest):
         """Retrieves the file specified by its digest from the CAS and returns
@@ -134,7 +658,42 @@ class CAS(object):
         if not self.has_file(hash_digest):
             raise LookupError("File not present in the CAS.")
 
-        return open(self._get_cas_path(hash_digest), 'rb')
+        fileobj = self._open_blob(hash_digest)
+        stats.count('cas.blobs_read')
+        codec = read_blob_header(fileobj)
+        if codec in (None, 'none'):
+            return fileobj
+        elif codec == CHUNKS_CODEC:
+            with fileobj:
+                return ChunkedReader(self, _parse_chunk_list(fileobj))
+        return DecompressingReader(fileobj, codec)
+
+    def remove(self, hash_digest):
+        """Delete a blob from the CAS.
+
+        Only blobs that no snapshot references may be removed; see the
+        refcount module. Raises LookupError if the blob is not in the
+        CAS.
+        """
+        with self._pending_lock:
+            path = self._pending.pop(hash_digest, None)
+        if path is None:
+            path = self._get_cas_path(hash_digest)
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise LookupError("File not present in the CAS.")
+        stats.count('cas.blobs_removed')
+
+    def _open_blob(self, hash_digest):
+        """Open the raw blob file, including its header."""
+        with self._pending_lock:
+            path = self._pending.get(hash_digest)
+            if path is None:
+                path = self._get_cas_path(hash_digest)
+            return open(path, 'rb')
 
     def list(self):
         """Returns the list of hashes of all files in the CAS.
@@ -150,13 +709,189 @@ class CAS(object):
         Return:
            The iterator of hashes. The iteration order is unspecified.
         """
+        with self._pending_lock:
+            pending = self._pending.keys()
+        for hash_digest in pending:
+            yield hash_digest
+
         for (dirpath, dirnames, filenames) in os.walk(self._root):
             # All files in uncorrupted CAS were previously stored
             # by a .store() call, so we construct the hashes by
             # joining shards encoded in dirpath and the file names.
             path_parts = utils.get_path_parts(dirpath)
-            shard_parts = path_parts[-self._sharding:]
-
+            depth = len(path_parts) - len(utils.get_path_parts(self._root))
+            shard_parts = path_parts[len(path_parts) - depth:]
+
+            # Only descend into shard directories; the CAS root also
+            # holds bookkeeping directories such as TEMP_DIRECTORY.
+            if depth < self._sharding:
+                dirnames[:] = [d for d in dirnames if _is_shard_name(d)]
+            else:
+                dirnames[:] = []
+
+            if depth != self._sharding:
+                continue
             for hash_without_shards in filenames:
                 full_hash = ''.join(shard_parts) + hash_without_shards
                 yield full_hash
+
+
+def _is_shard_name(name):
+    return (len(name) == CAS.NIBBLES_PER_SHARD and
+            all(c in '0123456789abcdef' for c in name))
+
+
+def _store_file(args):
+    """Helper function for store_list_of_files; see hashing._hash_file."""
+    target_cas, fn, hash_digest = args
+    try:
+        with open(fn, 'rb') as fileobj:
+            target_cas.store(fileobj, hash_digest)
+    except LookupError:
+        # Another worker stored the same contents in the meantime.
+        return fn, None
+    return fn, hash_digest
+
+
+def _store_chunk(args):
+    """Helper function for store_chunked_file."""
+    target_cas, fn, offset, chunk_size = args
+    with open(fn, 'rb') as fileobj:
+        fileobj.seek(offset)
+        data = fileobj.read(chunk_size)
+    chunk_digest = hashing.hash_str(data)
+    stored = False
+    if not target_cas.has_file(chunk_digest):
+        try:
+            target_cas.store(StringIO.StringIO(data), chunk_digest)
+            stored = True
+        except LookupError:
+            pass
+    return chunk_digest, len(data), stored
+
+
+def store_chunked_file(target_cas, fn, hash_digest, chunk_size=CHUNK_SIZE,
+                       num_threads=None):
+    """Store a file in a CAS as a list of fixed-size chunks.
+
+    The chunks are hashed and stored in parallel. Chunks that did not
+    change since a previous snapshot are already present in the CAS
+    and are not stored again.
+
+    Args:
+      target_cas: CAS to store the file in.
+      fn: Name of the file.
+      hash_digest: Hash digest of the entire file.
+      chunk_size: Size of the chunks in bytes.
+      num_threads: Number of parallel workers. Defaults to number of
+      cores in system.
+
+    Returns:
+      The set of hash digests (of chunks and of the file itself) that
+      were newly stored.
+    """
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+
+    size = os.path.getsize(fn)
+    # An empty file still consists of one (empty) chunk.
+    offsets = xrange(0, max(size, 1), chunk_size)
+    pool = multiprocessing.pool.ThreadPool(num_threads, profiling.init_worker)
+    chunks = []
+    stored = set()
+
+    try:
+        work = [(target_cas, fn, offset, chunk_size) for offset in offsets]
+        for chunk_digest, length, chunk_stored in pool.imap(_store_chunk, work):
+            chunks.append((chunk_digest, length))
+            if chunk_stored:
+                stored.add(chunk_digest)
+        # clean up
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+
+    target_cas.store_chunk_list(chunks, hash_digest)
+    stored.add(hash_digest)
+    return stored
+
+
+@stats.timed('cas_ingest')
+def store_list_of_files(target_cas, file_digests, num_threads=None,
+                        chunk_threshold=None, chunk_size=CHUNK_SIZE):
+    """Store many files in a CAS in parallel.
+
+    Args:
+      target_cas: CAS to store the files in.
+      file_digests: List of pairs (file name, hash digest of the file).
+      num_threads: Number of parallel store workers. Defaults to
+      number of cores in system.
+      chunk_threshold: If not None, files larger than this many bytes
+      are stored with store_chunked_file.
+      chunk_size: Chunk size used for chunked files.
+
+    Returns:
+      The set of hash digests that were newly stored. Files whose
+      contents were already present in the CAS are skipped.
+    """
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+
+    sizes = None
+    if chunk_threshold is not None or progress.is_enabled():
+        sizes = dict((fn, os.path.getsize(fn)) for fn, _ in file_digests)
+        stats.count('syscalls.stat', len(sizes))
+        progress.begin('cas_ingest', files=len(sizes),
+                       bytes=sum(sizes.itervalues()))
+
+    chunked = []
+    if chunk_threshold is not None:
+        chunked = [(fn, digest) for fn, digest in file_digests
+                   if sizes[fn] > chunk_threshold]
+        chunked_names = set(fn for fn, _ in chunked)
+        file_digests = [(fn, digest) for fn, digest in file_digests
+                        if fn not in chunked_names]
+
+    # One batched query instead of one has_file call per file.
+    present = target_cas.has_files(set(digest for _, digest in file_digests))
+    stats.count('cas_ingest.dedup.hits',
+                sum(1 for _, digest in file_digests if digest in present))
+    for fn, digest in file_digests:
+        if digest in present:
+            stats.count('cas_ingest.files')
+            if sizes is not None:
+                progress.advance(files=1, bytes=sizes[fn])
+    file_digests = [(fn, digest) for fn, digest in file_digests
+                    if digest not in present]
+    stats.count('cas_ingest.dedup.misses', len(file_digests))
+
+    pool = multiprocessing.pool.ThreadPool(num_threads, profiling.init_worker)
+    stored = set()
+
+    try:
+        work = [(target_cas, fn, digest) for fn, digest in file_digests]
+        for fn, digest in pool.imap_unordered(_store_file, work):
+            stats.count('cas_ingest.files')
+            if sizes is not None:
+                progress.advance(files=1, bytes=sizes[fn])
+            if digest is not None:
+                stored.add(digest)
+        # clean up
+        pool.close()
+        pool.join()
+    except KeyboardInterrupt:
+        pool.terminate()
+        pool.join()
+        raise
+
+    # Large files are split into chunks, which are stored in parallel.
+    for fn, digest in chunked:
+        if not target_cas.has_file(digest):
+            stored.update(store_chunked_file(target_cas, fn, digest,
+                                             chunk_size, num_threads))
+        progress.advance(files=1, bytes=sizes[fn])
+
+    return stored
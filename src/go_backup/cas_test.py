@@ -3,6 +3,7 @@
 
 import cas
 import hashing
+import os
 import pytest
 import tempfile
 import StringIO
@@ -23,3 +24,227 @@ def test_cas_simple(tmpdir):
         assert test_file_contents == retrieved_contents
 
     assert test_cas.list() == [digest]
+
+
+def store_str(test_cas, contents):
+    digest = hashing.hash_str(contents)
+    test_cas.store(StringIO.StringIO(contents), digest)
+    return digest
+
+
+@pytest.mark.parametrize('codec', cas.supported_codecs())
+def test_cas_compression(tmpdir, codec):
+    """Test that compressible files are stored compressed and retrieved
+    transparently."""
+    test_file_contents = 'go-backup is\na backup tool\n' * 100000
+
+    test_cas = cas.CAS(tmpdir, compression=codec)
+    digest = store_str(test_cas, test_file_contents)
+
+    with open(test_cas._get_cas_path(digest), 'rb') as raw_file:
+        assert raw_file.read().startswith(cas.BLOB_HEADER % codec)
+    assert test_cas.stats.compressed_blobs == 1
+    assert test_cas.stats.bytes_out < len(test_file_contents)
+
+    with test_cas.retrieve(digest) as retrieved_file:
+        assert hashing.hash_fileobj(retrieved_file) == digest
+
+    # a CAS without compression reads the blob all the same
+    with cas.CAS(tmpdir).retrieve(digest) as retrieved_file:
+        assert retrieved_file.read() == test_file_contents
+
+
+def test_cas_compression_skips_incompressible(tmpdir):
+    """Test that random (already compressed-looking) data is stored verbatim."""
+    test_file_contents = os.urandom(200000)
+
+    test_cas = cas.CAS(tmpdir, compression='zlib')
+    digest = store_str(test_cas, test_file_contents)
+
+    with open(test_cas._get_cas_path(digest), 'rb') as raw_file:
+        assert raw_file.read() == test_file_contents
+    assert test_cas.stats.compressed_blobs == 0
+    with test_cas.retrieve(digest) as retrieved_file:
+        assert retrieved_file.read() == test_file_contents
+
+
+def test_cas_header_escaping(tmpdir):
+    """Test that a file looking like a compressed blob is stored unambiguously."""
+    test_file_contents = cas.BLOB_HEADER % 'zlib' + 'not really zlib'
+
+    test_cas = cas.CAS(tmpdir)
+    digest = store_str(test_cas, test_file_contents)
+
+    with open(test_cas._get_cas_path(digest), 'rb') as raw_file:
+        assert raw_file.read().startswith(cas.BLOB_HEADER % 'none')
+    with test_cas.retrieve(digest) as retrieved_file:
+        assert retrieved_file.read() == test_file_contents
+
+
+def test_cas_unsupported_codec(tmpdir):
+    with pytest.raises(ValueError):
+        cas.CAS(tmpdir, compression='rot13')
+
+
+def test_cas_ilist_ignores_bookkeeping(tmpdir):
+    """Test that leftover temporary files are not listed as blobs."""
+    test_cas = cas.CAS(tmpdir)
+    digest = store_str(test_cas, 'abc')
+    tmpdir.join(cas.CAS.TEMP_DIRECTORY).join('tmpXYZ').write('partial')
+
+    assert test_cas.list() == [digest]
+
+
+def test_cas_store_is_atomic(tmpdir):
+    """Test that a failing store leaves no partial blob behind."""
+    class FailingFile(object):
+        def __init__(self):
+            self.calls = 0
+
+        def read(self, size):
+            self.calls += 1
+            if self.calls > 2:
+                raise IOError('read failed')
+            return 'x' * size
+
+    test_cas = cas.CAS(tmpdir)
+    digest = hashing.hash_str('full contents')
+    with pytest.raises(IOError):
+        test_cas.store(FailingFile(), digest)
+
+    assert not test_cas.has_file(digest)
+    assert tmpdir.join(cas.CAS.TEMP_DIRECTORY).listdir() == []
+
+
+def test_store_list_of_files(tmpdir):
+    """Test parallel ingest, including duplicate contents."""
+    source = tmpdir.mkdir('source')
+    file_digests = []
+    for i in xrange(20):
+        contents = 'file number %d' % (i % 5)
+        source.join('f%d' % i).write(contents)
+        file_digests.append((str(source.join('f%d' % i)),
+                             hashing.hash_str(contents)))
+
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    stored = cas.store_list_of_files(test_cas, file_digests, num_threads=4)
+
+    assert stored == set(digest for _, digest in file_digests)
+    assert sorted(test_cas.list()) == sorted(stored)
+    assert cas.store_list_of_files(test_cas, file_digests) == set()
+
+
+@pytest.mark.parametrize('durability', cas.DURABILITY_MODES)
+def test_cas_durability_modes(tmpdir, durability):
+    """Test that stored blobs are usable before and after sync()."""
+    test_cas = cas.CAS(tmpdir, durability=durability, batch_size=3)
+    digests = [store_str(test_cas, 'blob %d' % i) for i in xrange(5)]
+
+    for i, digest in enumerate(digests):
+        assert test_cas.has_file(digest)
+        with test_cas.retrieve(digest) as retrieved_file:
+            assert retrieved_file.read() == 'blob %d' % i
+    assert sorted(test_cas.list()) == sorted(digests)
+
+    test_cas.sync()
+    other_cas = cas.CAS(tmpdir)
+    assert sorted(other_cas.list()) == sorted(digests)
+    assert tmpdir.join(cas.CAS.TEMP_DIRECTORY).listdir() == []
+
+
+def test_cas_deferred_durability(tmpdir):
+    """Test that unsynced blobs are not visible under their final names."""
+    test_cas = cas.CAS(tmpdir, durability=cas.DURABILITY_BATCH, batch_size=3)
+    digests = [store_str(test_cas, 'blob %d' % i) for i in xrange(4)]
+
+    # the first batch of three has been flushed, the last blob has not
+    other_cas = cas.CAS(tmpdir)
+    assert sorted(other_cas.list()) == sorted(digests[:3])
+    assert not other_cas.has_file(digests[3])
+
+
+@pytest.mark.parametrize('durability', cas.DURABILITY_MODES)
+def test_cas_remove(tmpdir, durability):
+    test_cas = cas.CAS(tmpdir, durability=durability, batch_size=3)
+    digests = [store_str(test_cas, 'blob %d' % i) for i in xrange(4)]
+    for digest in digests:
+        test_cas.remove(digest)
+        assert not test_cas.has_file(digest)
+        with pytest.raises(LookupError):
+            test_cas.remove(digest)
+    test_cas.sync()
+    assert test_cas.list() == []
+
+
+def test_cas_failed_store(tmpdir, monkeypatch):
+    """Test that a failed store leaves no temporary file and raises the
+    original error."""
+    test_cas = cas.CAS(tmpdir, durability=cas.DURABILITY_BLOB)
+    def fail(path):
+        raise OSError(5, 'Input/output error')
+    monkeypatch.setattr(os, 'fsync', fail)
+    with pytest.raises(OSError) as error:
+        store_str(test_cas, 'contents')
+    assert error.value.errno == 5
+    assert os.listdir(str(tmpdir.join(cas.CAS.TEMP_DIRECTORY))) == []
+
+    # the blob was renamed before the directory could be synced
+    monkeypatch.undo()
+    monkeypatch.setattr(cas, '_fsync_path', fail)
+    with pytest.raises(OSError) as error:
+        store_str(test_cas, 'contents')
+    assert error.value.errno == 5
+    assert test_cas.list() == [hashing.hash_str('contents')]
+
+
+def test_cas_unknown_durability(tmpdir):
+    with pytest.raises(ValueError):
+        cas.CAS(tmpdir, durability='sometimes')
+
+
+@pytest.mark.parametrize('durability', cas.DURABILITY_MODES)
+def test_store_chunked_file(tmpdir, durability):
+    """Test that a chunked file is retrieved in full and that unchanged
+    chunks are shared between versions of a file."""
+    contents_v1 = ''.join(chr(i % 251) for i in xrange(10000))
+    contents_v2 = contents_v1[:5000] + 'X' + contents_v1[5001:]
+    source = tmpdir.mkdir('source')
+    source.join('v1').write(contents_v1, mode='wb')
+    source.join('v2').write(contents_v2, mode='wb')
+
+    test_cas = cas.CAS(tmpdir.mkdir('cas'), durability=durability)
+    digest_v1 = hashing.hash_str(contents_v1)
+    stored_v1 = cas.store_chunked_file(test_cas, str(source.join('v1')),
+                                       digest_v1, chunk_size=1000)
+    assert len(stored_v1) == 11
+    assert len(test_cas.chunk_list(digest_v1)) == 10
+
+    digest_v2 = hashing.hash_str(contents_v2)
+    stored_v2 = cas.store_chunked_file(test_cas, str(source.join('v2')),
+                                       digest_v2, chunk_size=1000)
+    # only the changed chunk and the new manifest are stored
+    assert len(stored_v2) == 2
+
+    test_cas.sync()
+    for digest, contents in [(digest_v1, contents_v1), (digest_v2, contents_v2)]:
+        with test_cas.retrieve(digest) as retrieved_file:
+            assert retrieved_file.read(1234) == contents[:1234]
+            assert retrieved_file.read() == contents[1234:]
+
+
+def test_store_list_of_files_chunk_threshold(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('small').write('small file')
+    source.join('large').write('large file ' * 1000)
+    file_digests = [(str(source.join(fn)), hashing.hash_str(source.join(fn).read()))
+                    for fn in ['small', 'large']]
+
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    cas.store_list_of_files(test_cas, file_digests, chunk_threshold=100,
+                            chunk_size=4096)
+
+    assert test_cas.chunk_list(file_digests[0][1]) is None
+    assert len(test_cas.chunk_list(file_digests[1][1])) == 3
+    for fn, digest in file_digests:
+        with test_cas.retrieve(digest) as retrieved_file:
+            assert hashing.hash_fileobj(retrieved_file) == digest
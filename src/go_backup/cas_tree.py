@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+"""Lazy view of a snapshot stored in a go-backup CAS.
+
+A CASTree presents the directory metadata blobs in a CAS as a metadata
+tree (see the metadata module), but reads and parses the blob of a
+directory only when the children of that directory are first
+accessed. Browsing one subdirectory of a huge snapshot thus only reads
+the blobs on the way to it.
+
+Parsed blobs are kept in a BlobCache, a least recently used cache
+bounded by the total size of the cached blobs. Blobs are immutable and
+identified by their hash, so a single cache (and a single CASTree) can
+serve any number of snapshots.
+
+Given an async_cas.AsyncCAS, a CASTree can also load blobs ahead of
+time: prefetch_subdirectories starts loading the blobs of the
+subdirectories of a directory in the background, so that walking a
+snapshot on a high-latency CAS keeps many reads in flight instead of
+waiting for one blob at a time.
+"""
+
+import collections
+import cStringIO
+import os
+import threading
+
+import directory_blob
+import metadata
+import stats
+
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024  # 64 mebibytes of blobs
+
+
+class BlobCache(object):
+    """Least recently used cache of parsed directory metadata blobs."""
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE):
+        """Create a new cache.
+
+        Args:
+          max_bytes: Upper bound on the sum of sizes of the encoded
+            blobs whose parsed versions are held by the cache.
+        """
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, hash_digest):
+        """Return the cached value for hash_digest, or None."""
+        with self._lock:
+            item = self._items.pop(hash_digest, None)
+            if item is None:
+                self.misses += 1
+                stats.count('cas_tree.cache.misses')
+                return None
+            self._items[hash_digest] = item
+            self.hits += 1
+            stats.count('cas_tree.cache.hits')
+            return item[0]
+
+    def put(self, hash_digest, value, size):
+        """Cache value, the parsed version of a blob of size bytes."""
+        with self._lock:
+            old_item = self._items.pop(hash_digest, None)
+            if old_item is not None:
+                self._bytes -= old_item[1]
+            if size > self._max_bytes:
+                return
+            self._items[hash_digest] = (value, size)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def __contains__(self, hash_digest):
+        with self._lock:
+            return hash_digest in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class LazyDirectoryNode(metadata.DirectoryNode):
+    """A metadata.DirectoryNode whose children are loaded from the CAS on
+    first access.
+
+    In addition to the fields of metadata.DirectoryNode, the node has
+    a hash attribute, the hash of its directory metadata blob.
+    """
+
+    def __new__(cls, tree, hash_digest, name, mtime, user, group, permissions):
+        self = super(LazyDirectoryNode, cls).__new__(
+            cls, name, mtime, user, group, permissions, None)
+        self.hash = hash_digest
+        self._tree = tree
+        self._children = None
+        return self
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = self.load_children()
+        return self._children
+
+    def load_children(self):
+        """Return the children of this node without keeping them.
+
+        Unlike the children attribute, this allows a single pass over a
+        huge tree to free the parts it has already visited.
+        """
+        if self._children is not None:
+            return self._children
+        return self._tree.load_children(self.hash)
+
+    def prefetch(self):
+        """Start loading the children in the background, if the tree
+        supports it."""
+        if self._children is None:
+            self._tree.prefetch(self.hash)
+
+
+class CASTree(object):
+
+    def __init__(self, source_cas, cache=None, async_source=None):
+        """Create a lazy view of the snapshots in a CAS.
+
+        Args:
+          source_cas: The CAS holding the snapshots.
+          cache: BlobCache for parsed directory blobs. By default a new
+            cache of DEFAULT_CACHE_SIZE is used.
+          async_source: async_cas.AsyncCAS for source_cas, used for
+            prefetching. Without it, prefetch does nothing.
+        """
+        self._cas = source_cas
+        if cache is None:
+            cache = BlobCache()
+        self.cache = cache
+        self._async = async_source
+        self._prefetches = {}
+        self._prefetches_lock = threading.Lock()
+
+    def root(self, hash_digest):
+        """Return the root node of the snapshot with the given root hash.
+
+        The metadata of the root directory itself is not recorded in
+        any blob, so only the name ('') and hash of the returned node
+        are meaningful.
+        """
+        return LazyDirectoryNode(self, hash_digest, '', None, None, None, None)
+
+    def entries(self, hash_digest):
+        """Return the list of directory entries stored in a blob."""
+        entries = self.cache.get(hash_digest)
+        if entries is None:
+            with self._prefetches_lock:
+                prefetch = self._prefetches.pop(hash_digest, None)
+            if prefetch is not None:
+                # Errors of the prefetch are raised by _load below.
+                prefetch.wait()
+                entries = self.cache.get(hash_digest)
+        if entries is None:
+            entries = self._load(hash_digest)
+        return entries
+
+    def _load(self, hash_digest):
+        with self._cas.retrieve(hash_digest) as blob:
+            data = blob.read()
+        entries = directory_blob.decode(cStringIO.StringIO(data))
+        self.cache.put(hash_digest, entries, len(data))
+        return entries
+
+    def prefetch(self, hash_digest):
+        """Start loading a directory blob into the cache in the
+        background. Blocks while the AsyncCAS has the maximum number of
+        operations in flight."""
+        if self._async is None or hash_digest in self.cache:
+            return
+        with self._prefetches_lock:
+            if hash_digest in self._prefetches:
+                return
+            prefetch = self._prefetches[hash_digest] = _Prefetch()
+        # submit blocks while the AsyncCAS is busy, so it is called
+        # without holding the lock. The result is not kept, so that
+        # unused prefetches hold no memory outside of the cache.
+        result = None
+        try:
+            result = self._async.submit(_prefetch, self, hash_digest)
+        finally:
+            prefetch.submitted(result)
+            if result is None:
+                with self._prefetches_lock:
+                    self._prefetches.pop(hash_digest, None)
+        stats.count('cas_tree.prefetches')
+
+    def load_children(self, hash_digest):
+        """Return a dictionary of child nodes of a directory."""
+        children = {}
+        for entry in self.entries(hash_digest):
+            children[entry['name']] = self.node_from_entry(entry)
+        return children
+
+    def node_from_entry(self, entry):
+        """Return the metadata tree node describing a directory entry."""
+        mtime = directory_blob.parse_mtime(entry['mtime'])
+        common = (entry['name'], mtime, entry['user'], entry['group'],
+                  entry['permissions'])
+        if entry['type'] == 'file':
+            return metadata.FileNode(*common, hash=entry['hash'],
+                                     size=entry['size'])
+        elif entry['type'] == 'directory':
+            return LazyDirectoryNode(self, entry['hash'], *common)
+        elif entry['type'] == 'symlink':
+            return metadata.SymlinkNode(*common, link_target=entry['link_target'])
+        else:
+            raise ValueError('Unknown directory entry type "{}".'.format(
+                entry['type']))
+
+
+class _Prefetch(object):
+    """A prefetch of a directory blob, which may still wait to be
+    submitted to the AsyncCAS."""
+
+    def __init__(self):
+        self._submitted = threading.Event()
+        self._result = None
+
+    def submitted(self, result):
+        self._result = result
+        self._submitted.set()
+
+    def wait(self):
+        self._submitted.wait()
+        if self._result is not None:
+            self._result.wait()
+
+
+def _prefetch(tree, hash_digest):
+    tree._load(hash_digest)
+
+
+def prefetch_subdirectories(children):
+    """Start loading the children of the lazily loaded directories in a
+    dictionary of child nodes."""
+    for child in children.itervalues():
+        if isinstance(child, LazyDirectoryNode):
+            child.prefetch()
+
+
+def transient_children(node):
+    """Return the children of a directory node without keeping them
+    referenced from the node, so that already visited parts of a
+    lazily loaded tree can be freed."""
+    if isinstance(node, LazyDirectoryNode):
+        return node.load_children()
+    return node.children
+
+
+def iter_descendants(path, node):
+    """Yield the paths of all descendants of node, which is at path, in
+    sorted order."""
+    if not isinstance(node, metadata.DirectoryNode):
+        return
+    stack = [(path, node)]
+    while stack:
+        cur_path, cur_node = stack.pop()
+        for name, child in sorted(transient_children(cur_node).iteritems(),
+                                  reverse=True):
+            child_path = os.path.join(cur_path, name)
+            yield child_path
+            if isinstance(child, metadata.DirectoryNode):
+                stack.append((child_path, child))
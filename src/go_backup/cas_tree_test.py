@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Tests for the lazy view of snapshots in a go-backup CAS."""
+
+import async_cas
+import cas
+import cas_tree
+import directory_blob
+import hashing
+import metadata
+import threading
+import time
+
+def make_tree(depth, width):
+    """Build a tree of the given depth with width files in each directory."""
+    children = {}
+    for i in xrange(width):
+        name = 'file%d' % i
+        children[name] = metadata.FileNode(
+            name=name, mtime=1400000000, user='root', group='root',
+            permissions='0100644', hash=hashing.hash_str(name), size=i)
+    if depth > 0:
+        children['sub'] = make_tree(depth - 1, width)._replace(name='sub')
+    return metadata.DirectoryNode(name='', mtime=1400000000, user='root',
+                                  group='root', permissions='0040755',
+                                  children=children)
+
+class CountingCAS(cas.CAS):
+    def __init__(self, root):
+        super(CountingCAS, self).__init__(root)
+        self.retrieved = []
+
+    def retrieve(self, hash_digest):
+        self.retrieved.append(hash_digest)
+        return super(CountingCAS, self).retrieve(hash_digest)
+
+def test_lazy_tree_loads_on_demand(tmpdir):
+    test_cas = CountingCAS(tmpdir)
+    root_hash = directory_blob.store_tree(test_cas, make_tree(3, 4))
+
+    tree = cas_tree.CASTree(test_cas)
+    root = tree.root(root_hash)
+    assert test_cas.retrieved == []
+
+    sub = root.children['sub']
+    assert isinstance(sub, metadata.DirectoryNode)
+    assert test_cas.retrieved == [root_hash]
+
+    file_node = sub.children['file2']
+    assert file_node == metadata.FileNode(
+        name='file2', mtime=1400000000, user='root', group='root',
+        permissions='0100644', hash=hashing.hash_str('file2'), size=2)
+    assert test_cas.retrieved == [root_hash, sub.hash]
+
+def test_lazy_tree_cache_shared(tmpdir):
+    test_cas = CountingCAS(tmpdir)
+    root_hash = directory_blob.store_tree(test_cas, make_tree(1, 2))
+
+    tree = cas_tree.CASTree(test_cas)
+    tree.root(root_hash).children['sub'].children
+    # a second snapshot with the same contents is served from the cache
+    tree.root(root_hash).children['sub'].children
+    assert len(test_cas.retrieved) == 2
+    assert tree.cache.hits == 2
+
+def test_blob_cache_eviction():
+    cache = cas_tree.BlobCache(max_bytes=10)
+    cache.put('a', 'A', 4)
+    cache.put('b', 'B', 4)
+    assert cache.get('a') == 'A'
+    cache.put('c', 'C', 4)
+    # 'b' is the least recently used item
+    assert cache.get('b') is None
+    assert cache.get('a') == 'A'
+    assert cache.get('c') == 'C'
+    cache.put('d', 'D', 11)
+    assert cache.get('d') is None
+    assert len(cache) == 2
+
+def test_prefetch_subdirectories(tmpdir):
+    test_cas = CountingCAS(tmpdir)
+    root_hash = directory_blob.store_tree(test_cas, make_tree(3, 4))
+
+    # without an AsyncCAS, prefetching does nothing
+    root = cas_tree.CASTree(test_cas).root(root_hash)
+    cas_tree.prefetch_subdirectories(root.children)
+    assert len(test_cas.retrieved) == 1
+
+    del test_cas.retrieved[:]
+    with async_cas.AsyncCAS(test_cas, max_in_flight=2) as async_source:
+        tree = cas_tree.CASTree(test_cas, async_source=async_source)
+        root = tree.root(root_hash)
+        cas_tree.prefetch_subdirectories(root.children)
+        sub = root.children['sub']
+        assert sub.children['sub'].name == 'sub'
+        # each blob is read once, whether prefetched or not
+        assert len(test_cas.retrieved) == 2
+        assert tree.cache.hits == 1
+
+class BlockingCAS(cas.CAS):
+    """A CAS whose retrieves of one blob wait for an event."""
+    def __init__(self, root, blocked):
+        super(BlockingCAS, self).__init__(root)
+        self.blocked = blocked
+        self.release = threading.Event()
+
+    def retrieve(self, hash_digest):
+        if hash_digest == self.blocked:
+            self.release.wait()
+        return super(BlockingCAS, self).retrieve(hash_digest)
+
+def test_prefetch_blocked_on_busy_cas_does_not_block_others(tmpdir):
+    test_cas = cas.CAS(tmpdir)
+    digests = [directory_blob.store_tree(test_cas, make_tree(0, i))
+               for i in xrange(3)]
+    blocking_cas = BlockingCAS(tmpdir, digests[0])
+    with async_cas.AsyncCAS(blocking_cas, 1) as async_source:
+        tree = cas_tree.CASTree(blocking_cas, async_source=async_source)
+        try:
+            tree.prefetch(digests[0])
+            # waits for the only slot of the AsyncCAS
+            waiting = threading.Thread(target=tree.prefetch,
+                                       args=(digests[1],))
+            waiting.start()
+            time.sleep(0.1)
+
+            loader = threading.Thread(target=tree.entries, args=(digests[2],))
+            loader.start()
+            loader.join(10)
+            loaded = not loader.is_alive()
+        finally:
+            blocking_cas.release.set()
+        assert loaded
+        waiting.join()
+        assert len(tree.entries(digests[1])) == 1
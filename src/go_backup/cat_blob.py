@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""Writing a blob from a go-backup CAS to a file descriptor, verifying
+its hash in the same pass.
+
+Blobs stored verbatim are copied with sendfile(2), which moves the data
+from the page cache to the destination (a pipe, socket or file)
+without copying it through user space. Each block is hashed right
+after it was sent, while it is still in the page cache, so the blob is
+read from disk only once. All other blobs (compressed or chunked) are
+decoded by CAS.retrieve and streamed through a reused buffer.
+
+Either way, the data has been written by the time the hash is known.
+If the hash does not match, cat_blob raises a ValueError and the
+cat-blob command exits with a non-zero status; consumers of its output
+must check that status (e.g. with "set -o pipefail").
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+import hashing
+
+"""Number of bytes sent per sendfile(2) call."""
+ZERO_COPY_BLOCK_SIZE = 8 * 1024 * 1024
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _sendfile = _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                          ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    _sendfile = None
+
+
+def _write_all(out_fd, data):
+    while len(data):
+        written = os.write(out_fd, data)
+        data = data[written:]
+
+
+def _readinto_full(fileobj, buf):
+    """Fill buf from fileobj; return the number of bytes read, which is
+    less than len(buf) only at the end of the file."""
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        n = fileobj.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+def _send_verbatim(blob, out_fd, hasher):
+    """Copy the rest of an open verbatim blob file to out_fd with
+    sendfile(2), feeding it to hasher.
+
+    Returns:
+      The number of bytes copied, or None if out_fd does not support
+      sendfile(2), in which case nothing was copied.
+    """
+    in_fd = blob.fileno()
+    start = blob.tell()
+    end = os.fstat(in_fd).st_size
+    offset = ctypes.c_int64(start)
+    buf = bytearray(min(ZERO_COPY_BLOCK_SIZE, max(end - start, 1)))
+    while offset.value < end:
+        block_start = offset.value
+        count = min(ZERO_COPY_BLOCK_SIZE, end - block_start)
+        while offset.value < block_start + count:
+            sent = _sendfile(out_fd, in_fd, ctypes.byref(offset),
+                             block_start + count - offset.value)
+            if sent < 0:
+                error = ctypes.get_errno()
+                if offset.value == start and error in (errno.EINVAL, errno.ENOSYS):
+                    blob.seek(start)
+                    return None
+                raise OSError(error, os.strerror(error))
+            if sent == 0:
+                raise IOError('Blob file shrank while it was being copied.')
+        # Hash the block while it is still in the page cache.
+        blob.seek(block_start)
+        view = memoryview(buf)[:count]
+        if _readinto_full(blob, view) != count:
+            raise IOError('Blob file shrank while it was being copied.')
+        hasher.update(view)
+    return end - start
+
+
+def _stream(blob, out_fd, hasher):
+    """Copy the contents of a file-like object to out_fd, feeding them
+    to hasher; return the number of bytes copied."""
+    total = 0
+    if hasattr(blob, 'readinto'):
+        buf = bytearray(hashing.READ_BLOCK_SIZE)
+        while True:
+            n = _readinto_full(blob, buf)
+            if not n:
+                break
+            view = memoryview(buf)[:n]
+            hasher.update(view)
+            _write_all(out_fd, view)
+            total += n
+    else:
+        while True:
+            data = blob.read(hashing.READ_BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+            _write_all(out_fd, data)
+            total += len(data)
+    return total
+
+
+def cat_blob(source_cas, hash_digest, out_fd, zero_copy=True):
+    """Write the contents of a blob to out_fd and verify their hash.
+
+    Args:
+      source_cas: CAS holding the blob.
+      hash_digest: Hash of the blob.
+      out_fd: File descriptor to write to.
+      zero_copy: Use sendfile(2) where possible.
+
+    Returns:
+      The number of bytes written. Raises a LookupError if the blob is
+      not in the CAS and a ValueError if the written contents do not
+      match hash_digest.
+    """
+    hasher = hashing.new_hasher()
+    with source_cas.retrieve(hash_digest) as blob:
+        size = None
+        if zero_copy and _sendfile is not None and isinstance(blob, file):
+            size = _send_verbatim(blob, out_fd, hasher)
+        if size is None:
+            size = _stream(blob, out_fd, hasher)
+    digest = hasher.hexdigest()
+    if digest != hash_digest:
+        raise ValueError('Blob {} is corrupted (its contents hash to {}); '
+                         'the output is invalid.'.format(hash_digest, digest))
+    return size
+
+
+def main(argv):
+    import cas
+    import sys
+    args = [arg for arg in argv[1:] if arg != '--no-zero-copy']
+    if len(args) != 2:
+        print "usage: %s [--no-zero-copy] cas_root hash" % argv[0]
+        return 1
+
+    source_cas = cas.CAS(os.path.abspath(args[0]))
+    try:
+        sys.stdout.flush()
+        cat_blob(source_cas, args[1], sys.stdout.fileno(),
+                 zero_copy='--no-zero-copy' not in argv[1:])
+    except (LookupError, ValueError) as e:
+        print >>sys.stderr, 'cat-blob: {}'.format(e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
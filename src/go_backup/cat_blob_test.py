@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Tests for go-backup cat-blob."""
+
+import cas
+import cat_blob
+import hashing
+import os
+import pytest
+from cas_test import store_str
+
+def cat_to_file(test_cas, digest, path, zero_copy=True):
+    with open(path, 'wb') as out:
+        size = cat_blob.cat_blob(test_cas, digest, out.fileno(), zero_copy)
+    assert size == os.path.getsize(path)
+    with open(path, 'rb') as f:
+        return f.read()
+
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_cat_verbatim_blob(tmpdir, monkeypatch, zero_copy):
+    monkeypatch.setattr(cat_blob, 'ZERO_COPY_BLOCK_SIZE', 1000)
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    contents = os.urandom(4500)
+    digest = store_str(test_cas, contents)
+    assert cat_to_file(test_cas, digest, str(tmpdir.join('out')),
+                       zero_copy) == contents
+
+def test_cat_blob_with_none_codec_header(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    contents = cas.BLOB_HEADER_PREFIX + 'looks like a header'
+    digest = store_str(test_cas, contents)
+    assert cat_to_file(test_cas, digest, str(tmpdir.join('out'))) == contents
+
+def test_cat_compressed_and_chunked_blobs(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'), compression='zlib')
+    contents = 'go-backup is\na backup tool\n' * 100000
+    digest = store_str(test_cas, contents)
+    assert cat_to_file(test_cas, digest, str(tmpdir.join('out'))) == contents
+
+    chunked_contents = os.urandom(10000)
+    source = tmpdir.join('big')
+    source.write(chunked_contents, 'wb')
+    chunked_digest = hashing.hash_str(chunked_contents)
+    cas.store_chunked_file(test_cas, str(source), chunked_digest,
+                           chunk_size=1000)
+    assert (cat_to_file(test_cas, chunked_digest, str(tmpdir.join('out2'))) ==
+            chunked_contents)
+
+def test_cat_blob_to_pipe(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    contents = os.urandom(3000)
+    digest = store_str(test_cas, contents)
+    read_fd, write_fd = os.pipe()
+    try:
+        cat_blob.cat_blob(test_cas, digest, write_fd)
+        os.close(write_fd)
+        assert os.read(read_fd, 10000) == contents
+    finally:
+        os.close(read_fd)
+
+@pytest.mark.parametrize('zero_copy', [True, False])
+def test_cat_corrupted_blob(tmpdir, zero_copy):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    digest = store_str(test_cas, os.urandom(3000))
+    with open(test_cas._get_cas_path(digest), 'r+b') as blob:
+        blob.seek(1000)
+        blob.write('corrupted')
+    with pytest.raises(ValueError):
+        cat_to_file(test_cas, digest, str(tmpdir.join('out')), zero_copy)
+
+def test_main_exit_status(tmpdir, capfd):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    digest = store_str(test_cas, 'blob contents')
+    assert cat_blob.main(['cat-blob', str(tmpdir.join('cas')), digest]) == 0
+    assert capfd.readouterr()[0] == 'blob contents'
+
+    with open(test_cas._get_cas_path(digest), 'r+b') as blob:
+        blob.write('B')
+    assert cat_blob.main(['cat-blob', str(tmpdir.join('cas')), digest]) == 1
+    assert 'corrupted' in capfd.readouterr()[1]
+
+    assert cat_blob.main(['cat-blob', str(tmpdir.join('cas')), '0' * 64]) == 1
@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+"""Catalog of the snapshots stored in a go-backup CAS.
+
+Snapshots are blobs like any other, so without a catalog the only way
+to find them would be to read every blob in the CAS. The catalog lives
+in the CATALOG_DIRECTORY subdirectory of the CAS root (which CAS.ilist
+ignores, as it is not a shard directory) and consists of:
+  - LOG_FILE, an append-only log with one JSON object per line and
+    snapshot, holding the fields of Snapshot; and
+  - INDEX_FILE, a JSON object mapping each (host, source) pair to its
+    latest snapshot, together with the size of the log it describes.
+    It is replaced atomically after each append and rebuilt from the
+    log whenever its recorded size does not match the log (e.g. after
+    a crash between appending and updating the index).
+
+Listing snapshots thus reads one line per snapshot, and finding the
+latest snapshot of a source reads only the index. Appends are
+serialized with flock(2). A line torn by a crash is terminated before
+the next append and ignored when reading. Deleting a snapshot appends
+a line whose only key is DELETED_KEY, holding the fields of the
+deleted snapshot.
+
+A snapshot must be durable before it is recorded, so record() calls
+CAS.sync() first. If the CAS has a refcount index (see the refcount
+module), record() and delete() keep it up to date, and delete() frees
+the blobs that only the deleted snapshot referenced.
+"""
+
+import collections
+import fcntl
+import json
+import os
+import socket
+import time
+
+import stats
+
+CATALOG_DIRECTORY = 'catalog'
+LOG_FILE = 'snapshots'
+INDEX_FILE = 'index.json'
+DELETED_KEY = 'deleted'
+
+"""Path of the refcount index below the CAS root (see refcount.exists)."""
+REFCOUNT_INDEX_PATH = os.path.join('refcount', 'refcounts.sqlite')
+
+"""A catalog entry. time is in seconds since the epoch; parent is the
+root hash of the previous snapshot of the same host and source, or
+None."""
+Snapshot = collections.namedtuple('Snapshot', ['root_hash', 'host', 'source',
+                                               'time', 'files', 'bytes',
+                                               'parent'])
+
+
+def _index_key(host, source):
+    return '{}:{}'.format(host, source)
+
+
+def snapshot_from_json(entry):
+    """Return the Snapshot described by a JSON object of its fields."""
+    # json returns unicode strings; go-backup uses UTF-8 encoded str
+    return Snapshot(**dict(
+        (str(key), value.encode('utf-8') if isinstance(value, unicode) else value)
+        for key, value in entry.iteritems()))
+
+
+class Catalog(object):
+
+    def __init__(self, cas_root):
+        """Open the catalog of the CAS at cas_root."""
+        self._cas_root = str(cas_root)
+        self._directory = os.path.join(str(cas_root), CATALOG_DIRECTORY)
+        self._log_path = os.path.join(self._directory, LOG_FILE)
+        self._index_path = os.path.join(self._directory, INDEX_FILE)
+
+    def snapshots(self):
+        """Return the list of all snapshots, oldest first."""
+        try:
+            with open(self._log_path, 'rb') as f:
+                return self._read_log(f)
+        except IOError:
+            return []
+
+    def _read_log(self, f):
+        snapshots = []
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # torn by a crash while appending
+                continue
+            if DELETED_KEY in entry:
+                deleted = snapshot_from_json(entry[DELETED_KEY])
+                if deleted in snapshots:
+                    snapshots.remove(deleted)
+                continue
+            snapshots.append(snapshot_from_json(entry))
+        return snapshots
+
+    def find(self, root_hash):
+        """Return the most recently recorded snapshot with the given root
+        hash, or None."""
+        found = None
+        for snapshot in self.snapshots():
+            if snapshot.root_hash == root_hash:
+                found = snapshot
+        return found
+
+    def latest(self, source, host=None):
+        """Return the latest snapshot of source taken on host (by default
+        this host), or None."""
+        if host is None:
+            host = socket.gethostname()
+        entry = self._load_index()['latest'].get(_index_key(host, source))
+        return snapshot_from_json(entry) if entry is not None else None
+
+    def _load_index(self):
+        try:
+            log_size = os.path.getsize(self._log_path)
+        except OSError:
+            log_size = 0
+        try:
+            with open(self._index_path, 'rb') as f:
+                index = json.load(f)
+            if index['log_size'] == log_size:
+                return index
+        except (IOError, ValueError, KeyError):
+            pass
+        return self._build_index(log_size)
+
+    def _build_index(self, log_size):
+        latest = {}
+        for snapshot in self.snapshots():
+            latest[_index_key(snapshot.host, snapshot.source)] = snapshot._asdict()
+        return {'log_size': log_size, 'latest': latest}
+
+    def _write_index(self, index):
+        temp_path = self._index_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            json.dump(index, f, sort_keys=True)
+        os.rename(temp_path, self._index_path)
+
+    def record(self, target_cas, root_hash, source, files, num_bytes,
+               host=None, timestamp=None):
+        """Make a snapshot durable and record it in the catalog.
+
+        Args:
+          target_cas: CAS holding the snapshot; it is synced first.
+          root_hash: Hash of the root directory blob of the snapshot.
+          source: Native path of the directory that was backed up.
+          files: Number of files in the snapshot.
+          num_bytes: Total size of the files in the snapshot.
+          host: Host name; defaults to the name of this host.
+          timestamp: Time of the snapshot; defaults to now.
+
+        Returns:
+          The recorded Snapshot.
+        """
+        target_cas.sync()
+        if host is None:
+            host = socket.gethostname()
+        if timestamp is None:
+            timestamp = time.time()
+        if not os.path.isdir(self._directory):
+            os.makedirs(self._directory)
+
+        with open(self._log_path, 'ab') as log:
+            fcntl.flock(log, fcntl.LOCK_EX)
+            try:
+                index = self._load_index()
+                parent = index['latest'].get(_index_key(host, source))
+                snapshot = Snapshot(root_hash, host, source, timestamp, files,
+                                    num_bytes,
+                                    parent['root_hash'] if parent else None)
+
+                if self._has_refcount_index():
+                    import refcount
+                    with refcount.RefcountIndex(self._cas_root) as refcounts:
+                        refcounts.add_root(target_cas, root_hash)
+
+                self._append(log, snapshot._asdict())
+                index['latest'][_index_key(host, source)] = snapshot._asdict()
+                index['log_size'] = log.tell()
+                self._write_index(index)
+            finally:
+                fcntl.flock(log, fcntl.LOCK_UN)
+        return snapshot
+
+    def _append(self, log, entry):
+        log.seek(0, os.SEEK_END)
+        line = json.dumps(entry, sort_keys=True) + '\n'
+        if log.tell() > 0 and not self._ends_with_newline():
+            line = '\n' + line
+        log.write(line)
+        log.flush()
+        os.fsync(log.fileno())
+
+    def delete(self, source_cas, root_hash):
+        """Delete the oldest snapshot with the given root hash and free
+        the blobs that no other snapshot references.
+
+        Requires a refcount index; raises a LookupError if there is
+        none or if there is no such snapshot.
+
+        Args:
+          source_cas: CAS holding the snapshot.
+          root_hash: Root hash of the snapshot.
+
+        Returns:
+          The number of blobs removed from the CAS.
+        """
+        if not self._has_refcount_index():
+            raise LookupError('The CAS has no refcount index; create it with '
+                              'gc --init.')
+        import refcount
+        with refcount.exclusive_lock(self._cas_root):
+            with open(self._log_path, 'ab') as log:
+                fcntl.flock(log, fcntl.LOCK_EX)
+                try:
+                    for snapshot in self.snapshots():
+                        if snapshot.root_hash == root_hash:
+                            break
+                    else:
+                        raise LookupError('No snapshot {} in the '
+                                          'catalog.'.format(root_hash))
+                    self._append(log, {DELETED_KEY: snapshot._asdict()})
+                    self._write_index(self._build_index(log.tell()))
+                    with refcount.RefcountIndex(self._cas_root) as refcounts:
+                        freed = refcounts.remove_root(source_cas, root_hash)
+                finally:
+                    fcntl.flock(log, fcntl.LOCK_UN)
+
+            for hash_digest in freed:
+                try:
+                    source_cas.remove(hash_digest)
+                except LookupError:
+                    # never stored, or removed by an interrupted delete
+                    continue
+                stats.count('catalog.blobs_freed')
+        return len(freed)
+
+    def _has_refcount_index(self):
+        # Checked without importing refcount, which pulls in sqlite3
+        # and multiprocessing, so that commands that only read the
+        # catalog start quickly.
+        return os.path.exists(os.path.join(self._cas_root,
+                                           REFCOUNT_INDEX_PATH))
+
+    def _ends_with_newline(self):
+        with open(self._log_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == '\n'
+
+
+def format_snapshot(snapshot):
+    return '{}  {}  {}:{}  {} files, {} bytes'.format(
+        time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(snapshot.time)),
+        snapshot.root_hash, snapshot.host, snapshot.source, snapshot.files,
+        snapshot.bytes)
+
+
+def main(argv):
+    args = []
+    host = None
+    source = None
+    latest = False
+    argv_iter = iter(argv[1:])
+    try:
+        for arg in argv_iter:
+            if arg == '--host':
+                host = next(argv_iter)
+            elif arg == '--source':
+                source = next(argv_iter)
+            elif arg == '--latest':
+                latest = True
+            else:
+                args.append(arg)
+    except StopIteration:
+        args = []
+    if len(args) != 1 or (latest and source is None):
+        print ("usage: %s [--host HOST] [--source PATH [--latest]] cas_root"
+               % argv[0])
+        return 1
+
+    catalog = Catalog(os.path.abspath(args[0]))
+    if latest:
+        snapshot = catalog.latest(source, host)
+        if snapshot is None:
+            return 1
+        print format_snapshot(snapshot)
+        return 0
+    for snapshot in catalog.snapshots():
+        if ((host is None or snapshot.host == host) and
+                (source is None or snapshot.source == source)):
+            print format_snapshot(snapshot)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Tests for the go-backup snapshot catalog."""
+
+import cas
+import catalog
+
+class FakeCAS(object):
+    def __init__(self):
+        self.synced = 0
+    def sync(self):
+        self.synced += 1
+
+def test_record_and_list(tmpdir):
+    test_catalog = catalog.Catalog(str(tmpdir))
+    assert test_catalog.snapshots() == []
+    assert test_catalog.latest('/home', 'host') is None
+
+    fake_cas = FakeCAS()
+    first = test_catalog.record(fake_cas, 'a' * 64, '/home', 10, 1000,
+                                host='host', timestamp=1)
+    other = test_catalog.record(fake_cas, 'b' * 64, '/etc', 5, 50,
+                                host='host', timestamp=2)
+    second = test_catalog.record(fake_cas, 'c' * 64, '/home', 11, 1100,
+                                 host='host', timestamp=3)
+    assert fake_cas.synced == 3
+    assert first.parent is None
+    assert second.parent == 'a' * 64
+    assert test_catalog.snapshots() == [first, other, second]
+    assert test_catalog.latest('/home', 'host') == second
+    assert test_catalog.latest('/etc', 'host') == other
+    assert test_catalog.latest('/home', 'elsewhere') is None
+    # a new Catalog object sees the same data
+    assert catalog.Catalog(str(tmpdir)).snapshots() == [first, other, second]
+    assert type(second.root_hash) is str
+
+def test_index_rebuilt(tmpdir):
+    test_catalog = catalog.Catalog(str(tmpdir))
+    test_catalog.record(FakeCAS(), 'a' * 64, '/home', 1, 1, host='h')
+    snapshot = test_catalog.record(FakeCAS(), 'b' * 64, '/home', 1, 1, host='h')
+    index = tmpdir.join(catalog.CATALOG_DIRECTORY, catalog.INDEX_FILE)
+    index.remove()
+    assert test_catalog.latest('/home', 'h') == snapshot
+    # an index that does not describe the whole log is ignored
+    index.write('{"log_size": 1, "latest": {}}')
+    assert test_catalog.latest('/home', 'h') == snapshot
+
+def test_torn_line(tmpdir):
+    test_catalog = catalog.Catalog(str(tmpdir))
+    first = test_catalog.record(FakeCAS(), 'a' * 64, '/home', 1, 1, host='h')
+    log = tmpdir.join(catalog.CATALOG_DIRECTORY, catalog.LOG_FILE)
+    log.write('{"root_hash": "tor', mode='ab')
+    assert test_catalog.snapshots() == [first]
+    second = test_catalog.record(FakeCAS(), 'b' * 64, '/home', 1, 1, host='h')
+    assert test_catalog.snapshots() == [first, second]
+    assert second.parent == first.root_hash
+
+def test_catalog_not_listed_as_blobs(tmpdir):
+    test_cas = cas.CAS(str(tmpdir))
+    catalog.Catalog(test_cas.root).record(test_cas, 'a' * 64, '/', 0, 0)
+    assert test_cas.list() == []
+
+def test_main(tmpdir, capsys):
+    test_catalog = catalog.Catalog(str(tmpdir))
+    test_catalog.record(FakeCAS(), 'a' * 64, '/home', 3, 30, host='h',
+                        timestamp=0)
+    test_catalog.record(FakeCAS(), 'b' * 64, '/etc', 1, 1, host='h')
+    assert catalog.main(['list-snapshots', '--source', '/home', str(tmpdir)]) == 0
+    out = capsys.readouterr()[0]
+    assert out == '1970-01-01T00:00:00Z  {}  h:/home  3 files, 30 bytes\n'.format('a' * 64)
+    assert catalog.main(['list-snapshots', '--host', 'h', '--source', '/etc',
+                         '--latest', str(tmpdir)]) == 0
+    assert 'b' * 64 in capsys.readouterr()[0]
+    assert catalog.main(['list-snapshots']) == 1
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""The go-backup command line: go-backup <subcommand> [args...].
+
+Each subcommand is implemented by a function taking argv (normally main)
+in one of the modules, which is imported only when the subcommand runs.
+Startup time of a subcommand is thus determined by the modules it needs,
+not by all of go-backup. This module must therefore not import any
+go-backup modules at the top level.
+
+The --profile DIR and --profile-memory options (see profiling) are
+handled here for all subcommands.
+"""
+
+import collections
+import sys
+
+"""Maps subcommand names to (module, function, one-line description)."""
+COMMANDS = collections.OrderedDict([
+    ('backup', ('backup', 'main', 'store a snapshot of a directory tree')),
+    ('verify', ('verify', 'main', 'compare a restored tree with its snapshot')),
+    ('restore', ('restore', 'main', 'restore a snapshot or a part of it')),
+    ('diff', ('snapshot_diff', 'main',
+              'list the differences between two snapshots')),
+    ('list-snapshots', ('catalog', 'main', 'list the snapshots in a CAS')),
+    ('cat-blob', ('cat_blob', 'main',
+                  'write a blob to stdout, verifying its hash')),
+    ('export-next-incremental', ('bundle', 'export_main',
+                                 'write a snapshot bundle to stdout')),
+    ('import-next-incremental', ('bundle', 'import_main',
+                                 'import a snapshot bundle into a CAS')),
+    ('serve', ('remote_cas', 'main', 'serve a CAS over the network')),
+    ('space', ('space', 'main',
+               'report the deduplicated and unique size of each snapshot')),
+    ('gc', ('garbage_collection', 'main',
+            'delete snapshots and free the blobs only they use')),
+    ('watch', ('journal', 'main',
+               'record the changes below a tree for incremental backups')),
+])
+
+
+def usage(prog):
+    lines = ['usage: {} <subcommand> [args...]'.format(prog), '',
+             'Subcommands:']
+    for name, (_, _, description) in COMMANDS.iteritems():
+        lines.append('  {:<24} {}'.format(name, description))
+    lines.append('')
+    lines.append('Run "{} <subcommand>" without arguments for its usage.'.format(
+        prog))
+    lines.append('All subcommands accept --profile DIR [--profile-memory].')
+    return '\n'.join(lines)
+
+
+def main(argv):
+    """Run the subcommand named in argv[1] and return its exit status."""
+    prog = 'go-backup'
+    if len(argv) >= 2 and argv[1] in ('help', '-h', '--help'):
+        print usage(prog)
+        return 0
+    if len(argv) < 2 or argv[1] not in COMMANDS:
+        if len(argv) >= 2:
+            print >>sys.stderr, 'Unknown subcommand "{}".'.format(argv[1])
+        print >>sys.stderr, usage(prog)
+        return 2
+
+    args = argv[2:]
+    if any(arg.startswith('--profile') for arg in args):
+        import profiling
+        args = profiling.handle_options(args)
+    module_name, function_name, _ = COMMANDS[argv[1]]
+    function = getattr(__import__(module_name), function_name)
+    return function(['{} {}'.format(prog, argv[1])] + args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Tests for the go-backup command line."""
+
+import cli
+import os
+import subprocess
+import sys
+
+def test_unknown_subcommand(capsys):
+    assert cli.main(['go-backup', 'frobnicate']) == 2
+    assert 'Unknown subcommand' in capsys.readouterr()[1]
+    assert cli.main(['go-backup']) == 2
+
+def test_help(capsys):
+    assert cli.main(['go-backup', 'help']) == 0
+    out = capsys.readouterr()[0]
+    for name in cli.COMMANDS:
+        assert name in out
+
+def test_subcommands_exist():
+    for name, (module_name, function_name, _) in cli.COMMANDS.iteritems():
+        assert callable(getattr(__import__(module_name), function_name))
+
+def test_subcommand_usage(capsys):
+    assert cli.main(['go-backup', 'restore']) == 1
+    assert 'usage: go-backup restore' in capsys.readouterr()[0]
+
+def test_imports_are_lazy():
+    code = ('import cli, sys\n'
+            'cli.main(["go-backup", "help"])\n'
+            'print sorted(m for m in ["cas", "hashing", "verify"] if m in sys.modules)\n')
+    out = subprocess.check_output([sys.executable, '-c', code],
+                                  cwd=os.path.dirname(os.path.abspath(cli.__file__)))
+    assert out.splitlines()[-1] == '[]'
+
+def test_list_snapshots_imports_no_refcount(tmpdir):
+    code = ('import cli, sys\n'
+            'cli.main(["go-backup", "list-snapshots", sys.argv[1]])\n'
+            'print sorted(m for m in ["refcount", "multiprocessing", "sqlite3"]\n'
+            '             if m in sys.modules)\n')
+    out = subprocess.check_output([sys.executable, '-c', code,
+                                   str(tmpdir.mkdir('cas'))],
+                                  cwd=os.path.dirname(os.path.abspath(cli.__file__)))
+    assert out.splitlines()[-1] == '[]'
+
+def test_profile_any_subcommand(tmpdir):
+    directory = tmpdir.join('profile')
+    subprocess.check_call([sys.executable, 'cli.py', 'space', '--profile',
+                           str(directory), str(tmpdir.mkdir('cas'))],
+                          cwd=os.path.dirname(os.path.abspath(cli.__file__)))
+    assert directory.join('main.prof').check()
@@ -0,0 +1,9 @@
+"""Shared fixtures for the go-backup tests."""
+
+import pytest
+
+@pytest.fixture(autouse=True)
+def cache_home(tmpdir_factory, monkeypatch):
+    """Keep the stat caches of restored trees out of the user's cache
+    directory."""
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmpdir_factory.mktemp('cache')))
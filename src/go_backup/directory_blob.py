@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""Encoding and decoding of go-backup directory metadata blobs.
+
+The format of directory metadata blobs is specified in README.md: the
+HEADER line followed by
+
+  json.dump(entries, indent=2, encoding="utf-8", separators=(',', ': '),
+            sort_keys=True)
+
+of the list of directory entries sorted by name. reference_encode()
+implements exactly that. iterencode() produces the same bytes, but is
+specialized to the fixed directory entry schema, which makes it several
+times faster than the generic json encoder. Strings are escaped by the
+same function json uses internally, so the two agree byte for byte.
+"""
+
+import calendar
+import cStringIO
+import json
+import json.encoder
+import time
+
+import hashing
+import metadata
+import stats
+
+HEADER = 'go-backup metadata (version 1)\n'
+
+"""Keys of a directory entry, in the order produced by sort_keys=True."""
+ENTRY_KEYS = ['group', 'hash', 'link_target', 'mtime', 'name', 'permissions',
+              'size', 'type', 'user']
+
+_encode_string = json.encoder.encode_basestring_ascii
+_FIRST_KEY_PREFIXES = dict((key, '\n    "%s": ' % key) for key in ENTRY_KEYS)
+_KEY_PREFIXES = dict((key, ',\n    "%s": ' % key) for key in ENTRY_KEYS)
+
+
+def format_mtime(mtime):
+    """Return the string representation of mtime used in directory entries."""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(mtime))
+
+
+def parse_mtime(mtime_string):
+    """Inverse of format_mtime; returns seconds since the epoch."""
+    return calendar.timegm(time.strptime(mtime_string, "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def node_entry(node, hash_digest=None):
+    """Return the directory entry describing a metadata tree node.
+
+    Args:
+      node: A metadata.FileNode, metadata.DirectoryNode or
+        metadata.SymlinkNode.
+      hash_digest: Hash of the directory metadata blob of node; only
+        used (and required) for directory nodes.
+    """
+    entry = {
+        'name': node.name,
+        'mtime': format_mtime(node.mtime),
+        'user': node.user,
+        'group': node.group,
+        'permissions': node.permissions,
+    }
+    if isinstance(node, metadata.FileNode):
+        entry['type'] = 'file'
+        entry['size'] = node.size
+        entry['hash'] = node.hash
+    elif isinstance(node, metadata.DirectoryNode):
+        if hash_digest is None:
+            raise ValueError('Directory entries require a hash.')
+        entry['type'] = 'directory'
+        entry['hash'] = hash_digest
+    elif isinstance(node, metadata.SymlinkNode):
+        entry['type'] = 'symlink'
+        entry['link_target'] = node.link_target
+    else:
+        raise ValueError('Unknown node type {}.'.format(type(node)))
+    return entry
+
+
+def _sorted_entries(entries):
+    return sorted(entries, key=lambda entry: entry['name'])
+
+
+def reference_encode(entries):
+    """Encode a directory metadata blob using the json module."""
+    f = cStringIO.StringIO()
+    f.write(HEADER)
+    json.dump(_sorted_entries(entries), f, indent=2, encoding="utf-8",
+              separators=(',', ': '), sort_keys=True)
+    return f.getvalue()
+
+
+def _encode_value(value):
+    if isinstance(value, basestring):
+        return _encode_string(value)
+    elif isinstance(value, (int, long)) and not isinstance(value, bool):
+        return str(value)
+    else:
+        raise TypeError('Unexpected value {!r} in directory entry.'.format(
+            value))
+
+
+def iterencode(entries):
+    """Encode a directory metadata blob.
+
+    Returns:
+      An iterator of strings whose concatenation equals
+      reference_encode(entries); there is one string per entry.
+    """
+    yield HEADER
+    entries = _sorted_entries(entries)
+    if not entries:
+        yield '[]'
+        return
+    separator = '[\n  {'
+    for entry in entries:
+        parts = [separator]
+        prefixes = _FIRST_KEY_PREFIXES
+        for key in ENTRY_KEYS:
+            if key in entry:
+                value = entry[key]
+                parts.append(prefixes[key])
+                if type(value) is str:
+                    parts.append(_encode_string(value))
+                else:
+                    parts.append(_encode_value(value))
+                prefixes = _KEY_PREFIXES
+        if len(parts) != 2 * len(entry) + 1:
+            unknown_keys = sorted(set(entry) - set(ENTRY_KEYS))
+            raise ValueError('Unexpected keys {} in directory entry.'.format(
+                unknown_keys))
+        parts.append('\n  }')
+        yield ''.join(parts)
+        separator = ',\n  {'
+    yield '\n]'
+
+
+def encode(entries):
+    """Encode a directory metadata blob and return it as a string."""
+    return ''.join(iterencode(entries))
+
+
+def decode(fileobj):
+    """Parse a directory metadata blob and return its list of entries.
+
+    Raises a ValueError if the blob is not a directory metadata blob of
+    the supported version.
+    """
+    header = fileobj.readline()
+    if header != HEADER:
+        raise ValueError('Unsupported directory metadata header {!r}.'.format(
+            header))
+    # json returns unicode strings; go-backup uses byte strings everywhere.
+    return [dict((str(k), v.encode('utf-8') if isinstance(v, unicode) else v)
+                 for k, v in entry.iteritems())
+            for entry in json.load(fileobj, encoding="utf-8")]
+
+
+@stats.timed('store_tree')
+def store_tree(target_cas, root_node):
+    """Store the directory metadata blobs of a metadata tree in a CAS.
+
+    Only directory blobs are stored; file contents have to be stored
+    separately. Blobs that are already present in the CAS are not
+    written again, and directory nodes that have a hash attribute are
+    taken to be stored along with their subtrees.
+
+    Args:
+      target_cas: CAS to store the blobs in.
+      root_node: metadata.DirectoryNode at the root of the tree.
+
+    Returns:
+      Hash of the root directory metadata blob.
+    """
+    return _store_tree(target_cas, root_node)
+
+
+def _store_tree(target_cas, root_node):
+    # Not timed itself, so that nested directories are not counted
+    # once per level.
+    entries = []
+    for child in root_node.children.itervalues():
+        if isinstance(child, metadata.DirectoryNode):
+            # Nodes with a hash (e.g. cas_tree.LazyDirectoryNode) are
+            # stored already.
+            hash_digest = getattr(child, 'hash', None)
+            if hash_digest is None:
+                hash_digest = _store_tree(target_cas, child)
+            entries.append(node_entry(child, hash_digest))
+        else:
+            entries.append(node_entry(child))
+
+    # The CAS needs the hash before the blob, so the blob is encoded
+    # twice (the second time only if it is new) rather than kept in
+    # memory in between.
+    hash_digest = hashing.hash_chunks(iterencode(entries))
+    stats.count('store_tree.directories')
+    if not target_cas.has_file(hash_digest):
+        target_cas.store(_ChunkReader(iterencode(entries)), hash_digest)
+    return hash_digest
+
+
+class _ChunkReader(object):
+    """File-like object reading the concatenation of an iterable of
+    strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Tests for go-backup directory metadata blobs."""
+
+import cas
+import directory_blob
+import hashing
+import metadata
+import pytest
+import random
+import stats
+import StringIO
+import time
+
+def random_string(rng):
+    # Mix plain ASCII with characters json has to escape and UTF-8
+    # encoded non-ASCII characters (including ones outside the BMP).
+    alphabet = ['a', 'b', 'Z', '0', ' ', '.', '"', '\\', '/', '\n', '\t',
+                '\x00', '\x1f', '\x7f', u'\xe9'.encode('utf-8'),
+                u'\u20ac'.encode('utf-8'), u'\U0001f600'.encode('utf-8')]
+    return ''.join(rng.choice(alphabet) for _ in xrange(rng.randint(0, 12)))
+
+def random_entry(rng, name):
+    entry = {
+        'name': name,
+        'mtime': directory_blob.format_mtime(rng.randint(0, 2 ** 32)),
+        'user': random_string(rng),
+        'group': random_string(rng),
+        'permissions': '%04o' % rng.randint(0, 0o7777),
+    }
+    entry_type = rng.choice(['file', 'directory', 'symlink'])
+    entry['type'] = entry_type
+    if entry_type == 'file':
+        entry['size'] = rng.choice([0, 1, rng.randint(0, 2 ** 63)])
+    if entry_type in ('file', 'directory'):
+        entry['hash'] = hashing.hash_str(name)
+    if entry_type == 'symlink':
+        entry['link_target'] = random_string(rng)
+    return entry
+
+def test_iterencode_matches_json_fuzz():
+    rng = random.Random(20140101)
+    for _ in xrange(300):
+        names = set(random_string(rng) for _ in xrange(rng.randint(0, 20)))
+        entries = [random_entry(rng, name) for name in names]
+        assert directory_blob.encode(entries) == directory_blob.reference_encode(entries)
+
+def test_iterencode_empty():
+    assert directory_blob.encode([]) == directory_blob.reference_encode([])
+
+def test_iterencode_rejects_unknown_keys():
+    with pytest.raises(ValueError):
+        directory_blob.encode([{'name': 'x', 'color': 'blue'}])
+
+def test_iterencode_rejects_float_mtime():
+    with pytest.raises(TypeError):
+        directory_blob.encode([{'name': 'x', 'mtime': 1.5}])
+
+def test_decode_roundtrip():
+    rng = random.Random(42)
+    entries = [random_entry(rng, name) for name in ['a', 'b\xc3\xa9', 'c"d']]
+    blob = directory_blob.encode(entries)
+    decoded = directory_blob.decode(StringIO.StringIO(blob))
+    assert decoded == sorted(entries, key=lambda entry: entry['name'])
+
+def test_decode_bad_header():
+    with pytest.raises(ValueError):
+        directory_blob.decode(StringIO.StringIO('go-backup metadata (version 2)\n[]'))
+
+def test_store_tree(tmpdir):
+    file_node = metadata.FileNode(name='f', mtime=0, user='root', group='root',
+                                  permissions='0100644', hash=hashing.hash_str(''),
+                                  size=0)
+    link_node = metadata.SymlinkNode(name='l', mtime=0, user='root', group='root',
+                                     permissions='0120777', link_target='f')
+    sub_node = metadata.DirectoryNode(name='sub', mtime=0, user='root',
+                                      group='root', permissions='0040755',
+                                      children={'f': file_node})
+    root_node = metadata.DirectoryNode(name='', mtime=0, user='root',
+                                       group='root', permissions='0040755',
+                                       children={'sub': sub_node, 'l': link_node,
+                                                 'f': file_node})
+
+    test_cas = cas.CAS(tmpdir)
+    root_digest = directory_blob.store_tree(test_cas, root_node)
+
+    with test_cas.retrieve(root_digest) as root_blob:
+        assert hashing.hash_fileobj(root_blob) == root_digest
+    with test_cas.retrieve(root_digest) as root_blob:
+        entries = directory_blob.decode(root_blob)
+    assert [entry['name'] for entry in entries] == ['f', 'l', 'sub']
+    sub_digest = entries[2]['hash']
+    with test_cas.retrieve(sub_digest) as sub_blob:
+        assert directory_blob.decode(sub_blob) == [entries[0]]
+    assert sorted(test_cas.list()) == sorted([root_digest, sub_digest])
+
+def test_store_tree_stage_time(tmpdir):
+    node = metadata.DirectoryNode(name='d', mtime=0, user='root', group='root',
+                                  permissions='0040755', children={})
+    for i in xrange(11):
+        node = metadata.DirectoryNode(name='d', mtime=0, user='root',
+                                      group='root', permissions='0040755',
+                                      children={'d': node})
+
+    stats.enable()
+    try:
+        start = time.time()
+        directory_blob.store_tree(cas.CAS(tmpdir), node)
+        elapsed = time.time() - start
+        stage = stats.report()['stages']['store_tree']
+    finally:
+        stats.disable()
+    # nested directories are not timed once per level
+    assert stage['calls'] == 1
+    assert stage['wall_seconds'] <= elapsed
+
+def test_chunk_reader():
+    reader = directory_blob._ChunkReader(['ab', '', 'cde', 'f'])
+    assert reader.read(1) == 'a'
+    assert reader.read(3) == 'bcd'
+    assert reader.read() == 'ef'
+    assert reader.read(5) == ''
+
+def test_parse_mtime():
+    for mtime in [0, 1, 1400000000, 2 ** 31 + 5]:
+        assert directory_blob.parse_mtime(directory_blob.format_mtime(mtime)) == mtime
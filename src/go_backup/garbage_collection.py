@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""Garbage collection in a go-backup CAS.
+
+Garbage collection works on the refcount index (see the refcount
+module):
+
+  - build_index (gc --init) creates the index from the snapshots in
+    the catalog; from then on, recording snapshots maintains it;
+  - catalog.Catalog.delete (gc --delete) deletes a snapshot and frees
+    the blobs that no other snapshot references, reading only those;
+  - check (gc --check) recomputes all counts from scratch, compares
+    them with the index and finds the blobs that no snapshot
+    references at all (e.g. left behind by interrupted backups). With
+    repair (gc --check --repair), the index is replaced by the
+    recomputed counts and those blobs are removed.
+
+All of these hold refcount.exclusive_lock, so they wait for running
+backups, and backups wait for them.
+"""
+
+import collections
+import os
+import sys
+
+import async_cas
+import cas
+import catalog
+import refcount
+import stats
+
+"""Result of check: mismatches as returned by refcount.compare, and
+the sorted hashes of the blobs in the CAS that no snapshot
+references."""
+CheckResult = collections.namedtuple('CheckResult', ['mismatches',
+                                                     'unreferenced'])
+
+
+def _compute_counts(source_cas, max_in_flight):
+    root_hashes = [snapshot.root_hash for snapshot in
+                   catalog.Catalog(source_cas.root).snapshots()]
+    return refcount.compute_counts(source_cas, root_hashes, max_in_flight)
+
+
+def build_index(source_cas, max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+    """Create the refcount index of a CAS, replacing any existing one.
+
+    Returns:
+      The number of blobs referenced by the snapshots in the catalog.
+    """
+    with refcount.exclusive_lock(source_cas.root):
+        counts = _compute_counts(source_cas, max_in_flight)
+        with refcount.RefcountIndex(source_cas.root) as refcounts:
+            refcounts.replace(counts)
+    return len(counts)
+
+
+def check(source_cas, repair=False,
+          max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+    """Compare the refcount index of a CAS with counts computed from
+    scratch.
+
+    Args:
+      source_cas: CAS with a refcount index.
+      repair: Whether to replace the index with the computed counts
+        and remove the blobs that no snapshot references.
+      max_in_flight: Number of blobs read at the same time.
+
+    Returns:
+      A CheckResult describing the state before any repair. Raises a
+      LookupError if the CAS has no refcount index.
+    """
+    if not refcount.exists(source_cas.root):
+        raise LookupError('The CAS has no refcount index; create it with '
+                          'gc --init.')
+    with refcount.exclusive_lock(source_cas.root):
+        counts = _compute_counts(source_cas, max_in_flight)
+        with refcount.RefcountIndex(source_cas.root) as refcounts:
+            mismatches = refcount.compare(refcounts.counts(), counts)
+            unreferenced = sorted(hash_digest
+                                  for hash_digest in source_cas.ilist()
+                                  if hash_digest not in counts)
+            if repair:
+                if mismatches:
+                    refcounts.replace(counts)
+                for hash_digest in unreferenced:
+                    source_cas.remove(hash_digest)
+                    stats.count('gc.unreferenced_blobs_removed')
+    return CheckResult(mismatches, unreferenced)
+
+
+def main(argv):
+    argv = stats.handle_options(argv)
+    args = []
+    deletes = []
+    init = False
+    check_index = False
+    repair = False
+    argv_iter = iter(argv[1:])
+    try:
+        for arg in argv_iter:
+            if arg == '--init':
+                init = True
+            elif arg == '--check':
+                check_index = True
+            elif arg == '--repair':
+                repair = True
+            elif arg == '--delete':
+                deletes.append(next(argv_iter))
+            else:
+                args.append(arg)
+    except StopIteration:
+        args = []
+    if (len(args) != 1 or init + check_index + bool(deletes) != 1 or
+            (repair and not check_index)):
+        print ("usage: %s [--stats] [--stats-json FILE] (--init | "
+               "--check [--repair] | --delete ROOT_HASH...) cas_root"
+               % argv[0])
+        return 1
+
+    source_cas = cas.CAS(os.path.abspath(args[0]))
+    try:
+        if init:
+            print '{} blobs referenced'.format(build_index(source_cas))
+            return 0
+        if deletes:
+            snapshots = catalog.Catalog(source_cas.root)
+            for root_hash in deletes:
+                print '{}: {} blobs freed'.format(
+                    root_hash, snapshots.delete(source_cas, root_hash))
+            return 0
+        result = check(source_cas, repair)
+    except (LookupError, ValueError) as e:
+        print >>sys.stderr, 'gc: {}'.format(e)
+        return 1
+    for hash_digest, indexed, computed in result.mismatches:
+        print '{}  indexed {}/{}  computed {}/{}'.format(
+            hash_digest, indexed[0], indexed[1], computed[0], computed[1])
+    print '{} mismatched counts, {} unreferenced blobs{}'.format(
+        len(result.mismatches), len(result.unreferenced),
+        ' (repaired)' if repair else '')
+    if repair or not (result.mismatches or result.unreferenced):
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
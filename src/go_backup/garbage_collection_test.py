@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Tests for go-backup garbage collection."""
+
+import backup
+import cas
+import garbage_collection
+import hashing
+import pytest
+import refcount
+import StringIO
+from restore_test import make_source
+
+def test_build_index_and_check(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    with pytest.raises(LookupError):
+        garbage_collection.check(test_cas)
+    snapshot = backup.backup(test_cas, str(source), [])
+    assert garbage_collection.build_index(test_cas) == 6
+    assert (garbage_collection.check(test_cas) ==
+            garbage_collection.CheckResult([], []))
+
+    # an interrupted backup leaves an unreferenced blob behind
+    orphan = hashing.hash_str('orphan')
+    test_cas.store(StringIO.StringIO('orphan'), orphan)
+    a_digest = hashing.hash_str('file a')
+    with refcount.RefcountIndex(test_cas.root) as refcounts:
+        refcounts.set(a_digest, 0, 3)
+        refcounts.set(snapshot.root_hash, 0, 0)
+        refcounts._connection.commit()
+
+    result = garbage_collection.check(test_cas, repair=True)
+    assert result.unreferenced == [orphan]
+    assert result.mismatches == sorted([
+        (a_digest, (0, 3), (0, 1)),
+        (snapshot.root_hash, (0, 0), (1, 0))])
+    assert not test_cas.has_file(orphan)
+    assert (garbage_collection.check(test_cas) ==
+            garbage_collection.CheckResult([], []))
+
+def test_main(tmpdir, capsys):
+    source = make_source(tmpdir)
+    cas_root = str(tmpdir.join('cas'))
+    test_cas = cas.CAS(cas_root)
+    snapshot = backup.backup(test_cas, str(source), [])
+
+    delete = ['gc', '--delete', snapshot.root_hash, cas_root]
+    assert garbage_collection.main(['gc', cas_root]) == 1
+    assert garbage_collection.main(delete) == 1
+    assert 'gc --init' in capsys.readouterr().err
+    assert garbage_collection.main(['gc', '--init', cas_root]) == 0
+    assert garbage_collection.main(['gc', '--check', cas_root]) == 0
+    assert garbage_collection.main(delete) == 0
+    assert '{}: 6 blobs freed'.format(snapshot.root_hash) in \
+        capsys.readouterr().out
+    assert test_cas.list() == []
@@ -7,6 +7,7 @@ import tempfile
 from collections import namedtuple
 
 import metadata
+import stats
 import utils
 
 Digest = namedtuple('Digest', ['sha1', 'sha256'])
@@ -24,6 +25,7 @@ def is_supported_version(version):
     return version in supported_versions
 
 
+@stats.timed('hashdeep')
 def compute_digests(rootdir, paths, num_threads=None):
     """Return a dict with (path, digest)."""
 
@@ -76,6 +78,8 @@ def compute_digests(rootdir, paths, num_threads=None):
     if len(keys) != len(paths) or set(keys) != set(paths):
         raise ValueError('List of filenames returned by hashdeep does not '
             'match the input list.')
+
+    stats.count('hashdeep.files', len(paths))
     
     return res
 
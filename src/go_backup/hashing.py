@@ -8,6 +8,12 @@ methods implemented here and never compute hashes on their own.
 
 import hashlib
 import multiprocessing
+import os
+
+import profiling
+import progress
+import sparse
+import stats
 
 READ_BLOCK_SIZE = 1024 * 1024  # 1 mebibyte
 
@@ -15,16 +21,49 @@ def hash_str(str):
     """Compute and return the SHA256 digest of a string."""
     return hashlib.sha256(str).hexdigest()
 
+def new_hasher():
+    """Return a new hashlib object for incrementally computing a digest
+    (call update() with the data and hexdigest() for the digest)."""
+    return hashlib.sha256()
+
+def hash_chunks(chunks):
+    """Compute and return the SHA256 digest of the concatenation of an
+    iterable of strings."""
+    hasher = hashlib.sha256()
+    for data in chunks:
+        hasher.update(data)
+    return hasher.hexdigest()
+
 def hash_fileobj(fileobj):
-    """Compute and return the SHA256 digest of a file-like object."""
+    """Compute and return the SHA256 digest of a file-like object.
+
+    The holes of a sparse file are hashed as the zeros they read as,
+    without reading them.
+    """
     hasher = hashlib.sha256()
-    while True:
-        data = fileobj.read(READ_BLOCK_SIZE)
-        if not data:
-            break
+    for data, _ in sparse.iter_blocks(fileobj, READ_BLOCK_SIZE):
         hasher.update(data)
     return hasher.hexdigest()
 
+class VerifyingReader(object):
+    """File-like object that reads from another one and raises a
+    ValueError at the end of the data if it does not have the expected
+    hash. Passing it to CAS.store thus never stores a corrupted blob."""
+
+    def __init__(self, fileobj, hash_digest):
+        self._fileobj = fileobj
+        self._hash_digest = hash_digest
+        self._hasher = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            self._hasher.update(data)
+        elif self._hasher.hexdigest() != self._hash_digest:
+            raise ValueError('Contents of blob {} are corrupted.'.format(
+                self._hash_digest))
+        return data
+
 def _hash_file(fn):
     """Helper function for hash_list_of_files. Semantically this would
     belong inside its caller, but multiprocessing expects the
@@ -32,8 +71,9 @@ def _hash_file(fn):
     https://stackoverflow.com/questions/3288595/)
     """
     with open(fn, "rb") as file:
-        return (fn, hash_fileobj(file))
+        return (fn, hash_fileobj(file), os.fstat(file.fileno()).st_size)
 
+@stats.timed('hashing')
 def hash_list_of_files(file_list, num_processes=None):
     """Given a list of file names, compute and return hashes of all files
     in the list.
@@ -50,12 +90,22 @@ def hash_list_of_files(file_list, num_processes=None):
     if num_processes is None:
         num_processes = multiprocessing.cpu_count()
 
-    pool = multiprocessing.Pool(num_processes)
+    if progress.is_enabled():
+        # The sizes are only needed for the ETA; stat is cheap compared
+        # to reading the files.
+        total_bytes = sum(os.path.getsize(fn) for fn in file_list)
+        stats.count('syscalls.stat', len(file_list))
+        progress.begin('hashing', files=len(file_list), bytes=total_bytes)
+
+    pool = multiprocessing.Pool(num_processes, profiling.init_worker)
     result = {}
 
     try:
-        for fn, digest in pool.imap_unordered(_hash_file, file_list):
+        for fn, digest, size in pool.imap_unordered(_hash_file, file_list):
             result[fn] = digest
+            stats.count('hashing.files')
+            stats.count('hashing.bytes_read', size)
+            progress.advance(files=1, bytes=size)
         # clean up
         pool.close()
         pool.join()
@@ -71,7 +121,8 @@ if __name__ == '__main__':
     # hashing.py matches or exceeds that of sha256deep both for
     # scenarios with small and large files. (This is probably
     # attributed to optimized OpenSSL implementation used by hashlib;
-    # hashdeep uses slower reference implementation.)
+    # hashdeep uses slower reference implementation.) benchmark.py
+    # measures both on synthetic trees.
     import sys
     lst = [fn.strip() for fn in open(sys.argv[1]).read().split("\n") if fn.strip()]
     hashes = hash_list_of_files(lst)
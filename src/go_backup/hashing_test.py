@@ -48,3 +48,6 @@ def test_hash_fileobj_2(tmpdir):
     # check its hash
     with open(test_fn, "rb") as test_file:
         assert hashing.hash_fileobj(test_file) == million_a_digest
+
+def test_hash_chunks():
+    assert hashing.hash_chunks([abc2[:10], abc2[10:], '']) == abc2_digest
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+"""Change journal for incremental scans of a directory tree.
+
+Once a tree is large and changes little between backups, walking and
+stat'ing all of its entries dominates the time of a backup. A Watcher
+(the watch subcommand, run as a daemon) follows the changes below a
+tree with inotify(7) and appends the directories whose entries changed
+to a journal. The next backup then only lists those directories and
+the directories on the way to them, and reuses the directory blobs of
+the previous snapshot for all other subtrees (see Scan).
+
+A journal directory holds
+  - WATCHER_FILE, which the running watcher keeps locked (flock(2))
+    for its lifetime. It holds the id of the watcher, the watched root
+    and, once all watches are in place, the line READY;
+  - JOURNAL_FILE, to which the watcher appends one line per change:
+    'D path' if the entries of the directory at path changed, 'T path'
+    if the entire subtree at path has to be walked (e.g. a directory
+    that was created or moved there) and OVERFLOW if changes were lost
+    (the kernel's event queue overflowed, or a watch could not be
+    added);
+  - PENDING_FILE, the changes taken by backups that did not finish yet;
+  - STATE_FILE, which records the watcher, the snapshot and the
+    patterns of the last backup that used the journal.
+
+A backup takes the journal (renames JOURNAL_FILE and appends it to
+PENDING_FILE) before it starts walking, so that every change made
+after that point ends up in a later journal. Its walk is incremental
+only if the watcher that is running now was already running and ready
+when the previous snapshot was taken, that snapshot is still the
+latest of the tree, the patterns did not change and nothing overflowed.
+Otherwise the tree is walked in full, as without a journal. Changes
+that are reported late (after the journal was taken) are merely
+picked up by the next backup.
+
+inotify reports a change to a hard-linked file only in the directory
+through which it was made, and does not report writes through shared
+memory mappings; files changed only in these ways are missed until a
+full walk.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import json
+import os
+import select
+import signal
+import struct
+import sys
+import uuid
+
+import cas_tree
+import hashing
+import metadata
+import stats
+import utils
+
+WATCHER_FILE = 'watcher'
+JOURNAL_FILE = 'journal'
+TAKING_FILE = 'journal.taking'
+PENDING_FILE = 'pending'
+STATE_FILE = 'state.json'
+SCAN_LOCK_FILE = 'scan.lock'
+
+READY = 'ready'
+OVERFLOW = 'OVERFLOW'
+DIRECTORY = 'D'
+SUBTREE = 'T'
+
+"""Seconds between writes of the changes seen by a watcher."""
+FLUSH_INTERVAL = 1.0
+EVENT_BUFFER_SIZE = 64 * 1024
+
+# From <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+              IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+_EVENT = struct.Struct('iIII')  # wd, mask, cookie, len
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+try:
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_init1.restype = ctypes.c_int
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                   ctypes.c_uint32]
+    _inotify_add_watch.restype = ctypes.c_int
+except AttributeError:
+    # not Linux: there is no watcher, so backups always walk in full
+    _inotify_init1 = _inotify_add_watch = None
+
+
+def _escape(path):
+    # one line per path, whatever bytes the path contains
+    return path.encode('string_escape')
+
+
+def _unescape(line):
+    return line.decode('string_escape')
+
+
+def _same_file(f, path):
+    try:
+        return os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+    except OSError:
+        return False
+
+
+class Watcher(object):
+    """Records the changes below a directory tree in a journal directory."""
+
+    def __init__(self, rootdir, journal_dir):
+        self.rootdir = os.path.normpath(os.path.abspath(rootdir))
+        self.journal_dir = journal_dir
+        self.id = uuid.uuid4().hex
+        self._fd = None
+        self._status = None
+        # watch descriptor -> path of the watched directory
+        self._paths = {}
+        # directories that could not be watched for lack of permissions
+        self._unwatched = set()
+        # journal lines not yet written
+        self._changes = set()
+
+    def start(self):
+        """Lock the journal directory and watch all directories of the
+        tree. Raises a ValueError if another watcher is running."""
+        if _inotify_init1 is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        utils.mkdir_p(self.journal_dir)
+        self._status = open(os.path.join(self.journal_dir, WATCHER_FILE), 'a+')
+        try:
+            fcntl.flock(self._status, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self._status.close()
+            raise ValueError('Another watcher is using the journal {}.'.format(
+                self.journal_dir))
+        self._write_status(ready=False)
+
+        self._fd = _inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._watch_tree(os.sep)
+        # Only changes made from now on are guaranteed to be recorded.
+        self._write_status(ready=True)
+
+    def _write_status(self, ready):
+        self._status.seek(0)
+        self._status.truncate()
+        self._status.write('{}\n{}\n'.format(self.id, _escape(self.rootdir)))
+        if ready:
+            self._status.write(READY + '\n')
+        self._status.flush()
+
+    def close(self):
+        """Stop watching. Changes not yet written are lost, which the
+        next backup detects from the missing watcher."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._status is not None:
+            self._status.close()
+            self._status = None
+
+    def _watch_tree(self, path):
+        for native_root, _, _ in os.walk(
+                utils.build_native_path(self.rootdir, path)):
+            self._add_watch(utils.get_path_from_native_path(self.rootdir,
+                                                            native_root))
+
+    def _add_watch(self, path):
+        native_path = utils.build_native_path(self.rootdir, path)
+        wd = _inotify_add_watch(self._fd, native_path, WATCH_MASK)
+        if wd >= 0:
+            # A directory that is watched already keeps its descriptor.
+            self._paths[wd] = path
+            stats.count('journal.watches')
+            return
+        err = ctypes.get_errno()
+        if err in (errno.ENOENT, errno.ENOTDIR):
+            # removed or replaced in the meantime; its parent is dirty
+            return
+        if err == errno.EACCES:
+            self._unwatched.add(path)
+            return
+        print >>sys.stderr, 'watch: cannot watch {}: {}'.format(
+            native_path, os.strerror(err))
+        self._changes.add(OVERFLOW + '\n')
+
+    def _record(self, kind, path):
+        self._changes.add('{} {}\n'.format(kind, _escape(path)))
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            stats.count('journal.overflows')
+            self._changes.add(OVERFLOW + '\n')
+            return
+        if mask & IN_IGNORED:
+            self._paths.pop(wd, None)
+            return
+        path = self._paths.get(wd)
+        if path is None:
+            return
+        if not name:
+            # Changes of a directory itself are also reported to its
+            # parent, except for the root.
+            if path == os.sep and mask & (IN_DELETE_SELF | IN_MOVE_SELF |
+                                          IN_UNMOUNT):
+                self._changes.add(OVERFLOW + '\n')
+            return
+
+        child = os.path.join(path, name)
+        self._record(DIRECTORY, path)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(child)
+                self._record(SUBTREE, child)
+            elif mask & IN_ATTRIB and child in self._unwatched:
+                # possibly readable now
+                self._unwatched.discard(child)
+                self._watch_tree(child)
+                self._record(SUBTREE, child)
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (None: forever) for changes, then
+        handle all pending changes and append them to the journal."""
+        wait = timeout
+        while select.select([self._fd], [], [], wait)[0]:
+            data = os.read(self._fd, EVENT_BUFFER_SIZE)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = data[offset:offset + length].rstrip('\0')
+                offset += length
+                self._handle(wd, mask, name)
+            wait = 0
+        self.flush()
+
+    def flush(self):
+        """Append the changes seen so far to the journal."""
+        if not self._changes:
+            return
+        lines = ''.join(sorted(self._changes))
+        journal_path = os.path.join(self.journal_dir, JOURNAL_FILE)
+        while True:
+            with open(journal_path, 'ab') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                # A backup may have taken the journal since it was opened.
+                if _same_file(f, journal_path):
+                    f.write(lines)
+                    f.flush()
+                    break
+        self._changes.clear()
+
+    def run(self):
+        """Watch until interrupted."""
+        while True:
+            self.poll(FLUSH_INTERVAL)
+
+
+def running_watcher(journal_dir, rootdir):
+    """Return the id of the watcher that is running and ready for
+    rootdir in journal_dir, or None."""
+    try:
+        f = open(os.path.join(journal_dir, WATCHER_FILE), 'rb')
+    except IOError:
+        return None
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            lines = f.read().split('\n')
+            if (len(lines) >= 3 and lines[2] == READY and
+                    _unescape(lines[1]) == os.path.normpath(rootdir)):
+                return lines[0]
+            return None
+        # nobody holds the lock
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return None
+
+
+def _patterns_key(patterns):
+    return hashing.hash_str(repr([tuple(p) for p in patterns]))
+
+
+class Scan(object):
+    """The use of a journal directory by one backup.
+
+    Creating a Scan takes the journal and decides whether the walk can
+    be incremental. While the Scan is open, other backups using the
+    same journal directory wait.
+    """
+
+    def __init__(self, journal_dir, rootdir, patterns, tree, previous):
+        """Take the journal of rootdir.
+
+        Args:
+          journal_dir: Journal directory of a Watcher of rootdir.
+          rootdir: Native path of the tree to back up.
+          patterns: Patterns of the backup.
+          tree: cas_tree.CASTree of the CAS holding previous.
+          previous: catalog.Snapshot of the latest snapshot of rootdir,
+            or None.
+        """
+        self.journal_dir = journal_dir
+        self.rootdir = os.path.normpath(rootdir)
+        self._tree = tree
+        self._previous = previous
+        self._patterns_key = _patterns_key(patterns)
+        utils.mkdir_p(journal_dir)
+        self._lock = open(self._path(SCAN_LOCK_FILE), 'a')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+
+        self.watcher = running_watcher(journal_dir, self.rootdir)
+        self._take()
+        self.directories = set()
+        self.subtrees = set()
+        overflowed = self._read_pending()
+        self.reason = self._full_scan_reason(overflowed)
+        self.incremental = self.reason is None
+        stats.count('journal.incremental_scans' if self.incremental
+                    else 'journal.full_scans')
+
+        self.old_root = tree.root(previous.root_hash) if self.incremental else None
+        # directories on the way to changed directories
+        self._on_path = set()
+        for path in self.directories | self.subtrees:
+            while path not in self._on_path:
+                self._on_path.add(path)
+                path = os.path.dirname(path)
+        # path -> node of the previous snapshot, for unchanged directories
+        self.reused = {}
+
+    def _path(self, name):
+        return os.path.join(self.journal_dir, name)
+
+    def _take(self):
+        journal_path = self._path(JOURNAL_FILE)
+        taking_path = self._path(TAKING_FILE)
+        if os.path.exists(taking_path):
+            # taken by a backup that crashed before merging it
+            self._merge(taking_path)
+        try:
+            os.rename(journal_path, taking_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return
+        self._merge(taking_path)
+
+    def _merge(self, taking_path):
+        with open(taking_path, 'rb') as f:
+            # waits for a watcher that is still writing to it
+            fcntl.flock(f, fcntl.LOCK_EX)
+            data = f.read()
+        with open(self._path(PENDING_FILE), 'ab') as pending:
+            pending.write(data)
+            pending.flush()
+            os.fsync(pending.fileno())
+        os.remove(taking_path)
+
+    def _read_pending(self):
+        overflowed = False
+        try:
+            f = open(self._path(PENDING_FILE), 'rb')
+        except IOError:
+            return overflowed
+        with f:
+            for line in f:
+                line = line.rstrip('\n')
+                kind, _, path = line.partition(' ')
+                if kind == DIRECTORY:
+                    self.directories.add(_unescape(path))
+                elif kind == SUBTREE:
+                    self.subtrees.add(_unescape(path))
+                else:
+                    # OVERFLOW, or a line torn by a crash
+                    overflowed = True
+        return overflowed
+
+    def _full_scan_reason(self, overflowed):
+        if self.watcher is None:
+            return 'no watcher is running'
+        if self._previous is None:
+            return 'there is no previous snapshot'
+        try:
+            with open(self._path(STATE_FILE), 'rb') as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return 'no backup used the journal yet'
+        if state.get('watcher') != self.watcher:
+            return 'the watcher was restarted'
+        if state.get('root_hash') != self._previous.root_hash:
+            return 'the latest snapshot was not taken with the journal'
+        if state.get('patterns') != self._patterns_key:
+            return 'the patterns changed'
+        if overflowed:
+            return 'changes were lost'
+        return None
+
+    def walk(self, top, topdown=True, onerror=None, followlinks=False):
+        """Like os.walk, but only descend into directories that changed
+        or lead to changes; the other subdirectories (that are
+        directories in the previous snapshot, too) are added to
+        self.reused."""
+        assert topdown and not followlinks
+        stack = [(os.sep, self.old_root, os.sep in self.subtrees)]
+        while stack:
+            path, old_node, full = stack.pop()
+            native_path = utils.build_native_path(top, path)
+            try:
+                names = os.listdir(native_path)
+            except OSError as e:
+                if onerror is not None:
+                    onerror(e)
+                continue
+            dirs = []
+            nondirs = []
+            for name in names:
+                if os.path.isdir(os.path.join(native_path, name)):
+                    dirs.append(name)
+                else:
+                    nondirs.append(name)
+            yield native_path, dirs, nondirs
+
+            old_children = {}
+            if old_node is not None and not full:
+                old_children = cas_tree.transient_children(old_node)
+            for name in reversed(dirs):
+                if os.path.islink(os.path.join(native_path, name)):
+                    continue
+                child = os.path.join(path, name)
+                child_full = full or child in self.subtrees
+                old_child = old_children.get(name)
+                if not isinstance(old_child, metadata.DirectoryNode):
+                    old_child = None
+                if child_full or child in self._on_path or old_child is None:
+                    stack.append((child, old_child, child_full))
+                else:
+                    self.reused[child] = old_child
+        stats.count('journal.reused_directories', len(self.reused))
+
+    def graft(self, root_node, uid_map, gid_map):
+        """Put the directories reused by walk into the metadata tree
+        built from its results, with their current metadata and the
+        hashes of their blobs in the previous snapshot."""
+        for path, old_node in self.reused.iteritems():
+            dir_node = root_node
+            cur_path = os.sep
+            for part in utils.get_path_parts(os.path.dirname(path)):
+                cur_path = os.path.join(cur_path, part)
+                if part not in dir_node.children:
+                    dir_node.children[part] = metadata.get_directory_node(
+                        self.rootdir, cur_path, uid_map, gid_map)
+                dir_node = dir_node.children[part]
+            name = os.path.basename(path)
+            node = dir_node.children.get(name)
+            if node is None:
+                # excluded by the patterns itself, but not its contents
+                node = metadata.get_directory_node(self.rootdir, path,
+                                                   uid_map, gid_map)
+            elif not isinstance(node, metadata.DirectoryNode):
+                # replaced since the walk; it was listed with its parent
+                continue
+            dir_node.children[name] = cas_tree.LazyDirectoryNode(
+                self._tree, old_node.hash, node.name, node.mtime, node.user,
+                node.group, node.permissions)
+
+    def totals(self, root_node):
+        """Return the number of files and their total size in the tree
+        at root_node, from those of the previous snapshot and the
+        parts that differ from it."""
+        files = self._previous.files
+        num_bytes = self._previous.bytes
+        stack = [(root_node, self.old_root)]
+        while stack:
+            new_dir, old_dir = stack.pop()
+            new_children = {}
+            if new_dir is not None:
+                new_children = cas_tree.transient_children(new_dir)
+            old_children = {}
+            if old_dir is not None:
+                old_children = cas_tree.transient_children(old_dir)
+            for name in set(new_children) | set(old_children):
+                new = new_children.get(name)
+                old = old_children.get(name)
+                if (isinstance(new, cas_tree.LazyDirectoryNode) and
+                        isinstance(old, cas_tree.LazyDirectoryNode) and
+                        new.hash == old.hash):
+                    continue
+                if isinstance(new, metadata.FileNode):
+                    files += 1
+                    num_bytes += new.size
+                if isinstance(old, metadata.FileNode):
+                    files -= 1
+                    num_bytes -= old.size
+                if not isinstance(new, metadata.DirectoryNode):
+                    new = None
+                if not isinstance(old, metadata.DirectoryNode):
+                    old = None
+                if new is not None or old is not None:
+                    stack.append((new, old))
+        return files, num_bytes
+
+    def finish(self, root_hash):
+        """Record that the snapshot root_hash was taken with this scan;
+        the changes taken are then no longer needed."""
+        state = {'watcher': self.watcher, 'root_hash': root_hash,
+                 'patterns': self._patterns_key}
+        temp_path = self._path(STATE_FILE) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            json.dump(state, f, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, self._path(STATE_FILE))
+        try:
+            os.remove(self._path(PENDING_FILE))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def close(self):
+        if self._lock is not None:
+            self._lock.close()
+            self._lock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _terminate(signum, frame):
+    sys.exit(0)
+
+
+def main(argv):
+    if len(argv) != 3:
+        print "usage: %s rootdir journal_dir" % argv[0]
+        return 1
+
+    watcher = Watcher(argv[1], os.path.abspath(argv[2]))
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        watcher.start()
+    except ValueError as e:
+        print >>sys.stderr, 'watch: {}'.format(e)
+        return 1
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""Tests for change journals and incremental backups."""
+
+import backup
+import cas
+import cas_tree
+import catalog
+import journal
+import os
+import pytest
+import stats
+from restore_test import make_source
+
+@pytest.fixture
+def watched(tmpdir):
+    """A source tree watched by a started Watcher; yields (source,
+    watcher)."""
+    source = make_source(tmpdir)
+    source.mkdir('static').join('s.txt').write('never changes')
+    watcher = journal.Watcher(str(source), str(tmpdir.join('journal')))
+    watcher.start()
+    yield source, watcher
+    watcher.close()
+
+def incremental_backup(test_cas, source, watcher):
+    """Back up source using the journal of watcher; return the snapshot
+    and the number of directories whose blobs were reused, or None for
+    a full walk."""
+    watcher.poll(0)
+    stats.enable()
+    try:
+        snapshot = backup.backup(test_cas, str(source), [],
+                                 journal_dir=watcher.journal_dir)
+        counters = stats.report()['counters']
+    finally:
+        stats.disable()
+    if not counters.get('journal.incremental_scans'):
+        return snapshot, None
+    return snapshot, counters.get('journal.reused_directories', 0)
+
+def assert_same_as_full_backup(tmpdir, source, snapshot):
+    full = backup.backup(cas.CAS(str(tmpdir.join('full-cas'))), str(source), [])
+    assert snapshot.root_hash == full.root_hash
+    assert (snapshot.files, snapshot.bytes) == (full.files, full.bytes)
+
+def test_incremental_backup(tmpdir, watched):
+    source, watcher = watched
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    first, reused = incremental_backup(test_cas, source, watcher)
+    assert reused is None
+
+    source.join('sub', 'deeper', 'b.sh').write('#!/bin/sh\nexit 1\n')
+    source.join('top.txt').remove()
+    source.mkdir('new').mkdir('dir').join('n.txt').write('new file')
+    second, reused = incremental_backup(test_cas, source, watcher)
+    # only /static is not on the way to a change
+    assert reused == 1
+    assert second.parent == first.root_hash
+    assert_same_as_full_backup(tmpdir, source, second)
+
+    # nothing changed
+    third, reused = incremental_backup(test_cas, source, watcher)
+    assert reused == 3
+    assert third.root_hash == second.root_hash
+
+def test_incremental_backup_after_moves(tmpdir, watched):
+    source, watcher = watched
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    incremental_backup(test_cas, source, watcher)
+
+    source.join('sub', 'deeper').rename(source.join('static', 'moved'))
+    source.join('sub').rename(source.join('sub2'))
+    snapshot, reused = incremental_backup(test_cas, source, watcher)
+    assert reused is not None
+    assert_same_as_full_backup(tmpdir, source, snapshot)
+
+    # changes inside moved directories are recorded at their new paths
+    source.join('static', 'moved', 'b.sh').write('changed')
+    source.join('sub2', 'a.txt').write('changed, too')
+    snapshot, reused = incremental_backup(test_cas, source, watcher)
+    assert reused is not None
+    assert_same_as_full_backup(tmpdir, source, snapshot)
+
+def test_full_walk_without_journal_coverage(tmpdir, watched):
+    source, watcher = watched
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    journal_dir = watcher.journal_dir
+    incremental_backup(test_cas, source, watcher)
+
+    def reason():
+        previous = catalog.Catalog(test_cas.root).latest(str(source))
+        with journal.Scan(journal_dir, str(source), [],
+                          cas_tree.CASTree(test_cas), previous) as scan:
+            return scan.reason
+    assert reason() is None
+
+    with open(os.path.join(journal_dir, journal.JOURNAL_FILE), 'ab') as f:
+        f.write(journal.OVERFLOW + '\n')
+    assert reason() == 'changes were lost'
+    # unfinished scans keep the changes they took
+    assert reason() == 'changes were lost'
+    source.join('top.txt').write('changed')
+    snapshot, reused = incremental_backup(test_cas, source, watcher)
+    assert reused is None
+    assert_same_as_full_backup(tmpdir, source, snapshot)
+    assert reason() is None
+
+    watcher.close()
+    assert reason() == 'no watcher is running'
+    restarted = journal.Watcher(str(source), journal_dir)
+    restarted.start()
+    try:
+        assert reason() == 'the watcher was restarted'
+        with pytest.raises(ValueError):
+            journal.Watcher(str(source), journal_dir).start()
+    finally:
+        restarted.close()
@@ -3,6 +3,7 @@
 import json
 import os
 import subprocess
+import stats
 import tempfile
 import utils
 from collections import namedtuple
@@ -23,6 +24,7 @@ def get_default_metadata(rootdir, path, uid_map=None, gid_map=None):
         gid_map = utils.get_gid_name_map()
     native_path = utils.build_native_path(rootdir, path)
     stat = os.lstat(native_path)
+    stats.count('syscalls.lstat')
 
     metadata = {}
     metadata['name'] = os.path.basename(path)
@@ -41,6 +43,7 @@ def get_file_node(rootdir, path, hash_cache, uid_map=None, gid_map=None):
 
     native_path = utils.build_native_path(rootdir, path)
     stat = os.lstat(native_path)
+    stats.count('syscalls.lstat')
 
     metadata['hash'] = hash_cache[path]
     metadata['size'] = stat.st_size
@@ -61,6 +64,7 @@ def get_symlink_node(rootdir, path, uid_map=None, gid_map=None):
     return SymlinkNode(**metadata)
 
 
+@stats.timed('metadata_tree')
 def get_metadata_tree(rootdir, files, symlinks, directories, digest_map, uid_map, gid_map):
     # Step 0: empty tree
     root_node = get_directory_node(rootdir, os.sep, uid_map, gid_map)
@@ -111,6 +115,20 @@ def get_metadata_tree(rootdir, files, symlinks, directories, digest_map, uid_map
     return root_node
 
 
+def flatten_tree(root_node):
+    """Return a dictionary mapping the paths of all nodes in a metadata
+    tree to the nodes."""
+    result = {}
+    stack = [(os.sep, root_node)]
+    while stack:
+        path, node = stack.pop()
+        result[path] = node
+        if isinstance(node, DirectoryNode):
+            for name, child in node.children.iteritems():
+                stack.append((os.path.join(path, name), child))
+    return result
+
+
 if __name__ == "__main__":
     import collections
     import pattern
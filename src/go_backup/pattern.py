@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 import itertools
 import os
+import progress
 import re
+import stat
+import stats
 import utils
 from collections import namedtuple
 
-"""The data structure containing matching results for given patterns."""
-MatchingResult = namedtuple('MatchingResult', ['filenames', 'symlinks', 'directories', 'errors', 'ignored'])
+"""The data structure containing matching results for given patterns
+(the result of assemble_paths). hardlinks maps each file in filenames
+that is a hard link to a file listed earlier (the same st_dev and
+st_ino) to the path of that earlier file, so that the contents of each
+inode need to be read only once (see unique_filenames and
+add_hardlink_digests)."""
+MatchingResult = namedtuple('MatchingResult', ['filenames', 'symlinks', 'directories', 'errors', 'ignored', 'hardlinks'])
 
 """Constants indicating whether a pattern should be included or excluded."""
 INCLUDE = 1
@@ -99,12 +107,21 @@ def pattern_decision(path, patterns):
     return res
 
 
-def assemble_paths(rootdir, patterns):
+@stats.timed('assemble_paths')
+def assemble_paths(rootdir, patterns, walk=os.walk):
+    """Walk rootdir and collect the paths included by patterns.
+
+    walk is os.walk, or a function with its interface that visits only
+    part of the tree (e.g. journal.Scan.walk).
+    """
     filenames = []
     symlinks = []
     directories = []
     errors = []
     ignored = []
+    hardlinks = {}
+    # (st_dev, st_ino) -> first path, only for files with several links
+    inodes = {}
 
     def listdir_onerror(error):
         errors.append(error)
@@ -125,20 +142,39 @@ def assemble_paths(rootdir, patterns):
         raise ValueError('Unknown file decision {}.'.format(decision))
 
     # Now recursively traverse the file system
-    for root, dirs, files in os.walk(rootdir, topdown=True,
-                                     onerror=listdir_onerror, followlinks=False):
+    progress.begin('scan')
+    for root, dirs, files in walk(rootdir, topdown=True,
+                                  onerror=listdir_onerror, followlinks=False):
+        stats.count('syscalls.listdir')
         for f in itertools.chain(files, dirs):
             native_path = os.path.join(root, f)
             path = utils.get_path_from_native_path(rootdir, native_path)
             decision = pattern_decision(path, patterns)
             if decision == INCLUDE:
                 # If we want to include the directory entry, we have to find out
-                # its type.
-                if os.path.islink(native_path):
+                # its type. A single lstat suffices, as symlinks are never
+                # followed.
+                try:
+                    st = os.lstat(native_path)
+                except OSError as e:
+                    errors.append(e)
+                    continue
+                stats.count('syscalls.lstat')
+                mode = st.st_mode
+                if stat.S_ISLNK(mode):
                     symlinks.append(path)
-                elif os.path.isfile(native_path):
+                elif stat.S_ISREG(mode):
                     filenames.append(path)
-                elif os.path.isdir(native_path):
+                    first = path
+                    if st.st_nlink > 1:
+                        first = inodes.setdefault((st.st_dev, st.st_ino), path)
+                    if first != path:
+                        # contents are read (and counted) only once
+                        hardlinks[path] = first
+                        progress.discover(files=1)
+                    else:
+                        progress.discover(files=1, bytes=st.st_size)
+                elif stat.S_ISDIR(mode):
                     directories.append(path)
                 else:
                     ignored.append(path)
@@ -148,15 +184,34 @@ def assemble_paths(rootdir, patterns):
         # recurse into a different file system.
         dirs[:] = [d for d in dirs if not os.path.ismount(os.path.join(rootdir, d))]
 
-    return MatchingResult(filenames, symlinks, directories, errors, ignored)
+    stats.count('assemble_paths.files', len(filenames))
+    stats.count('assemble_paths.directories', len(directories))
+    stats.count('assemble_paths.hardlinks', len(hardlinks))
+    return MatchingResult(filenames, symlinks, directories, errors, ignored,
+                          hardlinks)
+
+
+def unique_filenames(paths):
+    """Return the files of a MatchingResult with one path per inode, i.e.
+    without the files that are hard links to an earlier file."""
+    return [p for p in paths.filenames if p not in paths.hardlinks]
+
+
+def add_hardlink_digests(paths, digest_map):
+    """Given a dictionary mapping the unique_filenames of a MatchingResult
+    to their digests, add the digests of the hard links to them."""
+    for path, first in paths.hardlinks.iteritems():
+        digest_map[path] = digest_map[first]
 
 
 if __name__ == "__main__":
+    import profiling
     import StringIO
     import sys
-    rootdir = sys.argv[1]
-    if len(sys.argv) >= 3:
-        patterns_file = open(sys.argv[2])
+    argv = profiling.handle_options(stats.handle_options(sys.argv))
+    rootdir = argv[1]
+    if len(argv) >= 3:
+        patterns_file = open(argv[2])
     else:
         patterns_file = StringIO.StringIO("# some test includes\n+ /\n")
     patterns = parse_pattern_file(patterns_file)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+"""Profiling of go-backup runs.
+
+The go-backup command line (see cli) and the standalone command line
+tools call handle_options(), which recognizes --profile DIR. The rest of
+the run then executes under cProfile; when the program exits, DIR
+receives the raw profile data (main.prof, for use with pstats or other
+profile viewers) and a report of the hotspots sorted by cumulative and
+by internal time (main.txt).
+
+Worker pools are profiled too, if they are created with
+init_worker as initializer (see hashing.hash_list_of_files). Each
+worker process writes worker-PID.prof when it exits; worker threads
+are collected when the main program exits. The worker profiles are
+summarized in workers.txt.
+
+--profile-memory additionally samples the resident set size of the
+process every MEMORY_SAMPLE_INTERVAL seconds. Whenever it reaches a
+new peak (by more than MEMORY_SNAPSHOT_GROWTH), the live objects are
+counted by type; memory.txt lists the samples and the object counts
+at the highest peak. Python 2 has no tracemalloc, so the counts cover
+the objects tracked by the garbage collector (containers and class
+instances, but not e.g. strings), which usually suffices to tell
+which data structure is growing.
+"""
+
+import atexit
+import collections
+import cProfile
+import gc
+import glob
+import multiprocessing.util
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+MEMORY_SAMPLE_INTERVAL = 1.0
+MEMORY_SNAPSHOT_GROWTH = 0.1
+REPORT_LINES = 40
+
+
+class _Profiling(object):
+
+    def __init__(self, directory, memory):
+        self.directory = directory
+        self.pid = os.getpid()
+        self.profiler = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.thread_profilers = []
+        self.memory_sampler = _MemorySampler() if memory else None
+
+
+_profiling = None
+
+
+class _MemorySampler(threading.Thread):
+
+    def __init__(self):
+        super(_MemorySampler, self).__init__(name='memory sampler')
+        self.daemon = True
+        self.start_time = time.time()
+        self.samples = []
+        self.peak_rss = 0
+        self.peak_types = None
+        self.peak_time = None
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self.sample()
+            self._stopped.wait(MEMORY_SAMPLE_INTERVAL)
+
+    def sample(self):
+        rss = current_rss_bytes()
+        now = time.time() - self.start_time
+        self.samples.append((now, rss))
+        if rss > self.peak_rss * (1 + MEMORY_SNAPSHOT_GROWTH):
+            self.peak_rss = rss
+            self.peak_time = now
+            self.peak_types = collections.Counter(
+                type(obj).__name__ for obj in gc.get_objects())
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+    def report(self):
+        lines = ['Resident set size (seconds since start, MiB):']
+        for t, rss in self.samples:
+            lines.append('  {:10.1f} {:12.1f}'.format(t, rss / 1048576.0))
+        if self.peak_types is not None:
+            lines.append('')
+            lines.append('Objects tracked by the garbage collector at the '
+                         'peak of {:.1f} MiB ({:.1f}s):'.format(
+                             self.peak_rss / 1048576.0, self.peak_time))
+            for name, count in self.peak_types.most_common(REPORT_LINES):
+                lines.append('  {:<40} {:>12}'.format(name, count))
+        return '\n'.join(lines) + '\n'
+
+
+def current_rss_bytes():
+    """Return the current resident set size of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        # Without procfs, fall back to the peak resident set size.
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def _write_report(stats, path):
+    with open(path, 'w') as f:
+        stats.stream = f
+        stats.strip_dirs()
+        f.write('Sorted by cumulative time:\n')
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        f.write('Sorted by internal time:\n')
+        stats.sort_stats('time').print_stats(REPORT_LINES)
+
+
+def enable(directory, memory=False):
+    """Profile the rest of the run, writing the results to directory."""
+    global _profiling
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # Worker profiles of earlier runs would end up in workers.txt.
+    for pattern in ['worker-*.prof', 'thread-*.prof']:
+        for path in glob.glob(os.path.join(directory, pattern)):
+            os.remove(path)
+    _profiling = _Profiling(directory, memory)
+    if _profiling.memory_sampler is not None:
+        _profiling.memory_sampler.start()
+    _profiling.profiler.enable()
+
+
+def is_enabled():
+    return _profiling is not None
+
+
+def finish():
+    """Stop profiling and write the reports."""
+    global _profiling
+    profiling, _profiling = _profiling, None
+    if profiling is None or os.getpid() != profiling.pid:
+        return
+    profiling.profiler.disable()
+    main_path = os.path.join(profiling.directory, 'main.prof')
+    profiling.profiler.dump_stats(main_path)
+    _write_report(pstats.Stats(main_path), main_path[:-len('.prof')] + '.txt')
+
+    with profiling.lock:
+        for i, profiler in enumerate(profiling.thread_profilers):
+            profiler.dump_stats(os.path.join(profiling.directory,
+                                             'thread-{}.prof'.format(i)))
+    worker_paths = (glob.glob(os.path.join(profiling.directory, 'worker-*.prof')) +
+                    glob.glob(os.path.join(profiling.directory, 'thread-*.prof')))
+    if worker_paths:
+        _write_report(pstats.Stats(*worker_paths),
+                      os.path.join(profiling.directory, 'workers.txt'))
+
+    if profiling.memory_sampler is not None:
+        profiling.memory_sampler.stop()
+        with open(os.path.join(profiling.directory, 'memory.txt'), 'w') as f:
+            f.write(profiling.memory_sampler.report())
+
+
+def init_worker():
+    """Initializer for multiprocessing pools that profiles the workers
+    while profiling is enabled."""
+    profiling = _profiling
+    if profiling is None:
+        return
+    if os.getpid() == profiling.pid:
+        # A thread pool; its profiles are written by finish().
+        profiler = cProfile.Profile()
+        profiler.enable()
+        with profiling.lock:
+            profiling.thread_profilers.append(profiler)
+        return
+
+    # A worker process; it inherited the profiler of the process that
+    # created it, which must not record the worker's work.
+    profiling.profiler.disable()
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    def dump():
+        profiler.disable()
+        profiler.dump_stats(os.path.join(
+            profiling.directory, 'worker-{}.prof'.format(os.getpid())))
+    multiprocessing.util.Finalize(None, dump, exitpriority=10)
+
+
+def handle_options(argv):
+    """Handle the --profile DIR and --profile-memory command line options.
+
+    Returns:
+      argv with these options removed.
+    """
+    remaining = []
+    directory = None
+    memory = False
+    args = iter(argv)
+    for arg in args:
+        if arg == '--profile':
+            directory = next(args)
+        elif arg.startswith('--profile='):
+            directory = arg[len('--profile='):]
+        elif arg == '--profile-memory':
+            memory = True
+        else:
+            remaining.append(arg)
+
+    if directory is not None:
+        enable(directory, memory)
+        atexit.register(finish)
+
+    return remaining
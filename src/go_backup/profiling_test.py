@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Tests for go-backup's profiling mode."""
+
+import cas
+import hashing
+import profiling
+import pstats
+
+def test_disabled_by_default():
+    assert not profiling.is_enabled()
+    profiling.init_worker()
+    profiling.finish()
+
+def test_profile_with_workers(tmpdir):
+    files = []
+    for i in xrange(4):
+        f = tmpdir.join('f{}'.format(i))
+        f.write('x' * i)
+        files.append(str(f))
+    directory = tmpdir.join('profile')
+    directory.ensure(dir=True).join('worker-1.prof').write('stale')
+
+    profiling.enable(str(directory), memory=True)
+    try:
+        digests = hashing.hash_list_of_files(files, 2)
+        cas.store_list_of_files(cas.CAS(str(tmpdir.join('cas'))),
+                                digests.items(), 2)
+    finally:
+        profiling.finish()
+    assert not profiling.is_enabled()
+
+    names = set(p.basename for p in directory.listdir())
+    assert set(['main.prof', 'main.txt', 'workers.txt', 'memory.txt']) <= names
+    assert 'worker-1.prof' not in names
+    assert any(name.startswith('worker-') for name in names)
+    assert any(name.startswith('thread-') for name in names)
+
+    main_functions = set(f[2] for f in pstats.Stats(str(directory.join('main.prof'))).stats)
+    assert 'hash_list_of_files' in main_functions
+    assert 'hash_fileobj' not in main_functions
+    assert 'hash_fileobj' in directory.join('workers.txt').read()
+    assert 'Sorted by internal time' in directory.join('main.txt').read()
+    assert 'Resident set size' in directory.join('memory.txt').read()
+
+def test_handle_options(tmpdir):
+    argv = profiling.handle_options(['prog', '--profile', str(tmpdir), 'arg'])
+    try:
+        assert argv == ['prog', 'arg']
+        assert profiling.is_enabled()
+    finally:
+        profiling.finish()
+    assert tmpdir.join('main.prof').check()
+    assert profiling.handle_options(['prog', 'arg']) == ['prog', 'arg']
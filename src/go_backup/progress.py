@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""Live progress reporting of long-running go-backup runs.
+
+A run consists of phases (e.g. 'scan', 'hashing', 'cas_ingest'). Code
+that starts a phase calls begin(name, files, bytes) with the amount
+of work the phase will do, if known, and then reports completed work
+with advance(files, bytes). The file system walk does not know how
+much work lies ahead; it reports what it finds with discover(files,
+bytes) instead.
+
+From these events the module derives the throughput over the last
+RATE_WINDOW seconds and an estimate of the remaining time (ETA), based
+on bytes if the phase's total size is known and on files otherwise.
+They are shown as a status line on stderr, which is rewritten in place
+every TTY_INTERVAL seconds if stderr is a terminal and printed as a new
+line every LOG_INTERVAL seconds otherwise. In addition, the progress
+can be written as JSON to a file every FILE_INTERVAL seconds, for
+consumption by monitoring tools; the file is replaced atomically.
+
+Like the stats module, progress reporting is disabled by default, in
+which case all reporting functions return immediately.
+handle_options() enables it for command line tools that accept
+--progress and --progress-file FILE.
+"""
+
+import atexit
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+TTY_INTERVAL = 0.5
+LOG_INTERVAL = 30.0
+FILE_INTERVAL = 5.0
+RATE_WINDOW = 20.0
+
+
+class _Phase(object):
+
+    def __init__(self, name, files, bytes, now):
+        self.name = name
+        self.files_total = files
+        self.bytes_total = bytes
+        self.files_done = 0
+        self.bytes_done = 0
+        self.start_time = now
+        # (time, files_done, bytes_done) samples for computing the
+        # current throughput
+        self.samples = collections.deque([(now, 0, 0)])
+
+
+class Progress(object):
+
+    def __init__(self, stream=None, path=None, clock=time.time):
+        """Create a progress reporter.
+
+        Args:
+          stream: File object for the status line, or None.
+          path: Path of the progress file, or None.
+          clock: Function returning the current time in seconds.
+        """
+        self._stream = stream
+        self._tty = stream is not None and stream.isatty()
+        self._path = path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start_time = clock()
+        self._files_discovered = 0
+        self._bytes_discovered = 0
+        self._phase = None
+        self._last_line = None
+        self._last_file = None
+        self._line_width = 0
+
+    def begin(self, name, files=None, bytes=None):
+        """Start a new phase, ending the current one."""
+        with self._lock:
+            self._end_phase()
+            self._phase = _Phase(name, files, bytes, self._clock())
+            self._update(force=True)
+
+    def discover(self, files=0, bytes=0):
+        with self._lock:
+            self._files_discovered += files
+            self._bytes_discovered += bytes
+            if self._phase is not None:
+                self._phase.files_done += files
+                self._phase.bytes_done += bytes
+            self._update()
+
+    def advance(self, files=0, bytes=0):
+        with self._lock:
+            if self._phase is not None:
+                self._phase.files_done += files
+                self._phase.bytes_done += bytes
+            self._update()
+
+    def finish(self):
+        """End the current phase and write the final progress."""
+        with self._lock:
+            if self._phase is None:
+                self._write_file(self.status(finished=True))
+            self._end_phase(finished=True)
+
+    def _end_phase(self, finished=False):
+        if self._phase is None:
+            return
+        self._update(force=True, finished=finished)
+        if self._tty:
+            self._stream.write('\n')
+            self._stream.flush()
+        self._phase = None
+        self._line_width = 0
+
+    def status(self, finished=False):
+        """Return the current progress as a JSON-serializable dictionary."""
+        now = self._clock()
+        data = {
+            'elapsed_seconds': now - self._start_time,
+            'files_discovered': self._files_discovered,
+            'bytes_discovered': self._bytes_discovered,
+            'finished': finished,
+            'phase': None,
+        }
+        phase = self._phase
+        if phase is not None:
+            data.update({
+                'phase': phase.name,
+                'files_done': phase.files_done,
+                'bytes_done': phase.bytes_done,
+                'files_total': phase.files_total,
+                'bytes_total': phase.bytes_total,
+                'files_per_second': None,
+                'bytes_per_second': None,
+                'eta_seconds': None,
+            })
+            then, files_then, bytes_then = phase.samples[0]
+            if now > then:
+                data['files_per_second'] = (phase.files_done - files_then) / (now - then)
+                data['bytes_per_second'] = (phase.bytes_done - bytes_then) / (now - then)
+            data['eta_seconds'] = _eta(phase.bytes_done, phase.bytes_total,
+                                       data['bytes_per_second'])
+            if data['eta_seconds'] is None:
+                data['eta_seconds'] = _eta(phase.files_done, phase.files_total,
+                                           data['files_per_second'])
+        return data
+
+    def _update(self, force=False, finished=False):
+        now = self._clock()
+        phase = self._phase
+        line_interval = TTY_INTERVAL if self._tty else LOG_INTERVAL
+        line_due = (self._stream is not None and
+                    (self._last_line is None or now - self._last_line >= line_interval))
+        file_due = (self._path is not None and
+                    (self._last_file is None or now - self._last_file >= FILE_INTERVAL))
+        if not (force or line_due or file_due):
+            return
+
+        if phase is not None:
+            phase.samples.append((now, phase.files_done, phase.bytes_done))
+            while len(phase.samples) > 2 and now - phase.samples[1][0] >= RATE_WINDOW:
+                phase.samples.popleft()
+        data = self.status(finished)
+        if self._stream is not None and phase is not None and (force or line_due):
+            self._write_line(format_status(data))
+            self._last_line = now
+        if force or file_due:
+            self._write_file(data)
+
+    def _write_line(self, line):
+        if self._tty:
+            padding = max(0, self._line_width - len(line))
+            self._stream.write('\r' + line + ' ' * padding)
+            self._line_width = len(line)
+        else:
+            self._stream.write(line + '\n')
+        self._stream.flush()
+
+    def _write_file(self, data):
+        if self._path is None:
+            return
+        temp_path = self._path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self._path)
+        self._last_file = self._clock()
+
+
+def _eta(done, total, rate):
+    if total is None or not rate or rate <= 0:
+        return None
+    return max(0, total - done) / rate
+
+
+def format_size(num_bytes):
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(num_bytes) < 1024 or unit == 'TiB':
+            break
+        num_bytes /= 1024.0
+    if unit == 'B':
+        return '{} B'.format(int(num_bytes))
+    return '{:.1f} {}'.format(num_bytes, unit)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{}:{:02}:{:02}'.format(seconds // 3600, seconds // 60 % 60,
+                                   seconds % 60)
+
+
+def format_status(data):
+    """Format the result of Progress.status() as a one-line summary."""
+    if data['files_total'] is None:
+        parts = ['{} files'.format(data['files_done']),
+                 format_size(data['bytes_done'])]
+    else:
+        parts = ['{}/{} files'.format(data['files_done'], data['files_total'])]
+        if data['bytes_total'] is not None:
+            parts.append('{}/{}'.format(format_size(data['bytes_done']),
+                                        format_size(data['bytes_total'])))
+        else:
+            parts.append(format_size(data['bytes_done']))
+    if data['bytes_per_second'] is not None:
+        parts.append('{}/s'.format(format_size(data['bytes_per_second'])))
+        parts.append('{:.0f} files/s'.format(data['files_per_second']))
+    if data['eta_seconds'] is not None:
+        parts.append('ETA ' + format_duration(data['eta_seconds']))
+    return '{}: {}'.format(data['phase'], ', '.join(parts))
+
+
+_progress = None
+
+
+def enable(stream=None, path=None):
+    """Start reporting progress to stream and/or the file at path."""
+    global _progress
+    _progress = Progress(stream, path)
+
+
+def disable():
+    global _progress
+    _progress = None
+
+
+def is_enabled():
+    return _progress is not None
+
+
+def begin(name, files=None, bytes=None):
+    """Start a phase that will process the given number of files and
+    bytes (None if unknown)."""
+    if _progress is not None:
+        _progress.begin(name, files, bytes)
+
+
+def discover(files=0, bytes=0):
+    """Report files and bytes found by a file system walk."""
+    if _progress is not None:
+        _progress.discover(files, bytes)
+
+
+def advance(files=0, bytes=0):
+    """Report files and bytes processed by the current phase."""
+    if _progress is not None:
+        _progress.advance(files, bytes)
+
+
+def finish():
+    if _progress is not None:
+        _progress.finish()
+
+
+def handle_options(argv):
+    """Handle the --progress and --progress-file FILE command line
+    options.
+
+    --progress shows a status line on stderr; --progress-file writes the
+    progress as JSON to FILE. The final progress is written when the
+    program exits.
+
+    Returns:
+      argv with these options removed.
+    """
+    remaining = []
+    stream = None
+    path = None
+    args = iter(argv)
+    for arg in args:
+        if arg == '--progress':
+            stream = sys.stderr
+        elif arg == '--progress-file':
+            path = next(args)
+        elif arg.startswith('--progress-file='):
+            path = arg[len('--progress-file='):]
+        else:
+            remaining.append(arg)
+
+    if stream is not None or path is not None:
+        enable(stream, path)
+        atexit.register(finish)
+
+    return remaining
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""Tests for go-backup's progress reporting."""
+
+import cas
+import hashing
+import json
+import progress
+import StringIO
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+    def __call__(self):
+        return self.now
+
+class FakeTTY(StringIO.StringIO):
+    def isatty(self):
+        return True
+
+def test_disabled_by_default():
+    assert not progress.is_enabled()
+    progress.begin('nothing', files=1)
+    progress.advance(files=1)
+    progress.finish()
+
+def test_throughput_and_eta():
+    clock = FakeClock()
+    p = progress.Progress(clock=clock)
+    p.begin('hashing', files=100, bytes=1000)
+    clock.now += 10
+    p.advance(files=20, bytes=250)
+    data = p.status()
+    assert data['phase'] == 'hashing'
+    assert (data['files_done'], data['bytes_done']) == (20, 250)
+    assert data['bytes_per_second'] == 25
+    assert data['files_per_second'] == 2
+    # the ETA is based on bytes if the total size is known
+    assert data['eta_seconds'] == 30
+
+    p.begin('cas_ingest', files=100)
+    clock.now += 10
+    p.advance(files=20, bytes=250)
+    assert p.status()['eta_seconds'] == 40
+
+def test_discover():
+    clock = FakeClock()
+    p = progress.Progress(clock=clock)
+    p.begin('scan')
+    p.discover(files=3, bytes=3000)
+    clock.now += 1
+    data = p.status()
+    assert (data['files_done'], data['bytes_done']) == (3, 3000)
+    assert (data['files_discovered'], data['bytes_discovered']) == (3, 3000)
+    assert data['eta_seconds'] is None
+    assert progress.format_status(data) == 'scan: 3 files, 2.9 KiB, 2.9 KiB/s, 3 files/s'
+
+def test_status_line_is_throttled():
+    clock = FakeClock()
+    stream = StringIO.StringIO()
+    p = progress.Progress(stream, clock=clock)
+    p.begin('hashing', files=10)
+    for _ in xrange(5):
+        p.advance(files=1)
+    clock.now += progress.LOG_INTERVAL
+    p.advance(files=1)
+    p.finish()
+    lines = stream.getvalue().splitlines()
+    # phase start, one update per interval, phase end
+    assert len(lines) == 3
+    assert lines[-1].startswith('hashing: 6/10 files, 0 B')
+
+def test_tty_status_line_is_rewritten():
+    clock = FakeClock()
+    stream = FakeTTY()
+    p = progress.Progress(stream, clock=clock)
+    p.begin('hashing', files=1000, bytes=10 * 1024 * 1024)
+    clock.now += 1
+    p.advance(files=10, bytes=1024 * 1024)
+    p.finish()
+    output = stream.getvalue()
+    assert output.count('\r') == 3
+    assert output.endswith('ETA 0:00:09\n')
+    assert '1.0 MiB/10.0 MiB' in output
+
+def test_progress_file(tmpdir):
+    path = str(tmpdir.join('progress.json'))
+    clock = FakeClock()
+    p = progress.Progress(path=path, clock=clock)
+    p.begin('hashing', files=2, bytes=20)
+    clock.now += 1
+    p.advance(files=1, bytes=10)
+    clock.now += progress.FILE_INTERVAL
+    p.advance(files=1, bytes=10)
+    with open(path) as f:
+        data = json.load(f)
+    assert data['files_done'] == 2
+    assert not data['finished']
+    p.finish()
+    with open(path) as f:
+        data = json.load(f)
+    assert data['finished']
+    assert data['phase'] == 'hashing'
+    assert not tmpdir.join('progress.json.tmp').check()
+
+def test_pipeline_reports_progress(tmpdir):
+    files = []
+    for i in xrange(5):
+        f = tmpdir.join('f{}'.format(i))
+        f.write('x' * (i * 100))
+        files.append(str(f))
+
+    stream = StringIO.StringIO()
+    progress.enable(stream)
+    try:
+        digests = hashing.hash_list_of_files(files, 2)
+        test_cas = cas.CAS(str(tmpdir.join('cas')))
+        cas.store_list_of_files(test_cas, digests.items(), 2)
+        progress.finish()
+    finally:
+        progress.disable()
+    output = stream.getvalue()
+    assert 'hashing: 5/5 files, 1000 B/1000 B' in output
+    assert 'cas_ingest: 5/5 files, 1000 B/1000 B' in output
+
+def test_handle_options(tmpdir):
+    argv = progress.handle_options(['prog', '--progress-file',
+                                    str(tmpdir.join('p')), 'arg'])
+    try:
+        assert argv == ['prog', 'arg']
+        assert progress.is_enabled()
+    finally:
+        progress.disable()
+    assert progress.handle_options(['prog', 'arg']) == ['prog', 'arg']
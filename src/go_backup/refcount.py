@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Reference counts of the blobs in a go-backup CAS.
+
+Finding the blobs that only a deleted snapshot used by mark and sweep
+means reading every directory blob of every other snapshot. The
+refcount index instead records how often each blob is referenced by
+live blobs, where the roots of the snapshots in the catalog are live
+and so is everything a live blob references. A blob has two counts:
+
+  - its directory count: the number of snapshots with the blob as
+    root plus the number of 'directory' entries of live directory
+    blobs with its hash;
+  - its file count: the number of 'file' entries of live directory
+    blobs with its hash plus the number of references from the chunk
+    lists (see CAS.chunk_list) of live file blobs.
+
+The references of a blob (its directory entries, or its chunks) are
+counted only when one of its counts rises from zero, and released only
+when it drops to zero. Recording a snapshot thus reads only the blobs
+that no earlier snapshot references, and deleting one reads only the
+blobs no other snapshot references: the walk stops at shared subtrees.
+A blob whose counts are both zero is garbage; it has no row in the
+index.
+
+The index is optional. It is an SQLite database in INDEX_DIRECTORY of
+the CAS root, created from the catalog by the garbage_collection
+module (go-backup gc --init) and from then on updated by
+catalog.Catalog.record and Catalog.delete, each snapshot in one
+transaction. Counts only ever err on the high side after a crash, as
+the index is updated before a snapshot is appended to the catalog and
+after it is removed from it; gc --check rebuilds the counts from
+scratch and compares them.
+
+Blobs that a running backup has stored, or found to be present, are
+not referenced until its snapshot is recorded, so they must not be
+freed in the meantime. Writers therefore hold writer_lock() while they
+store blobs, and blobs are only freed under exclusive_lock().
+"""
+
+import collections
+import contextlib
+import cStringIO
+import fcntl
+import os
+import sqlite3
+
+import async_cas
+import directory_blob
+import stats
+import utils
+
+INDEX_DIRECTORY = 'refcount'
+DATABASE_FILE = 'refcounts.sqlite'
+LOCK_FILE = 'lock'
+
+DIRECTORY = 'directory'
+FILE = 'file'
+
+
+def _index_path(cas_root, name):
+    return os.path.join(str(cas_root), INDEX_DIRECTORY, name)
+
+
+def exists(cas_root):
+    """Return whether the CAS at cas_root has a refcount index."""
+    return os.path.exists(_index_path(cas_root, DATABASE_FILE))
+
+
+@contextlib.contextmanager
+def _lock(cas_root, operation):
+    utils.mkdir_p(os.path.join(str(cas_root), INDEX_DIRECTORY))
+    with open(_index_path(cas_root, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, operation)
+        yield
+
+
+def writer_lock(cas_root):
+    """Return a context manager to hold while storing the blobs of a
+    snapshot that is not recorded yet."""
+    return _lock(cas_root, fcntl.LOCK_SH)
+
+
+def exclusive_lock(cas_root):
+    """Return a context manager to hold while freeing blobs; it waits
+    for all writers."""
+    return _lock(cas_root, fcntl.LOCK_EX)
+
+
+def _references(source_cas, hash_digest, kind, missing_ok):
+    """Return the (hash, kind) pairs of the blobs a blob references."""
+    try:
+        if kind == DIRECTORY:
+            with source_cas.retrieve(hash_digest) as blob:
+                data = blob.read()
+            return [(entry['hash'], DIRECTORY if entry['type'] == 'directory'
+                     else FILE)
+                    for entry in directory_blob.decode(cStringIO.StringIO(data))
+                    if entry['type'] in ('directory', 'file')]
+        chunks = source_cas.chunk_list(hash_digest)
+        return [(chunk_digest, FILE) for chunk_digest, _ in chunks or []]
+    except (LookupError, IOError):
+        if not missing_ok:
+            raise LookupError('Blob {} is not in the CAS.'.format(hash_digest))
+        # Its references cannot be released; gc --check finds them.
+        stats.count('refcount.missing_blobs')
+        return []
+
+
+def _propagate(source_cas, counts, root_hashes, delta, max_in_flight):
+    """Add delta (1 or -1) to the directory counts of root_hashes and
+    through the references of every blob whose count rises from or
+    drops to zero.
+
+    Args:
+      source_cas: CAS holding the blobs.
+      counts: Object with methods get(hash_digest), returning a pair
+        (directory count, file count), and set(hash_digest, directory
+        count, file count).
+      root_hashes: Hashes of the root directory blobs.
+      delta: 1 to add references, -1 to release them.
+      max_in_flight: Number of blobs read at the same time.
+
+    Returns:
+      The list of hashes of blobs whose counts dropped to zero.
+    """
+    freed = []
+    pending = collections.deque((root_hash, DIRECTORY)
+                                for root_hash in root_hashes)
+    in_flight = collections.deque()
+    with async_cas.AsyncCAS(source_cas, max_in_flight) as async_source:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                hash_digest, kind = pending.popleft()
+                directories, files = counts.get(hash_digest)
+                if kind == DIRECTORY:
+                    old = directories
+                    directories += delta
+                else:
+                    old = files
+                    files += delta
+                if old + delta < 0:
+                    raise ValueError('The reference count of blob {} would '
+                                     'become negative; run gc --check.'.format(
+                                         hash_digest))
+                counts.set(hash_digest, directories, files)
+                stats.count('refcount.updates')
+                if directories == 0 and files == 0:
+                    freed.append(hash_digest)
+                if old == 0 or old + delta == 0:
+                    in_flight.append(async_source.submit(
+                        _references, source_cas, hash_digest, kind, delta < 0))
+            if in_flight:
+                pending.extend(in_flight.popleft().get())
+    return freed
+
+
+class _MemoryCounts(object):
+
+    def __init__(self):
+        self.counts = {}
+
+    def get(self, hash_digest):
+        return self.counts.get(hash_digest, (0, 0))
+
+    def set(self, hash_digest, directories, files):
+        if directories == 0 and files == 0:
+            self.counts.pop(hash_digest, None)
+        else:
+            self.counts[hash_digest] = (directories, files)
+
+
+def compute_counts(source_cas, root_hashes,
+                   max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+    """Compute the reference counts of all blobs from scratch.
+
+    Returns:
+      A dictionary mapping the hashes of all live blobs to pairs
+      (directory count, file count).
+    """
+    counts = _MemoryCounts()
+    _propagate(source_cas, counts, root_hashes, 1, max_in_flight)
+    return counts.counts
+
+
+class RefcountIndex(object):
+
+    def __init__(self, cas_root, max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+        """Open the refcount index of the CAS at cas_root, creating an
+        empty one if there is none (garbage_collection.build_index
+        fills it)."""
+        utils.mkdir_p(os.path.join(str(cas_root), INDEX_DIRECTORY))
+        self._connection = sqlite3.connect(_index_path(cas_root, DATABASE_FILE))
+        self._connection.text_factory = str
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS refcounts (hash TEXT PRIMARY KEY, '
+            'directories INTEGER NOT NULL, files INTEGER NOT NULL)')
+        self._connection.commit()
+        self.max_in_flight = max_in_flight
+
+    def get(self, hash_digest):
+        """Return the pair (directory count, file count) of a blob."""
+        row = self._connection.execute(
+            'SELECT directories, files FROM refcounts WHERE hash = ?',
+            (hash_digest,)).fetchone()
+        return tuple(row) if row is not None else (0, 0)
+
+    def set(self, hash_digest, directories, files):
+        if directories == 0 and files == 0:
+            self._connection.execute('DELETE FROM refcounts WHERE hash = ?',
+                                     (hash_digest,))
+        else:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO refcounts VALUES (?, ?, ?)',
+                (hash_digest, directories, files))
+
+    def counts(self):
+        """Return a dictionary of all counts, like compute_counts."""
+        return dict((hash_digest, (directories, files))
+                    for hash_digest, directories, files in
+                    self._connection.execute('SELECT * FROM refcounts'))
+
+    def _update(self, source_cas, root_hashes, delta):
+        try:
+            freed = _propagate(source_cas, self, root_hashes, delta,
+                               self.max_in_flight)
+        except:
+            self._connection.rollback()
+            raise
+        self._connection.commit()
+        return freed
+
+    def add_root(self, source_cas, root_hash):
+        """Count a new snapshot. Raises a LookupError if one of the blobs
+        it adds is missing."""
+        self._update(source_cas, [root_hash], 1)
+
+    def remove_root(self, source_cas, root_hash):
+        """Release a deleted snapshot.
+
+        Returns:
+          The list of hashes of the blobs no snapshot references any
+          more; the caller removes them from the CAS.
+        """
+        return self._update(source_cas, [root_hash], -1)
+
+    def replace(self, counts):
+        """Replace all counts by those in a dictionary as returned by
+        compute_counts."""
+        self._connection.execute('DELETE FROM refcounts')
+        self._connection.executemany(
+            'INSERT INTO refcounts VALUES (?, ?, ?)',
+            ((hash_digest, directories, files)
+             for hash_digest, (directories, files) in counts.iteritems()))
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def compare(indexed, computed):
+    """Return the sorted list of triples (hash, indexed counts,
+    computed counts) of the blobs whose counts differ between two
+    dictionaries as returned by compute_counts."""
+    return sorted((hash_digest, indexed.get(hash_digest, (0, 0)),
+                   computed.get(hash_digest, (0, 0)))
+                  for hash_digest in set(indexed) | set(computed)
+                  if indexed.get(hash_digest) != computed.get(hash_digest))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Tests for the go-backup refcount index and snapshot deletion."""
+
+import backup
+import cas
+import catalog
+import garbage_collection
+import hashing
+import os
+import pytest
+import refcount
+from restore_test import make_source
+
+def indexed_cas(tmpdir):
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    garbage_collection.build_index(test_cas)
+    return test_cas
+
+def test_catalog_finds_the_index(tmpdir):
+    assert catalog.REFCOUNT_INDEX_PATH == os.path.join(
+        refcount.INDEX_DIRECTORY, refcount.DATABASE_FILE)
+    assert not catalog.Catalog(str(tmpdir))._has_refcount_index()
+    indexed_cas(tmpdir)
+    assert catalog.Catalog(str(tmpdir.join('cas')))._has_refcount_index()
+
+def test_delete_frees_only_unshared_blobs(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = indexed_cas(tmpdir)
+    first = backup.backup(test_cas, str(source), [])
+    source.join('sub', 'deeper', 'b.sh').write('changed')
+    source.join('new.txt').write('new file')
+    second = backup.backup(test_cas, str(source), [])
+
+    with refcount.RefcountIndex(test_cas.root) as refcounts:
+        assert refcounts.counts() == refcount.compute_counts(
+            test_cas, [first.root_hash, second.root_hash])
+        assert refcounts.get(first.root_hash) == (1, 0)
+        assert refcounts.get(hashing.hash_str('file a')) == (0, 2)
+        assert refcounts.get(hashing.hash_str('new file')) == (0, 1)
+
+    snapshots = catalog.Catalog(test_cas.root)
+    # the old b.sh and the directories on the way to it
+    assert snapshots.delete(test_cas, first.root_hash) == 4
+    assert not test_cas.has_file(first.root_hash)
+    assert not test_cas.has_file(hashing.hash_str('#!/bin/sh\n'))
+    assert test_cas.has_file(hashing.hash_str('file a'))
+    assert [s.root_hash for s in snapshots.snapshots()] == [second.root_hash]
+    assert snapshots.latest(str(source)).root_hash == second.root_hash
+    assert (garbage_collection.check(test_cas) ==
+            garbage_collection.CheckResult([], []))
+
+    snapshots.delete(test_cas, second.root_hash)
+    assert test_cas.list() == []
+    assert snapshots.snapshots() == []
+    with pytest.raises(LookupError):
+        snapshots.delete(test_cas, second.root_hash)
+
+def test_snapshots_sharing_a_root(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = indexed_cas(tmpdir)
+    first = backup.backup(test_cas, str(source), [])
+    second = backup.backup(test_cas, str(source), [])
+    assert second.root_hash == first.root_hash
+
+    snapshots = catalog.Catalog(test_cas.root)
+    assert snapshots.delete(test_cas, first.root_hash) == 0
+    # the oldest one is deleted
+    assert snapshots.snapshots() == [second]
+    with refcount.RefcountIndex(test_cas.root) as refcounts:
+        assert refcounts.get(first.root_hash) == (1, 0)
+
+def test_chunks_are_counted(tmpdir):
+    source = make_source(tmpdir)
+    source.join('big').write('x' * 2500 + 'y' * 2500)
+    test_cas = indexed_cas(tmpdir)
+    digest = hashing.hash_str('x' * 2500 + 'y' * 2500)
+    cas.store_chunked_file(test_cas, str(source.join('big')), digest,
+                           chunk_size=1000)
+    chunks = test_cas.chunk_list(digest)
+    snapshot = backup.backup(test_cas, str(source), [])
+
+    with refcount.RefcountIndex(test_cas.root) as refcounts:
+        assert refcounts.get(digest) == (0, 1)
+        # two chunks of x, one mixed, two of y
+        assert refcounts.get(chunks[0][0]) == (0, 2)
+        assert refcounts.get(chunks[2][0]) == (0, 1)
+
+    catalog.Catalog(test_cas.root).delete(test_cas, snapshot.root_hash)
+    assert test_cas.list() == []
+
+def test_recording_requires_all_new_blobs(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = indexed_cas(tmpdir)
+    snapshot = backup.backup(test_cas, str(source), [])
+    catalog.Catalog(test_cas.root).delete(test_cas, snapshot.root_hash)
+
+    # a root whose blob is gone is not recorded, and nothing is counted
+    with pytest.raises(LookupError):
+        catalog.Catalog(test_cas.root).record(test_cas, snapshot.root_hash,
+                                              str(source), 3, 0)
+    assert catalog.Catalog(test_cas.root).snapshots() == []
+    with refcount.RefcountIndex(test_cas.root) as refcounts:
+        assert refcounts.counts() == {}
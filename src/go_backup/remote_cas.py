@@ -0,0 +1,544 @@
+#!/usr/bin/env python
+"""Access to a go-backup CAS over the network.
+
+CASServer serves a local cas.CAS over TCP; RemoteCAS is a client with
+the interface of cas.CAS (has_file, has_files, store, store_chunk_list,
+chunk_list, retrieve, list, ilist and sync), so that it can be passed
+to cas.store_list_of_files, restore, verify and the like. The snapshot
+catalog is not served; it stays with the CAS on the server.
+
+The protocol is line-based. Each request is a line with a command and
+its arguments, optionally followed by data, and is answered by a line
+"OK ...", "MISSING" or "ERR <exception type> <message>", optionally
+followed by data. Blob contents are sent as frames: a line with the
+length of the frame in bytes, followed by that many bytes, with a
+frame of length 0 marking the end.
+
+  HAVE <n> + n lines with digests  -> OK + line of n characters 0 or 1
+  PUT <digest> + frames            -> OK
+  MANIFEST <digest> <n> + n lines "<chunk digest> <size>" -> OK
+  CHUNKS <digest>                  -> OK <n> + n lines, or OK NONE
+  GET <digest>                     -> OK + frames, or MISSING
+  LIST                             -> OK + lines with digests + empty line
+  SYNC                             -> OK
+
+Every digest in a request must be 64 lowercase hex characters (see
+cas.check_digest); other requests, and requests the server fails to
+carry out, are answered with ERR. If a request fails after part of its
+answer was sent, the server closes the connection instead.
+
+Existence queries are batched: has_files asks for up to
+HAVE_BATCH_SIZE digests per round trip, so deduplicating a snapshot
+against the server costs a few round trips instead of one stat per
+file (as over NFS). Uploads are pipelined: store() sends a blob without
+waiting for the server's answer, which is only read once
+MAX_PENDING_STORES more blobs have been sent over the same connection,
+or by sync(). Errors of a store (such as a blob whose contents do not
+match its digest, which the server rejects) are therefore raised by a
+later call, at the latest by sync(), which callers must call before
+recording a snapshot anyway; their message names the digest of the
+blob. A blob stored through one connection may
+not be reported by has_file before sync().
+
+The client keeps a pool of at most pool_size persistent connections,
+each used by one thread at a time.
+
+The protocol has no authentication (nor encryption): anyone who can
+connect to the server can read and write every blob of the CAS. The
+server therefore listens on DEFAULT_HOST, the loopback interface,
+unless told otherwise (go-backup serve --bind HOST); to serve other
+hosts, bind to a trusted network only or tunnel connections, e.g.
+through SSH.
+"""
+
+import os
+import Queue
+import socket
+import SocketServer
+import threading
+
+import cas
+import hashing
+import stats
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 7314
+
+"""Maximum number of digests per HAVE request."""
+HAVE_BATCH_SIZE = 10000
+
+"""Maximum number of unanswered PUT requests per connection."""
+MAX_PENDING_STORES = 64
+
+DEFAULT_POOL_SIZE = 4
+
+_ERRORS = {'LookupError': LookupError, 'ValueError': ValueError}
+
+
+def _write_frames(wfile, fileobj):
+    while True:
+        data = fileobj.read(hashing.READ_BLOCK_SIZE)
+        if not data:
+            break
+        wfile.write('%d\n' % len(data))
+        wfile.write(data)
+    wfile.write('0\n')
+
+
+class ConnectionClosed(IOError):
+    """Raised when the other end closes a connection in the middle of a
+    request or response."""
+
+
+class _FrameReader(object):
+    """File-like object reading frames until the end marker."""
+
+    def __init__(self, rfile):
+        self._rfile = rfile
+        self._remaining = 0
+        self._done = False
+
+    def read(self, size=-1):
+        if self._remaining == 0 and not self._done:
+            self._remaining = int(_read_line(self._rfile))
+            self._done = self._remaining == 0
+        if self._done:
+            return ''
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._rfile.read(size)
+        if len(data) != size:
+            raise ConnectionClosed('Connection closed in the middle of a blob.')
+        self._remaining -= size
+        return data
+
+    def drain(self):
+        while self.read(hashing.READ_BLOCK_SIZE):
+            pass
+
+    @property
+    def done(self):
+        return self._done
+
+
+def _read_line(rfile):
+    line = rfile.readline()
+    if not line.endswith('\n'):
+        raise ConnectionClosed('Connection closed unexpectedly.')
+    return line[:-1]
+
+
+class _AbortedAnswer(Exception):
+    """Raised when a request fails after part of its answer was sent, so
+    that the connection can only be closed."""
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            self._handle_requests()
+        except (socket.error, ConnectionClosed):
+            # The client went away; there is nobody to answer.
+            stats.count('remote_cas.dropped_connections')
+        except _AbortedAnswer:
+            # Closing the connection tells the client that the answer
+            # is incomplete.
+            stats.count('remote_cas.aborted_answers')
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+    def _handle_requests(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command, _, args = line.rstrip('\n').partition(' ')
+            handler = getattr(self, '_handle_' + command.lower(), None)
+            self._answered = False
+            try:
+                if handler is None:
+                    raise ValueError('Unknown command "{}".'.format(command))
+                handler(*args.split())
+            except (socket.error, ConnectionClosed):
+                raise
+            except (LookupError, ValueError, TypeError,
+                    EnvironmentError) as e:
+                # TypeError includes requests with the wrong number of
+                # arguments.
+                if self._answered:
+                    raise _AbortedAnswer(e)
+                self.wfile.write('ERR {} {}\n'.format(type(e).__name__, e))
+            self.wfile.flush()
+
+    def _handle_have(self, count):
+        digests = [_read_line(self.rfile) for _ in xrange(int(count))]
+        for hash_digest in digests:
+            cas.check_digest(hash_digest)
+        present = self.server.cas.has_files(digests)
+        self.wfile.write('OK\n')
+        self.wfile.write(''.join('1' if d in present else '0'
+                                 for d in digests) + '\n')
+
+    def _handle_put(self, hash_digest):
+        reader = _FrameReader(self.rfile)
+        try:
+            cas.check_digest(hash_digest)
+            if not self.server.cas.has_file(hash_digest):
+                self.server.cas.store(
+                    hashing.VerifyingReader(reader, hash_digest), hash_digest)
+        except LookupError:
+            # stored concurrently through another connection
+            pass
+        finally:
+            # keep the connection in sync even if the store failed
+            reader.drain()
+        self.wfile.write('OK\n')
+
+    def _handle_manifest(self, hash_digest, count):
+        chunks = []
+        for _ in xrange(int(count)):
+            chunk_digest, size = _read_line(self.rfile).split()
+            chunks.append((chunk_digest, int(size)))
+        cas.check_digest(hash_digest)
+        for chunk_digest, _ in chunks:
+            cas.check_digest(chunk_digest)
+        if not self.server.cas.has_file(hash_digest):
+            self.server.cas.store_chunk_list(chunks, hash_digest)
+        self.wfile.write('OK\n')
+
+    def _handle_chunks(self, hash_digest):
+        cas.check_digest(hash_digest)
+        if not self.server.cas.has_file(hash_digest):
+            raise LookupError('File not present in the CAS.')
+        chunks = self.server.cas.chunk_list(hash_digest)
+        if chunks is None:
+            self.wfile.write('OK NONE\n')
+            return
+        self.wfile.write('OK %d\n' % len(chunks))
+        for chunk_digest, size in chunks:
+            self.wfile.write('%s %d\n' % (chunk_digest, size))
+
+    def _handle_get(self, hash_digest):
+        cas.check_digest(hash_digest)
+        try:
+            blob = self.server.cas.retrieve(hash_digest)
+        except LookupError:
+            self.wfile.write('MISSING\n')
+            return
+        with blob:
+            self.wfile.write('OK\n')
+            self._answered = True
+            _write_frames(self.wfile, blob)
+
+    def _handle_list(self):
+        self.wfile.write('OK\n')
+        self._answered = True
+        for hash_digest in self.server.cas.ilist():
+            self.wfile.write(hash_digest + '\n')
+        self.wfile.write('\n')
+
+    def _handle_sync(self):
+        self.server.cas.sync()
+        self.wfile.write('OK\n')
+
+
+class CASServer(SocketServer.ThreadingTCPServer):
+    """TCP server for a local CAS, serving each connection in a thread."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, served_cas, address=(DEFAULT_HOST, DEFAULT_PORT)):
+        """Create a server for served_cas listening on address, a pair
+        (host, port); port 0 picks a free port (see server_address)."""
+        SocketServer.ThreadingTCPServer.__init__(self, address,
+                                                 _RequestHandler)
+        self.cas = served_cas
+
+
+class _Connection(object):
+
+    def __init__(self, address):
+        self._socket = socket.create_connection(address)
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self._socket.makefile('rb')
+        self.wfile = self._socket.makefile('wb')
+        self._pending_stores = []
+
+    def request(self, line):
+        """Send a request line, first collecting the answers to any
+        pipelined stores."""
+        self.finish_stores()
+        stats.count('remote_cas.requests')
+        self.wfile.write(line + '\n')
+
+    def answer(self, context=None):
+        """Flush the request and return the arguments of its answer.
+
+        If the answer is an error, context (if given) is prepended to
+        the message of the exception raised.
+        """
+        self.wfile.flush()
+        line = _read_line(self.rfile)
+        status, _, args = line.partition(' ')
+        if status == 'OK':
+            return args
+        elif status == 'MISSING':
+            error_type, message = LookupError, 'File not present in the CAS.'
+        elif status == 'ERR':
+            error_type, _, message = args.partition(' ')
+            error_type = _ERRORS.get(error_type, IOError)
+        else:
+            raise IOError('Unexpected answer "{}" from the server.'.format(line))
+        if context is not None:
+            message = '{}: {}'.format(context, message)
+        raise error_type(message)
+
+    def store(self, fileobj, hash_digest):
+        while len(self._pending_stores) >= MAX_PENDING_STORES:
+            self._finish_store()
+        stats.count('remote_cas.requests')
+        self.wfile.write('PUT %s\n' % hash_digest)
+        _write_frames(self.wfile, fileobj)
+        self.wfile.flush()
+        self._pending_stores.append(hash_digest)
+
+    def _finish_store(self):
+        hash_digest = self._pending_stores.pop(0)
+        self.answer('Storing blob {} failed'.format(hash_digest))
+
+    def finish_stores(self):
+        while self._pending_stores:
+            self._finish_store()
+
+    def close(self):
+        self._socket.close()
+
+
+class RemoteCAS(object):
+
+    def __init__(self, host, port=DEFAULT_PORT, pool_size=DEFAULT_POOL_SIZE):
+        """Create a client for the CAS served at host and port, using at
+        most pool_size connections at a time."""
+        self._address = (host, port)
+        self._pool_size = pool_size
+        self._idle = Queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            return _Connection(self._address)
+        except:
+            self._slots.release()
+            raise
+
+    def _release(self, connection, broken=False):
+        """Return a connection to the pool, or close it if it is broken
+        or no longer in sync with the server."""
+        if broken:
+            connection.close()
+        else:
+            self._idle.put(connection)
+        self._slots.release()
+
+    def _call(self, f):
+        """Call f with a pooled connection and return its result."""
+        connection = self._acquire()
+        try:
+            result = f(connection)
+        except (LookupError, ValueError):
+            self._release(connection)
+            raise
+        except:
+            self._release(connection, broken=True)
+            raise
+        self._release(connection)
+        return result
+
+    def has_file(self, hash_digest):
+        return hash_digest in self.has_files([hash_digest])
+
+    def has_files(self, hash_digests):
+        hash_digests = list(hash_digests)
+
+        def have(connection):
+            present = set()
+            for start in xrange(0, len(hash_digests), HAVE_BATCH_SIZE):
+                batch = hash_digests[start:start + HAVE_BATCH_SIZE]
+                connection.request('HAVE %d' % len(batch))
+                connection.wfile.write(''.join(d + '\n' for d in batch))
+                connection.answer()
+                flags = _read_line(connection.rfile)
+                present.update(d for d, flag in zip(batch, flags)
+                               if flag == '1')
+            return present
+        return self._call(have)
+
+    def store(self, fileobj, hash_digest):
+        """Send a blob to the server without waiting for its answer; see
+        the module documentation."""
+        self._call(lambda connection: connection.store(fileobj, hash_digest))
+
+    def store_chunk_list(self, chunks, hash_digest):
+        # The chunks may still be in flight on other connections.
+        self._finish_all_stores()
+
+        def manifest(connection):
+            connection.request('MANIFEST %s %d' % (hash_digest, len(chunks)))
+            connection.wfile.write(''.join('%s %d\n' % chunk
+                                           for chunk in chunks))
+            connection.answer()
+        self._call(manifest)
+
+    def chunk_list(self, hash_digest):
+        def chunks(connection):
+            connection.request('CHUNKS %s' % hash_digest)
+            count = connection.answer()
+            if count == 'NONE':
+                return None
+            result = []
+            for _ in xrange(int(count)):
+                chunk_digest, size = _read_line(connection.rfile).split()
+                result.append((chunk_digest, int(size)))
+            return result
+        return self._call(chunks)
+
+    def retrieve(self, hash_digest):
+        """Return a file-like object with the contents of a blob. It holds
+        one of the pooled connections until it is closed."""
+        connection = self._acquire()
+        try:
+            connection.request('GET %s' % hash_digest)
+            connection.answer()
+        except LookupError:
+            self._release(connection)
+            raise
+        except:
+            self._release(connection, broken=True)
+            raise
+        return _RemoteBlob(self, connection)
+
+    def list(self):
+        return list(self.ilist())
+
+    def ilist(self):
+        connection = self._acquire()
+        broken = True
+        try:
+            connection.request('LIST')
+            connection.answer()
+            while True:
+                hash_digest = _read_line(connection.rfile)
+                if not hash_digest:
+                    break
+                yield hash_digest
+            broken = False
+        finally:
+            self._release(connection, broken)
+
+    def _finish_all_stores(self):
+        """Collect the answers to the stores sent over idle connections,
+        i.e. to all stores whose store() call has returned."""
+        connections = []
+        while True:
+            try:
+                connections.append(self._idle.get_nowait())
+            except Queue.Empty:
+                break
+        try:
+            for connection in connections:
+                connection.finish_stores()
+        finally:
+            for connection in connections:
+                self._idle.put(connection)
+
+    def sync(self):
+        """Wait for all stores to complete, raising any of their errors,
+        and make them durable on the server."""
+        self._finish_all_stores()
+
+        def sync(connection):
+            connection.request('SYNC')
+            connection.answer()
+        self._call(sync)
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                return
+
+
+class _RemoteBlob(object):
+    """File-like object returned by RemoteCAS.retrieve."""
+
+    def __init__(self, remote_cas, connection):
+        self._cas = remote_cas
+        self._connection = connection
+        self._reader = _FrameReader(connection.rfile)
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self._reader.read(size)
+        chunks = []
+        while True:
+            data = self._reader.read(hashing.READ_BLOCK_SIZE)
+            if not data:
+                return ''.join(chunks)
+            chunks.append(data)
+
+    def close(self):
+        if self._connection is not None:
+            # A connection in the middle of a blob cannot be reused.
+            self._cas._release(self._connection, broken=not self._reader.done)
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv):
+    args = []
+    host = DEFAULT_HOST
+    argv_iter = iter(argv[1:])
+    try:
+        for arg in argv_iter:
+            if arg == '--bind':
+                host = next(argv_iter)
+            else:
+                args.append(arg)
+    except StopIteration:
+        args = []
+    if len(args) not in (1, 2):
+        print "usage: %s [--bind HOST] cas_root [port]" % argv[0]
+        return 1
+
+    port = int(args[1]) if len(args) == 2 else DEFAULT_PORT
+    server = CASServer(cas.CAS(os.path.abspath(args[0])), (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""Tests for the go-backup network CAS client and server."""
+
+import cas
+import hashing
+import os
+import pytest
+import remote_cas
+import socket
+import stats
+import StringIO
+import threading
+import time
+from cas_test import store_str
+
+@pytest.fixture
+def server_cas(tmpdir):
+    """A local CAS served on localhost; yields (local CAS, RemoteCAS)."""
+    local_cas = cas.CAS(tmpdir.mkdir('cas'))
+    server = remote_cas.CASServer(local_cas, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = remote_cas.RemoteCAS(*server.server_address, pool_size=2)
+    yield local_cas, client
+    client.close()
+    server.shutdown()
+    server.server_close()
+
+def test_store_and_retrieve(server_cas, monkeypatch):
+    local_cas, client = server_cas
+    monkeypatch.setattr(remote_cas, 'MAX_PENDING_STORES', 3)
+    contents = ['blob %d' % i for i in xrange(10)] + [os.urandom(3000000)]
+    digests = [store_str(client, c) for c in contents]
+    client.sync()
+
+    assert sorted(local_cas.list()) == sorted(digests)
+    assert sorted(client.list()) == sorted(digests)
+    for digest, c in zip(digests, contents):
+        with client.retrieve(digest) as blob:
+            assert blob.read() == c
+    with pytest.raises(LookupError):
+        client.retrieve('0' * 64)
+
+def test_batched_existence_queries(server_cas, monkeypatch):
+    local_cas, client = server_cas
+    monkeypatch.setattr(remote_cas, 'HAVE_BATCH_SIZE', 3)
+    present = [store_str(local_cas, 'blob %d' % i) for i in xrange(4)]
+    missing = [hashing.hash_str('missing %d' % i) for i in xrange(4)]
+    assert client.has_files(present + missing) == set(present)
+    assert client.has_file(present[0])
+    assert not client.has_file(missing[0])
+
+def test_corrupted_store_is_rejected(server_cas):
+    local_cas, client = server_cas
+    digest = hashing.hash_str('expected contents')
+    client.store(StringIO.StringIO('other contents'), digest)
+    with pytest.raises(ValueError) as e:
+        client.sync()
+    assert 'Storing blob %s failed' % digest in str(e.value)
+    assert not local_cas.has_file(digest)
+    # the connection is still usable
+    good = store_str(client, 'expected contents')
+    client.sync()
+    assert local_cas.has_file(good)
+
+def test_invalid_digests_are_rejected(server_cas):
+    local_cas, client = server_cas
+    for digest in ['../../etc/passwd', '0' * 63, 'A' * 64, '0' * 64 + '/x']:
+        with pytest.raises(ValueError):
+            client.retrieve(digest)
+        with pytest.raises(ValueError):
+            client.has_file(digest)
+        with pytest.raises(ValueError):
+            client.chunk_list(digest)
+        with pytest.raises(ValueError):
+            client.store_chunk_list([(digest, 1)], '0' * 64)
+        client.store(StringIO.StringIO('contents'), digest)
+        with pytest.raises(ValueError):
+            client.sync()
+    assert local_cas.list() == []
+    # the connections are still usable
+    good = store_str(client, 'contents')
+    client.sync()
+    assert client.has_file(good)
+
+def test_malformed_requests_are_answered(server_cas):
+    local_cas, client = server_cas
+    connection = socket.create_connection(client._address)
+    try:
+        rfile = connection.makefile('rb')
+        connection.sendall('GET\nCHUNKS %s %s\nHAVE x\nSYNC\n' % (
+            '0' * 64, '0' * 64))
+        assert rfile.readline().startswith('ERR TypeError ')
+        assert rfile.readline().startswith('ERR TypeError ')
+        assert rfile.readline().startswith('ERR ValueError ')
+        assert rfile.readline() == 'OK\n'
+    finally:
+        connection.close()
+
+def test_server_errors_are_answered(server_cas, monkeypatch):
+    local_cas, client = server_cas
+    def failing_sync():
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(local_cas, 'sync', failing_sync)
+    with pytest.raises(IOError) as e:
+        client.sync()
+    assert 'No space left on device' in str(e.value)
+    monkeypatch.undo()
+    client.sync()
+
+def test_store_error_names_its_digest(server_cas, monkeypatch):
+    local_cas, client = server_cas
+    monkeypatch.setattr(remote_cas, 'MAX_PENDING_STORES', 1)
+    bad = hashing.hash_str('expected contents')
+    client.store(StringIO.StringIO('other contents'), bad)
+    # the error is raised by the next store over the same connection
+    with pytest.raises(ValueError) as e:
+        store_str(client, 'unrelated contents')
+    assert 'Storing blob %s failed' % bad in str(e.value)
+    client.sync()
+    assert not local_cas.has_file(bad)
+
+def test_partially_read_blob(server_cas):
+    local_cas, client = server_cas
+    digest = store_str(local_cas, 'x' * 3000000)
+    for _ in xrange(3):
+        with client.retrieve(digest) as blob:
+            assert blob.read(10) == 'x' * 10
+    assert client.has_file(digest)
+
+def test_store_list_of_files_with_chunking(server_cas, tmpdir):
+    local_cas, client = server_cas
+    source = tmpdir.mkdir('source')
+    source.join('small').write('small file')
+    source.join('big').write('0123456789' * 1000)
+    source.join('copy').write('small file')
+    file_digests = [(str(source.join(name)),
+                     hashing.hash_str(source.join(name).read()))
+                    for name in ['small', 'big', 'copy']]
+    stored = cas.store_list_of_files(client, file_digests, num_threads=2,
+                                     chunk_threshold=5000, chunk_size=4096)
+    client.sync()
+    assert len(stored) == 5
+    assert len(client.chunk_list(file_digests[1][1])) == 3
+    assert client.chunk_list(file_digests[0][1]) is None
+    with local_cas.retrieve(file_digests[1][1]) as blob:
+        assert blob.read() == '0123456789' * 1000
+    with client.retrieve(file_digests[1][1]) as blob:
+        assert blob.read() == '0123456789' * 1000
+
+def test_dropped_connections_are_quiet(tmpdir, monkeypatch):
+    local_cas = cas.CAS(tmpdir.mkdir('cas'))
+    errors = []
+    monkeypatch.setattr(remote_cas.CASServer, 'handle_error',
+                        lambda self, request, address: errors.append(address))
+    server = remote_cas.CASServer(local_cas, ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    stats.enable()
+    try:
+        digest = hashing.hash_str('contents')
+        # clients going away in the middle of a blob and of a request
+        for request in ['PUT %s\n8\ncont' % digest, 'HAVE 2\n%s\n' % digest]:
+            connection = socket.create_connection(server.server_address)
+            connection.sendall(request)
+            connection.close()
+        deadline = time.time() + 10
+        while (stats.report()['counters'].get(
+                'remote_cas.dropped_connections', 0) < 2 and
+               time.time() < deadline):
+            time.sleep(0.01)
+        assert stats.report()['counters']['remote_cas.dropped_connections'] == 2
+    finally:
+        stats.disable()
+        server.shutdown()
+        server.server_close()
+    assert errors == []
+    assert not local_cas.has_file(digest)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+"""Restore of files and directories from go-backup snapshots.
+
+A path inside a snapshot is resolved by descending from the root
+directory blob, so only the blobs of the directories on the way are
+read. Restoring a single file thus takes time independent of the size
+of the snapshot.
+
+Restore proceeds as described in README.md: a loop that creates the
+target structure and copies file contents out of the CAS (verifying
+their hashes on the way), followed by a loop that fixes up
+permissions, ownership and modification times. The fix-up loop runs
+in reverse, so that the mtime of a directory is set after its contents
+were created.
+
+Given an async_cas.AsyncCAS, the first loop copies files and loads
+directory blobs in the background, with up to its max_in_flight
+operations in flight. That makes restoring from a high-latency CAS
+(NFS, remote_cas) bound by bandwidth rather than latency.
+
+Blocks of zeros in files are restored as holes (see the sparse
+module), so sparse files such as VM disk images take no more space
+than they did when they were backed up.
+"""
+
+import collections
+import grp
+import os
+import pwd
+import shutil
+import stat
+
+import async_cas
+import cas_tree
+import hashing
+import metadata
+import sparse
+import stat_cache
+import utils
+
+
+def find_node(root_node, path):
+    """Return the node at path in the tree rooted at root_node.
+
+    Raises a LookupError if there is no such node.
+    """
+    node = root_node
+    for part in utils.get_path_parts(path):
+        if not isinstance(node, metadata.DirectoryNode):
+            raise LookupError('{} is not a directory in the snapshot.'.format(
+                node.name))
+        if part not in node.children:
+            raise LookupError('{} not found in the snapshot.'.format(path))
+        node = node.children[part]
+    return node
+
+
+def _restore_file(source_cas, node, native_path):
+    # Blocks of zeros are restored as holes, so sparse files stay sparse.
+    with source_cas.retrieve(node.hash) as source:
+        with open(native_path, 'wb') as destination:
+            digest = hashing.hash_chunks(
+                sparse.write_blocks(
+                    sparse.iter_blocks(source, hashing.READ_BLOCK_SIZE),
+                    destination))
+    if digest != node.hash:
+        raise ValueError('Blob {} is corrupted (restored contents hash to {}).'
+                         .format(node.hash, digest))
+
+
+def _remove_existing(native_path):
+    """Remove whatever is at native_path, so that a file or symlink can
+    be created there."""
+    if os.path.isdir(native_path) and not os.path.islink(native_path):
+        shutil.rmtree(native_path)
+    elif os.path.lexists(native_path):
+        os.remove(native_path)
+
+
+def _fix_up(node, native_path, set_owner):
+    if set_owner:
+        os.lchown(native_path, _uid(node.user), _gid(node.group))
+    if isinstance(node, metadata.SymlinkNode):
+        # Python can change neither the permissions nor the mtime of a
+        # symlink itself.
+        return
+    os.chmod(native_path, stat.S_IMODE(int(node.permissions, 8)))
+    os.utime(native_path, (node.mtime, node.mtime))
+
+
+def _uid(user):
+    try:
+        return pwd.getpwnam(user).pw_uid
+    except KeyError:
+        # metadata.get_default_metadata stores unknown users numerically
+        return int(user)
+
+
+def _gid(group):
+    try:
+        return grp.getgrnam(group).gr_gid
+    except KeyError:
+        return int(group)
+
+
+def restore_node(source_cas, node, destination, set_owner=None,
+                 async_source=None, cache=None, force=False):
+    """Restore a metadata tree node and everything below it.
+
+    Args:
+      source_cas: CAS holding the file contents.
+      node: Node to restore; typically obtained from cas_tree.
+      destination: Native path to create for node. For the root of a
+        snapshot (whose own metadata is not recorded) destination may
+        be an existing directory.
+      set_owner: Whether to restore file ownership. Defaults to True
+        if running as root.
+      async_source: async_cas.AsyncCAS for source_cas. If given, files
+        are restored in the background.
+      cache: stat_cache.StatCache. If given, the restored files are
+        recorded in it under their paths relative to destination.
+      force: Replace files and symlinks that exist already.
+
+    Returns:
+      The list of native paths that were created.
+    """
+    if set_owner is None:
+        set_owner = os.geteuid() == 0
+
+    created = []
+    fix_ups = []
+    in_flight = collections.deque()
+    stack = [(node, destination)]
+    while stack:
+        cur_node, native_path = stack.pop()
+        if isinstance(cur_node, metadata.DirectoryNode):
+            if not os.path.isdir(native_path):
+                os.mkdir(native_path)
+            children = cur_node.children
+            cas_tree.prefetch_subdirectories(children)
+            for name, child in sorted(children.iteritems(), reverse=True):
+                stack.append((child, os.path.join(native_path, name)))
+        elif isinstance(cur_node, metadata.SymlinkNode):
+            if force:
+                _remove_existing(native_path)
+            os.symlink(cur_node.link_target, native_path)
+        elif isinstance(cur_node, metadata.FileNode):
+            if force:
+                # Writing through an existing symlink would change the
+                # file it points to.
+                _remove_existing(native_path)
+            if async_source is None:
+                _restore_file(source_cas, cur_node, native_path)
+            else:
+                in_flight.append(async_source.submit(
+                    _restore_file, source_cas, cur_node, native_path))
+                while in_flight and in_flight[0].ready():
+                    in_flight.popleft().get()
+        else:
+            raise ValueError('Unknown node type {}.'.format(type(cur_node)))
+        created.append(native_path)
+        if cur_node.mtime is not None:
+            fix_ups.append((cur_node, native_path))
+    # Raise the first error, if any, before fixing up any metadata.
+    while in_flight:
+        in_flight.popleft().get()
+
+    rootdir = os.path.normpath(os.path.abspath(destination))
+    for cur_node, native_path in reversed(fix_ups):
+        _fix_up(cur_node, native_path, set_owner)
+        if cache is not None and isinstance(cur_node, metadata.FileNode):
+            # Fixing up changes the ctime, so files are recorded after.
+            path = utils.get_path_from_native_path(
+                rootdir, os.path.normpath(os.path.abspath(native_path)))
+            cache.record(path, os.lstat(native_path), cur_node.hash)
+
+    return created
+
+
+def restore(source_cas, root_hash, path, destination, force=False,
+            max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+    """Restore a file or subtree of a snapshot.
+
+    Args:
+      source_cas: CAS holding the snapshot.
+      root_hash: Hash of the root directory blob of the snapshot.
+      path: Path inside the snapshot, e.g. '/' or '/home/x/file.txt'.
+      destination: Native path under which the node at path is
+        restored. It must not exist, unless path is '/' and
+        destination is an empty directory, or force is set.
+      force: Allow restoring into an existing, non-empty directory.
+      max_in_flight: Maximum number of CAS operations in flight.
+
+    Returns:
+      The list of native paths that were created.
+    """
+    utils.ensure_normalized(path)
+    utils.ensure_absolute(path)
+    with async_cas.AsyncCAS(source_cas, max_in_flight) as async_source:
+        tree = cas_tree.CASTree(source_cas, async_source=async_source)
+        node = find_node(tree.root(root_hash), path)
+
+        if os.path.lexists(destination) and not force:
+            if not (isinstance(node, metadata.DirectoryNode) and
+                    os.path.isdir(destination) and
+                    not os.listdir(destination)):
+                raise ValueError('Destination {} already exists.'.format(
+                    destination))
+        # The restored files are hashed while being restored, so the
+        # next verify of a restored snapshot may skip them if they are
+        # unchanged.
+        cache = stat_cache.StatCache() if path == os.sep else None
+        created = restore_node(source_cas, node, destination,
+                               async_source=async_source, cache=cache,
+                               force=force)
+
+    if cache is not None:
+        stat_cache.save(destination, cache)
+
+    return created
+
+
+def main(argv):
+    import cas
+    args = [arg for arg in argv[1:] if arg != '--force']
+    if len(args) not in (3, 4):
+        print "usage: %s [--force] cas_root hash [path-in-snapshot] destination" % argv[0]
+        return 1
+
+    source_cas = cas.CAS(os.path.abspath(args[0]))
+    path = args[2] if len(args) == 4 else os.sep
+    restore(source_cas, args[1], path, args[-1], force='--force' in argv[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
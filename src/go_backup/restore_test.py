@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Tests for go-backup restore."""
+
+import backup
+import cas
+import cas_tree
+import hashing
+import metadata
+import os
+import pytest
+import restore
+import stat_cache
+
+def backup_directory(source, test_cas):
+    """Store the contents of directory source in test_cas and return the
+    root hash of the snapshot."""
+    return backup.backup(test_cas, str(source), [], num_processes=2,
+                         num_threads=2).root_hash
+
+def make_source(tmpdir):
+    source = tmpdir.mkdir('source')
+    source.join('top.txt').write('top level file')
+    sub = source.mkdir('sub')
+    sub.join('a.txt').write('file a')
+    sub.join('link').mksymlinkto('a.txt')
+    sub.mkdir('deeper').join('b.sh').write('#!/bin/sh\n')
+    sub.join('deeper').join('b.sh').chmod(0o750)
+    os.utime(str(sub.join('a.txt')), (1400000000, 1400000000))
+    return source
+
+def test_restore_single_file(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+
+    dest = tmpdir.join('a-restored.txt')
+    restore.restore(test_cas, root_hash, '/sub/a.txt', str(dest))
+    assert dest.read() == 'file a'
+    assert dest.mtime() == 1400000000
+
+def test_restore_subtree(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+
+    dest = tmpdir.join('sub-restored')
+    restore.restore(test_cas, root_hash, '/sub', str(dest))
+    assert sorted(os.listdir(str(dest))) == ['a.txt', 'deeper', 'link']
+    assert os.readlink(str(dest.join('link'))) == 'a.txt'
+    assert dest.join('deeper').join('b.sh').read() == '#!/bin/sh\n'
+    assert dest.join('deeper').join('b.sh').stat().mode & 0o7777 == 0o750
+
+def test_restore_full_snapshot_into_empty_directory(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    source = make_source(tmpdir)
+    root_hash = backup_directory(source, test_cas)
+
+    dest = tmpdir.mkdir('full')
+    restore.restore(test_cas, root_hash, '/', str(dest))
+    # a full restore records the stat cache for the next verify,
+    # outside of the restored tree
+    assert os.path.exists(stat_cache.cache_path(str(dest)))
+    assert sorted(stat_cache.load(str(dest)).files) == [
+        '/sub/a.txt', '/sub/deeper/b.sh', '/top.txt']
+    restored_hash = backup_directory(dest, test_cas)
+    # Python 2 cannot set the mtime of a symlink, so it may differ
+    tree = cas_tree.CASTree(test_cas)
+    original = metadata.flatten_tree(tree.root(root_hash))
+    restored = metadata.flatten_tree(tree.root(restored_hash))
+    assert sorted(original) == sorted(restored)
+    for path, node in original.iteritems():
+        if isinstance(node, metadata.SymlinkNode):
+            assert node._replace(mtime=None) == restored[path]._replace(mtime=None)
+        elif path != os.sep:
+            assert node[:-1] == restored[path][:-1]
+
+def test_restore_refuses_existing_destination(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+
+    dest = tmpdir.join('existing.txt')
+    dest.write('precious')
+    with pytest.raises(ValueError):
+        restore.restore(test_cas, root_hash, '/top.txt', str(dest))
+    assert dest.read() == 'precious'
+
+def test_restore_missing_path(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+
+    with pytest.raises(LookupError):
+        restore.restore(test_cas, root_hash, '/sub/nonexistent',
+                        str(tmpdir.join('x')))
+    with pytest.raises(LookupError):
+        restore.restore(test_cas, root_hash, '/top.txt/below',
+                        str(tmpdir.join('x')))
+
+def test_restore_reads_only_path_blobs(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+
+    retrieved = []
+    original_retrieve = test_cas.retrieve
+    def counting_retrieve(hash_digest):
+        retrieved.append(hash_digest)
+        return original_retrieve(hash_digest)
+    test_cas.retrieve = counting_retrieve
+
+    restore.restore(test_cas, root_hash, '/sub/deeper/b.sh',
+                    str(tmpdir.join('b.sh')))
+    # root, /sub and /sub/deeper directory blobs, plus the file itself
+    assert len(retrieved) == 4
+
+@pytest.mark.parametrize('max_in_flight', [1, 8])
+def test_restore_detects_corrupted_blob(tmpdir, max_in_flight):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+    with open(test_cas._get_cas_path(hashing.hash_str('file a')), 'wb') as f:
+        f.write('corrupted')
+
+    with pytest.raises(ValueError):
+        restore.restore(test_cas, root_hash, '/', str(tmpdir.mkdir('dest')),
+                        max_in_flight=max_in_flight)
+
+def test_restore_with_force_over_restored_tree(tmpdir):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+    dest = tmpdir.join('restored')
+    restore.restore(test_cas, root_hash, '/', str(dest))
+    with pytest.raises(ValueError):
+        restore.restore(test_cas, root_hash, '/', str(dest))
+
+    dest.join('sub', 'link').remove()
+    dest.join('sub', 'link').mksymlinkto('../top.txt')
+    dest.join('top.txt').remove()
+    dest.join('top.txt').mksymlinkto('sub/a.txt')
+    restore.restore(test_cas, root_hash, '/', str(dest), force=True)
+    assert os.readlink(str(dest.join('sub', 'link'))) == 'a.txt'
+    assert not dest.join('top.txt').islink()
+    assert dest.join('top.txt').read() == 'top level file'
+    assert dest.join('sub', 'a.txt').read() == 'file a'
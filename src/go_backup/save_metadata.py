@@ -1,28 +1,52 @@
 #!/usr/bin/env python
 
 import hashdeep
+import json
 import metadata
 import os.path
 import pattern
+import profiling
+import progress
+import stats
 import sys
+import utils
+
+
+def to_json(value):
+    """Convert a metadata tree (or any nested namedtuples and
+    dictionaries) into JSON-serializable objects that keep the field
+    names."""
+    if hasattr(value, '_asdict'):
+        value = value._asdict()
+    if isinstance(value, dict):
+        return dict((k, to_json(v)) for k, v in value.iteritems())
+    return value
+
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print "usage: %s rootdir patterns_file metadata_file" % sys.argv[0]
+    argv = profiling.handle_options(
+        progress.handle_options(stats.handle_options(sys.argv)))
+    if len(argv) != 4:
+        print "usage: %s [--stats] [--stats-json FILE] [--progress] [--progress-file FILE] [--profile DIR [--profile-memory]] rootdir patterns_file metadata_file" % argv[0]
         sys.exit(1)
 
-    rootdir = os.path.normpath(sys.argv[1])
+    rootdir = os.path.normpath(argv[1])
 
-    patterns_file = open(sys.argv[2])
+    patterns_file = open(argv[2])
     patterns = pattern.parse_pattern_file(patterns_file)
     pathlist = pattern.assemble_paths(rootdir, patterns)
 
-    digests = hashdeep.compute_digests(rootdir, pathlist.filenames)
-    backup_metadata = metadata.get_backup_metadata(rootdir=rootdir,
-                                                   files=pathlist.filenames,
-                                                   symlinks=pathlist.symlinks,
-                                                   directories=pathlist.directories,
-                                                   digest_map=digests)
+    digests = hashdeep.compute_digests(rootdir,
+                                       pattern.unique_filenames(pathlist))
+    pattern.add_hardlink_digests(pathlist, digests)
+    backup_metadata = metadata.get_metadata_tree(rootdir=rootdir,
+                                                 files=pathlist.filenames,
+                                                 symlinks=pathlist.symlinks,
+                                                 directories=pathlist.directories,
+                                                 digest_map=digests,
+                                                 uid_map=utils.get_uid_name_map(),
+                                                 gid_map=utils.get_gid_name_map())
 
-    with open(sys.argv[3], "w") as metadata_file:
-        metadata.write_backup_metadata(metadata_file, backup_metadata)
+    with open(argv[3], "w") as metadata_file:
+        json.dump(to_json(backup_metadata), metadata_file, indent=2,
+                  sort_keys=True)
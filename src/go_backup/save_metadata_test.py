@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+"""Tests for go-backup's save_metadata tool."""
+
+import collections
+import json
+import metadata
+import save_metadata
+
+def test_to_json_keeps_field_names():
+    Digest = collections.namedtuple('Digest', ['sha1', 'sha256'])
+    file_node = metadata.FileNode(name='f', mtime=0, user='root', group='root',
+                                  permissions='0100644',
+                                  hash=Digest('1' * 40, '2' * 64), size=3)
+    root_node = metadata.DirectoryNode(name='', mtime=None, user=None,
+                                       group=None, permissions=None,
+                                       children={'f': file_node})
+    data = json.loads(json.dumps(save_metadata.to_json(root_node)))
+    f = data['children']['f']
+    assert f['name'] == 'f'
+    assert f['size'] == 3
+    assert f['hash'] == {'sha1': '1' * 40, 'sha256': '2' * 64}
+    assert data['mtime'] is None
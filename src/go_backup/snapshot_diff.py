@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""Comparison of two snapshots in a go-backup CAS.
+
+Both snapshots are walked in lock-step through cas_tree. A directory
+whose blob has the same hash in both snapshots is identical in both,
+including everything below it, so it is skipped without reading its
+blob. Comparing two consecutive nightly snapshots therefore only reads
+the blobs of directories that changed in between.
+"""
+
+import os
+
+import cas_tree
+import metadata
+import utils
+
+"""Kinds of results produced by iter_diff."""
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def _subtree(path, node):
+    """Yield the paths of node, which is at path, and its descendants."""
+    yield path
+    for p in cas_tree.iter_descendants(path, node):
+        yield p
+
+
+def iter_diff(old_root, new_root):
+    """Compare two snapshots, yielding differences one directory at a
+    time.
+
+    Args:
+      old_root, new_root: Root nodes of the snapshots, typically from
+        cas_tree.CASTree.root.
+
+    Yields:
+      Pairs (kind, path), where kind is one of ADDED, REMOVED and
+      CHANGED. A path is CHANGED if its type, contents or metadata
+      differ; if its type changed, the descendants of the old and the
+      new node are reported as REMOVED and ADDED, respectively.
+    """
+    stack = [(os.sep, old_root, new_root)]
+    while stack:
+        path, old_dir, new_dir = stack.pop()
+        old_children = cas_tree.transient_children(old_dir)
+        new_children = cas_tree.transient_children(new_dir)
+        subdirectories = []
+        for name, in_old, in_new in utils.merge_sorted_names(
+                sorted(old_children), sorted(new_children)):
+            p = os.path.join(path, name)
+            if not in_old:
+                for q in _subtree(p, new_children[name]):
+                    yield ADDED, q
+                continue
+            if not in_new:
+                for q in _subtree(p, old_children[name]):
+                    yield REMOVED, q
+                continue
+
+            old, new = old_children[name], new_children[name]
+            old_is_dir = isinstance(old, metadata.DirectoryNode)
+            new_is_dir = isinstance(new, metadata.DirectoryNode)
+            if old_is_dir and new_is_dir:
+                # Children are compared separately.
+                if old[:-1] != new[:-1]:
+                    yield CHANGED, p
+                if (not isinstance(old, cas_tree.LazyDirectoryNode) or
+                        not isinstance(new, cas_tree.LazyDirectoryNode) or
+                        old.hash != new.hash):
+                    subdirectories.append((p, old, new))
+            elif type(old) is not type(new):
+                yield CHANGED, p
+                for q in cas_tree.iter_descendants(p, old):
+                    yield REMOVED, q
+                for q in cas_tree.iter_descendants(p, new):
+                    yield ADDED, q
+            elif old != new:
+                yield CHANGED, p
+
+        stack.extend(reversed(subdirectories))
+
+
+def main(argv):
+    if len(argv) != 4:
+        print "usage: %s cas_root old_hash new_hash" % argv[0]
+        return 1
+
+    import cas
+    tree = cas_tree.CASTree(cas.CAS(os.path.abspath(argv[1])))
+    for kind, path in iter_diff(tree.root(argv[2]), tree.root(argv[3])):
+        print '{}: {}'.format(kind, path)
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main(sys.argv))
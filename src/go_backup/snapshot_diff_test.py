@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Tests for go-backup snapshot comparison."""
+
+import cas
+import cas_tree
+import snapshot_diff
+from restore_test import backup_directory, make_source
+
+def test_diff(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    deeper_mtime = source.join('sub', 'deeper').mtime()
+    old_hash = backup_directory(source, test_cas)
+
+    source.join('top.txt').write('changed')
+    source.join('sub', 'deeper', 'b.sh').remove()
+    source.join('sub', 'deeper').join('b.sh').mkdir().join('c').write('c')
+    source.mkdir('new').join('n').write('n')
+    source.join('sub', 'link').remove()
+    # directory metadata changes are reported, too
+    source.join('sub').setmtime(1000000000)
+    source.join('sub', 'deeper').setmtime(deeper_mtime)
+    new_hash = backup_directory(source, test_cas)
+
+    tree = cas_tree.CASTree(test_cas)
+    assert list(snapshot_diff.iter_diff(tree.root(old_hash),
+                                        tree.root(new_hash))) == [
+        (snapshot_diff.ADDED, '/new'),
+        (snapshot_diff.ADDED, '/new/n'),
+        (snapshot_diff.CHANGED, '/sub'),
+        (snapshot_diff.CHANGED, '/top.txt'),
+        (snapshot_diff.REMOVED, '/sub/link'),
+        (snapshot_diff.CHANGED, '/sub/deeper/b.sh'),
+        (snapshot_diff.ADDED, '/sub/deeper/b.sh/c'),
+    ]
+    assert list(snapshot_diff.iter_diff(tree.root(new_hash),
+                                        tree.root(new_hash))) == []
+
+def test_diff_skips_unchanged_subtrees(tmpdir):
+    source = make_source(tmpdir)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    old_hash = backup_directory(source, test_cas)
+    source.join('top.txt').write('changed')
+    new_hash = backup_directory(source, test_cas)
+
+    tree = cas_tree.CASTree(test_cas)
+    assert list(snapshot_diff.iter_diff(tree.root(old_hash),
+                                        tree.root(new_hash))) == [
+        (snapshot_diff.CHANGED, '/top.txt')]
+    # only the two root blobs were read
+    assert tree.cache.misses == 2
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+"""Space accounting of the snapshots in a go-backup CAS.
+
+For each snapshot in the catalog, space_usage computes
+  - its logical size: the total size of its files, as restored;
+  - its deduplicated size: the total size of the distinct file
+    contents (or chunks) it references, i.e. what storing it alone
+    would take;
+  - its unique size: the total size of the contents that no other
+    snapshot references, i.e. what deleting it would free.
+
+Sizes are taken from the size fields of directory entries (and, for
+chunked files, from their chunk lists); blobs are never stat'ed, and
+sizes are uncompressed. Directory blobs themselves are not counted.
+Whether a file is chunked is told by the header of its blob, which is
+read once for each distinct file.
+
+All snapshots are accounted for in one pass over the distinct
+directory blobs, which are shared between snapshots whenever a
+subtree did not change, so each of them is read only once however
+many snapshots contain it. Subtree totals are cached by the hash of
+the directory blob. Which snapshots reference a blob is tracked as a
+bit mask over the snapshots, pushed from the roots down the directory
+graph in topological order.
+"""
+
+import collections
+import os
+import sys
+
+import async_cas
+import cas
+import cas_tree
+import catalog
+import stats
+
+"""Space accounting of one snapshot (a catalog.Snapshot); sizes are in
+bytes."""
+SpaceUsage = collections.namedtuple('SpaceUsage', [
+    'snapshot', 'files', 'logical_bytes', 'deduplicated_bytes',
+    'unique_bytes'])
+
+
+def _walk_directories(tree, root_hashes):
+    """Read each distinct directory blob reachable from root_hashes once.
+
+    Returns:
+      A tuple (order, children, files): the hashes of all directory
+      blobs, each after all directories it contains; a dictionary
+      mapping them to the list of hashes of their subdirectories; and
+      a dictionary mapping them to the list of pairs (hash, size) of
+      their files.
+    """
+    order = []
+    children = {}
+    files = {}
+    stack = [(root_hash, False) for root_hash in reversed(root_hashes)]
+    while stack:
+        hash_digest, expanded = stack.pop()
+        if expanded:
+            order.append(hash_digest)
+            continue
+        if hash_digest in children:
+            continue
+        entries = tree.entries(hash_digest)
+        stats.count('space.directories')
+        children[hash_digest] = [entry['hash'] for entry in entries
+                                 if entry['type'] == 'directory']
+        files[hash_digest] = [(entry['hash'], entry['size'])
+                              for entry in entries if entry['type'] == 'file']
+        stack.append((hash_digest, True))
+        for child in children[hash_digest]:
+            if child not in children:
+                tree.prefetch(child)
+                stack.append((child, False))
+    return order, children, files
+
+
+def _subtree_totals(order, children, files):
+    """Return a dictionary mapping directory blob hashes to the number
+    and total size of the files in their subtrees."""
+    totals = {}
+    for hash_digest in order:
+        num_files = len(files[hash_digest])
+        num_bytes = sum(size for _, size in files[hash_digest])
+        for child in children[hash_digest]:
+            child_files, child_bytes = totals[child]
+            num_files += child_files
+            num_bytes += child_bytes
+        totals[hash_digest] = (num_files, num_bytes)
+    return totals
+
+
+def _chunk_list(source_cas, hash_digest):
+    try:
+        return source_cas.chunk_list(hash_digest)
+    except LookupError:
+        # counted as a plain blob; gc --check reports missing blobs
+        stats.count('space.missing_blobs')
+        return None
+
+
+def _chunk_lists(source_cas, async_source, file_digests, max_in_flight):
+    """Return a dictionary mapping the hashes of those files that are
+    stored in chunks (see CAS.chunk_list) to their chunk lists."""
+    chunk_lists = {}
+    in_flight = collections.deque()
+    for hash_digest in file_digests:
+        in_flight.append((hash_digest, async_source.submit(
+            _chunk_list, source_cas, hash_digest)))
+        while in_flight and (len(in_flight) >= max_in_flight or
+                             in_flight[0][1].ready()):
+            digest, result = in_flight.popleft()
+            chunks = result.get()
+            if chunks is not None:
+                chunk_lists[digest] = chunks
+    while in_flight:
+        digest, result = in_flight.popleft()
+        chunks = result.get()
+        if chunks is not None:
+            chunk_lists[digest] = chunks
+    return chunk_lists
+
+
+def space_usage(source_cas, snapshots=None,
+                max_in_flight=async_cas.DEFAULT_MAX_IN_FLIGHT):
+    """Compute the space accounting of snapshots.
+
+    Args:
+      source_cas: CAS holding the snapshots.
+      snapshots: List of catalog.Snapshots; by default all snapshots in
+        the catalog. Unique sizes are relative to these snapshots.
+      max_in_flight: Number of blobs read at the same time.
+
+    Returns:
+      A pair of the list of SpaceUsages, in the order of snapshots, and
+      the deduplicated size of all snapshots together.
+    """
+    if snapshots is None:
+        snapshots = catalog.Catalog(source_cas.root).snapshots()
+    root_hashes = list(collections.OrderedDict.fromkeys(
+        snapshot.root_hash for snapshot in snapshots))
+
+    with async_cas.AsyncCAS(source_cas, max_in_flight) as async_source:
+        tree = cas_tree.CASTree(source_cas, async_source=async_source)
+        order, children, files = _walk_directories(tree, root_hashes)
+        # Any file may be stored in chunks, whatever its size, as the
+        # chunk size is chosen when the file is stored.
+        chunk_lists = _chunk_lists(
+            source_cas, async_source,
+            set(digest for entries in files.itervalues()
+                for digest, _ in entries),
+            max_in_flight)
+    totals = _subtree_totals(order, children, files)
+
+    # bit i of a mask stands for snapshots[i]
+    masks = collections.defaultdict(int)
+    for i, snapshot in enumerate(snapshots):
+        masks[snapshot.root_hash] |= 1 << i
+    blob_masks = collections.defaultdict(int)
+    blob_sizes = {}
+    for hash_digest in reversed(order):
+        # all directories containing this one have been visited
+        mask = masks.pop(hash_digest)
+        for child in children.pop(hash_digest):
+            masks[child] |= mask
+        for file_digest, size in files.pop(hash_digest):
+            for blob_digest, blob_size in chunk_lists.get(
+                    file_digest, [(file_digest, size)]):
+                blob_masks[blob_digest] |= mask
+                blob_sizes[blob_digest] = blob_size
+
+    # Blobs referenced by the same snapshots are summed up first.
+    bytes_by_mask = collections.defaultdict(int)
+    for blob_digest, mask in blob_masks.iteritems():
+        bytes_by_mask[mask] += blob_sizes[blob_digest]
+    deduplicated = [0] * len(snapshots)
+    unique = [0] * len(snapshots)
+    for mask, num_bytes in bytes_by_mask.iteritems():
+        i = 0
+        while mask >> i:
+            if (mask >> i) & 1:
+                deduplicated[i] += num_bytes
+            i += 1
+        if mask & (mask - 1) == 0:
+            unique[mask.bit_length() - 1] += num_bytes
+
+    usages = [SpaceUsage(snapshot, totals[snapshot.root_hash][0],
+                         totals[snapshot.root_hash][1], deduplicated[i],
+                         unique[i])
+              for i, snapshot in enumerate(snapshots)]
+    return usages, sum(bytes_by_mask.itervalues())
+
+
+def format_usage(usage):
+    return '{}; {} bytes deduplicated, {} bytes unique'.format(
+        catalog.format_snapshot(usage.snapshot), usage.deduplicated_bytes,
+        usage.unique_bytes)
+
+
+def main(argv):
+    argv = stats.handle_options(argv)
+    if len(argv) != 2:
+        print "usage: %s [--stats] [--stats-json FILE] cas_root" % argv[0]
+        return 1
+
+    source_cas = cas.CAS(os.path.abspath(argv[1]))
+    usages, total = space_usage(source_cas)
+    for usage in usages:
+        print format_usage(usage)
+    print 'total deduplicated size of {} snapshots: {} bytes'.format(
+        len(usages), total)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
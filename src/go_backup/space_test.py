@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""Tests for go-backup space accounting."""
+
+import backup
+import cas
+import hashing
+import space
+from restore_test import make_source
+
+def test_space_usage(tmpdir):
+    source = make_source(tmpdir)
+    source.join('sub', 'copy.txt').write('file a')
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    first = backup.backup(test_cas, str(source), [])
+    source.join('sub', 'deeper', 'b.sh').write('changed')
+    second = backup.backup(test_cas, str(source), [])
+    third = backup.backup(test_cas, str(source), [])
+
+    usages, total = space.space_usage(test_cas)
+    assert [u.snapshot for u in usages] == [first, second, third]
+    shared = len('top level file') + len('file a')
+    # the copy is only counted in the logical size
+    assert usages[0] == space.SpaceUsage(first, 4, first.bytes,
+                                         shared + len('#!/bin/sh\n'),
+                                         len('#!/bin/sh\n'))
+    assert first.bytes == shared + len('file a') + len('#!/bin/sh\n')
+    # the second and third snapshot are the same
+    assert usages[1] == space.SpaceUsage(second, 4, second.bytes,
+                                         shared + len('changed'), 0)
+    assert usages[2].unique_bytes == 0
+    assert total == shared + len('#!/bin/sh\n') + len('changed')
+
+    # unique sizes are relative to the snapshots given
+    usages, total = space.space_usage(test_cas, [first, second])
+    assert usages[1].unique_bytes == len('changed')
+
+def test_space_usage_of_chunked_files(tmpdir):
+    # chunked with a chunk size other than cas.CHUNK_SIZE, and smaller
+    # than it
+    source = tmpdir.mkdir('source')
+    contents = 'x' * 2500 + 'y' * 2500
+    source.join('big').write(contents)
+    test_cas = cas.CAS(str(tmpdir.join('cas')))
+    cas.store_chunked_file(test_cas, str(source.join('big')),
+                           hashing.hash_str(contents), chunk_size=1000)
+    snapshot = backup.backup(test_cas, str(source), [])
+
+    usages, total = space.space_usage(test_cas)
+    # chunks of x, x and y, and y
+    assert usages == [space.SpaceUsage(snapshot, 1, 5000, 3000, 3000)]
+    assert total == 3000
+
+def test_main(tmpdir, capsys):
+    source = make_source(tmpdir)
+    cas_root = str(tmpdir.join('cas'))
+    snapshot = backup.backup(cas.CAS(cas_root), str(source), [])
+    assert space.main(['space', cas_root]) == 0
+    out = capsys.readouterr().out
+    assert snapshot.root_hash in out
+    assert '{} bytes deduplicated, {} bytes unique'.format(
+        snapshot.bytes, snapshot.bytes) in out
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Support for sparse files.
+
+VM disk images and database files often consist mostly of holes,
+ranges that were never written and read as zeros without occupying
+disk space. iter_blocks finds the holes of a file with lseek(2)'s
+SEEK_DATA and SEEK_HOLE and produces zeros for them instead of reading
+them, and write_blocks re-creates holes by seeking over blocks of
+zeros instead of writing them. The blocks produced are exactly the
+contents of the file, so hashes are the same as for a plain read.
+
+On file systems (or kernels) without SEEK_DATA, a file is treated as
+one data region and read in full.
+"""
+
+import errno
+import os
+import stat
+
+import stats
+
+"""Values of lseek's whence for finding data and holes on Linux; the os
+module of Python 2 does not define them."""
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+_zero_blocks = {}
+
+
+def _zeros(size):
+    block = _zero_blocks.get(size)
+    if block is None:
+        block = _zero_blocks[size] = '\0' * size
+    return block
+
+
+def iter_regions(fd, start, end):
+    """Yield triples (start, stop, is_hole) that cover the range from
+    start to end of the open file fd in order."""
+    offset = start
+    while offset < end:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # nothing but a hole up to the end of the file
+                data = end
+            elif e.errno in (errno.EINVAL, errno.EOPNOTSUPP):
+                yield offset, end, False
+                return
+            else:
+                raise
+        data = min(data, end)
+        if data > offset:
+            yield offset, data, True
+        if data >= end:
+            return
+        hole = min(os.lseek(fd, data, SEEK_HOLE), end)
+        yield data, hole, False
+        offset = hole
+
+
+def iter_blocks(fileobj, block_size):
+    """Read a file-like object from its current position to its end.
+
+    Args:
+      fileobj: A file-like object. Only (real) file objects can have
+        holes.
+      block_size: Maximum size of the blocks produced. Blocks are
+        only shorter at the boundaries of holes and at the end.
+
+    Yields:
+      Pairs (data, is_hole). Holes are not read; their data is a
+      string of zeros.
+    """
+    st = os.fstat(fileobj.fileno()) if isinstance(fileobj, file) else None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        # Read until read() returns nothing, which e.g.
+        # hashing.VerifyingReader relies on.
+        while True:
+            parts = []
+            remaining = block_size
+            while remaining > 0:
+                data = fileobj.read(remaining)
+                if not data:
+                    break
+                parts.append(data)
+                remaining -= len(data)
+            if not parts:
+                return
+            yield ''.join(parts), False
+
+    fd = fileobj.fileno()
+    end = st.st_size
+    for start, stop, is_hole in iter_regions(fd, fileobj.tell(), end):
+        if is_hole:
+            stats.count('sparse.hole_bytes', stop - start)
+            while start < stop:
+                size = min(block_size, stop - start)
+                yield _zeros(size), True
+                start += size
+            continue
+        fileobj.seek(start)
+        while start < stop:
+            data = fileobj.read(min(block_size, stop - start))
+            if not data:
+                # the file shrank while it was being read
+                return
+            yield data, False
+            start += len(data)
+
+
+def is_zero(data):
+    """Return whether a string consists of zeros only."""
+    return data.count('\0') == len(data)
+
+
+def write_blocks(blocks, fileobj):
+    """Write blocks to a file, creating holes for blocks of zeros.
+
+    Args:
+      blocks: Iterable of pairs (data, is_hole) as produced by
+        iter_blocks. Blocks with is_hole set must be zeros; other
+        blocks that are zeros become holes, too.
+      fileobj: File object opened for writing, positioned at the
+        beginning of the data to write.
+
+    Yields:
+      The data of each block, after it was written.
+    """
+    seeked = False
+    for data, is_hole in blocks:
+        if is_hole or is_zero(data):
+            fileobj.seek(len(data), os.SEEK_CUR)
+            seeked = True
+        else:
+            fileobj.write(data)
+            seeked = False
+        yield data
+    if seeked:
+        # Seeking past the end does not extend a file.
+        fileobj.truncate()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""Tests for go-backup's sparse file support."""
+
+import cas
+import hashing
+import metadata
+import os
+import pytest
+import restore
+import sparse
+import StringIO
+
+MIB = 1024 * 1024
+
+def make_sparse_file(path):
+    """Create a 16 MiB file with 4 KiB of data at 5 MiB and holes
+    elsewhere; return its contents."""
+    with open(path, 'wb') as f:
+        f.truncate(16 * MIB)
+        f.seek(5 * MIB)
+        f.write('x' * 4096)
+    return '\0' * (5 * MIB) + 'x' * 4096 + '\0' * (11 * MIB - 4096)
+
+def allocated_bytes(path):
+    return os.stat(path).st_blocks * 512
+
+def test_iter_blocks(tmpdir):
+    path = str(tmpdir.join('sparse'))
+    contents = make_sparse_file(path)
+    with open(path, 'rb') as f:
+        blocks = list(sparse.iter_blocks(f, MIB))
+    assert ''.join(data for data, _ in blocks) == contents
+    if allocated_bytes(path) >= len(contents):
+        pytest.skip('The file system does not support sparse files.')
+    assert blocks[0] == ('\0' * MIB, True)
+    assert ('x' * 4096, False) in blocks
+
+def test_iter_blocks_of_other_file_objects():
+    blocks = list(sparse.iter_blocks(StringIO.StringIO('abcde'), 2))
+    assert blocks == [('ab', False), ('cd', False), ('e', False)]
+
+def test_hash_store_and_restore_sparse_file(tmpdir):
+    path = str(tmpdir.join('sparse'))
+    contents = make_sparse_file(path)
+    digest = hashing.hash_str(contents)
+    with open(path, 'rb') as f:
+        assert hashing.hash_fileobj(f) == digest
+
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    with open(path, 'rb') as f:
+        test_cas.store(f, digest)
+    blob_path = test_cas._get_cas_path(digest)
+    assert os.path.getsize(blob_path) == len(contents)
+    with test_cas.retrieve(digest) as blob:
+        assert blob.read() == contents
+
+    restored = str(tmpdir.join('restored'))
+    node = metadata.FileNode('sparse', 1400000000, 'root', 'root',
+                             '0100644', digest, len(contents))
+    restore._restore_file(test_cas, node, restored)
+    with open(restored, 'rb') as f:
+        assert f.read() == contents
+    if allocated_bytes(path) < len(contents):
+        assert allocated_bytes(blob_path) < MIB
+        assert allocated_bytes(restored) < MIB
+
+def test_write_blocks_trailing_hole(tmpdir):
+    path = str(tmpdir.join('out'))
+    with open(path, 'wb') as f:
+        written = list(sparse.write_blocks([('data', False), ('\0' * 100, True)],
+                                           f))
+    assert written == ['data', '\0' * 100]
+    with open(path, 'rb') as f:
+        assert f.read() == 'data' + '\0' * 100
+
+def test_compressed_store_of_sparse_file(tmpdir):
+    path = str(tmpdir.join('sparse'))
+    contents = make_sparse_file(path)
+    digest = hashing.hash_str(contents)
+    test_cas = cas.CAS(tmpdir.mkdir('cas'), compression='zlib')
+    with open(path, 'rb') as f:
+        test_cas.store(f, digest)
+    assert os.path.getsize(test_cas._get_cas_path(digest)) < MIB
+    with test_cas.retrieve(digest) as blob:
+        assert hashing.hash_fileobj(blob) == digest
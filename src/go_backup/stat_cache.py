@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Cache of file hashes keyed by stat data, for fast re-verification.
+
+The cache of a restored tree lives outside of it, in a file named
+after the hash of the tree's path in the STAT_CACHE_DIRECTORY of the
+user's cache directory ($XDG_CACHE_HOME, by default ~/.cache). It thus
+neither collides with anything a snapshot may contain nor shows up when
+the tree is verified. For every file it records the size,
+mtime, inode number and ctime the file had when its hash was last
+computed or verified. If all four are unchanged, the file's contents
+are assumed unchanged, too; in particular, changing a file's contents
+through any normal means updates its ctime.
+
+Trusting stat data does not protect against bit rot, which changes
+contents without touching any timestamps. To cover it, every run
+re-hashes a rotating sample of the files regardless of the cache: a
+file belongs to bucket HASH(path) mod SAMPLE_PERIOD, and run number r
+re-hashes bucket r mod SAMPLE_PERIOD. Every file is thus re-hashed at
+least once every SAMPLE_PERIOD runs.
+"""
+
+import json
+import os
+
+import hashing
+import stats
+import utils
+
+STAT_CACHE_DIRECTORY = os.path.join('go-backup', 'stat_cache')
+SAMPLE_PERIOD = 32
+
+
+class StatCache(object):
+
+    def __init__(self, run=0, files=None):
+        """Create a stat cache.
+
+        Args:
+          run: Number of the current run, used to select the sample.
+          files: Dictionary mapping paths to lists [size, mtime, inode,
+            ctime, hash digest].
+        """
+        self.run = run
+        self.files = files if files is not None else {}
+
+    def lookup(self, path, stat):
+        """Return the cached hash of path if its stat data is unchanged
+        and it is not in the current sample, and None otherwise."""
+        entry = self.files.get(path)
+        if (entry is None or entry[:4] != stat_key(stat) or
+            in_sample(path, self.run)):
+            stats.count('stat_cache.misses')
+            return None
+        stats.count('stat_cache.hits')
+        return entry[4]
+
+    def record(self, path, stat, hash_digest):
+        self.files[path] = stat_key(stat) + [hash_digest]
+
+
+def stat_key(stat):
+    return [stat.st_size, stat.st_mtime, stat.st_ino, stat.st_ctime]
+
+
+def in_sample(path, run):
+    bucket = int(hashing.hash_str(path)[:8], 16) % SAMPLE_PERIOD
+    return bucket == run % SAMPLE_PERIOD
+
+
+def cache_path(rootdir):
+    """Return the native path of the stat cache of a restored tree."""
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    rootdir = os.path.normpath(os.path.abspath(rootdir))
+    return os.path.join(cache_home, STAT_CACHE_DIRECTORY,
+                        hashing.hash_str(rootdir))
+
+
+def load(rootdir):
+    """Load the stat cache of a restored tree.
+
+    Returns:
+      The StatCache for the next run. If there is no cache (or it
+      cannot be read), an empty cache is returned.
+    """
+    try:
+        with open(cache_path(rootdir), 'rb') as f:
+            data = json.load(f)
+    except (IOError, ValueError):
+        return StatCache()
+    files = dict((path.encode('utf-8'), entry[:4] + [str(entry[4])])
+                 for path, entry in data['files'].iteritems())
+    return StatCache(data['run'] + 1, files)
+
+
+def save(rootdir, cache):
+    """Atomically replace the stat cache of a restored tree."""
+    native_path = cache_path(rootdir)
+    utils.mkdir_p(os.path.dirname(native_path))
+    temp_path = native_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        json.dump({'run': cache.run, 'files': cache.files}, f)
+    os.rename(temp_path, native_path)
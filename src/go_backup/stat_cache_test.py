@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Tests for go-backup's stat cache."""
+
+import os
+import stat_cache
+
+def test_lookup(tmpdir):
+    f = tmpdir.join('f')
+    f.write('contents')
+    cache = stat_cache.StatCache()
+    path = '/f'
+    # pick a run for which /f is not in the sample
+    while stat_cache.in_sample(path, cache.run):
+        cache.run += 1
+    cache.record(path, os.lstat(str(f)), 'digest')
+
+    assert cache.lookup(path, os.lstat(str(f))) == 'digest'
+    assert cache.lookup('/g', os.lstat(str(f))) is None
+
+    f.write('changed contents')
+    assert cache.lookup(path, os.lstat(str(f))) is None
+
+def test_sample_rotates():
+    paths = ['/file%d' % i for i in xrange(200)]
+    sampled = set()
+    for run in xrange(stat_cache.SAMPLE_PERIOD):
+        sampled.update(p for p in paths if stat_cache.in_sample(p, run))
+    assert sampled == set(paths)
+
+def test_save_load(tmpdir):
+    cache = stat_cache.StatCache(run=5)
+    f = tmpdir.join('f')
+    f.write('contents')
+    cache.record('/f', os.lstat(str(f)), 'digest')
+    stat_cache.save(str(tmpdir), cache)
+
+    loaded = stat_cache.load(str(tmpdir))
+    assert loaded.run == 6
+    assert loaded.files == cache.files
+
+def test_load_missing(tmpdir):
+    cache = stat_cache.load(str(tmpdir))
+    assert cache.run == 0
+    assert cache.files == {}
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""Instrumentation of go-backup runs.
+
+Code that does measurable work wraps it in stage(name), or decorates
+it with timed(name), and reports what it did with count(name, n).
+Counter names are dotted, e.g.
+'hashing.bytes_read'; the following conventions give rise to derived
+values in the report:
+  - '<stage>.files' and '<stage>.bytes_*' counters are also reported
+    per second of wall time of <stage>;
+  - '<name>.hits' and '<name>.misses' are reported as a hit rate;
+  - 'syscalls.<call>' counts file system calls issued by go-backup.
+
+Instrumentation is disabled by default, in which case stage() returns
+a shared no-op context manager and count() returns immediately.
+enable() turns it on for the rest of the run; handle_options() does so
+for command line tools that accept --stats and --stats-json FILE.
+
+Worker processes (e.g. of hashing.hash_list_of_files) do not report
+to this module directly; their callers count the work on their behalf.
+"""
+
+import atexit
+import collections
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        # Maps stage names to [wall time, CPU time, number of calls].
+        self.stages = collections.OrderedDict()
+        self.counters = collections.defaultdict(int)
+
+
+_stats = _Stats()
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self._name = name
+
+    def __enter__(self):
+        self._wall = time.time()
+        self._cpu = _cpu_time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self._wall
+        cpu = _cpu_time() - self._cpu
+        with _stats.lock:
+            totals = _stats.stages.setdefault(self._name, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += 1
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def _cpu_time():
+    """Return user plus system time of this process and its waited-for
+    children."""
+    t = os.times()
+    return t[0] + t[1] + t[2] + t[3]
+
+
+def enable():
+    """Start collecting statistics, discarding any collected so far."""
+    _stats.reset()
+    _stats.enabled = True
+
+
+def disable():
+    _stats.enabled = False
+
+
+def is_enabled():
+    return _stats.enabled
+
+
+def stage(name):
+    """Return a context manager that records the wall and CPU time spent
+    in it under the given stage name."""
+    if not _stats.enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def timed(name):
+    """Decorator recording each call of a function as the named stage."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Add n to the named counter."""
+    if not _stats.enabled:
+        return
+    with _stats.lock:
+        _stats.counters[name] += n
+
+
+def _peak_rss_bytes(who):
+    rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux, but in bytes on OS X.
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+def report():
+    """Return the statistics collected so far as a JSON-serializable
+    dictionary."""
+    with _stats.lock:
+        stages = dict((name, {'wall_seconds': wall, 'cpu_seconds': cpu,
+                              'calls': calls})
+                      for name, (wall, cpu, calls) in _stats.stages.iteritems())
+        counters = dict(_stats.counters)
+
+    rates = {}
+    for name, value in counters.iteritems():
+        prefix, _, suffix = name.rpartition('.')
+        if (suffix == 'files' or suffix.startswith('bytes_')) and prefix in stages:
+            wall = stages[prefix]['wall_seconds']
+            if wall > 0:
+                rates[name + '_per_second'] = value / wall
+
+    hit_rates = {}
+    for name in counters:
+        if name.endswith('.hits'):
+            prefix = name[:-len('.hits')]
+            total = counters[name] + counters.get(prefix + '.misses', 0)
+            hit_rates[prefix] = float(counters[name]) / total if total else 0.0
+
+    return {
+        'wall_seconds': time.time() - _stats.start_time,
+        'stages': stages,
+        'counters': counters,
+        'rates': rates,
+        'hit_rates': hit_rates,
+        'peak_rss_bytes': _peak_rss_bytes(resource.RUSAGE_SELF),
+        'peak_rss_children_bytes': _peak_rss_bytes(resource.RUSAGE_CHILDREN),
+    }
+
+
+def format_report(data):
+    """Format the result of report() as human-readable text."""
+    lines = ['Statistics (total wall time {:.2f}s):'.format(data['wall_seconds'])]
+    if data['stages']:
+        lines.append('  {:<24} {:>10} {:>10} {:>8}'.format(
+            'stage', 'wall s', 'cpu s', 'calls'))
+        for name in sorted(data['stages']):
+            s = data['stages'][name]
+            lines.append('  {:<24} {:>10.3f} {:>10.3f} {:>8}'.format(
+                name, s['wall_seconds'], s['cpu_seconds'], s['calls']))
+    for name in sorted(data['counters']):
+        line = '  {:<40} {:>14}'.format(name, data['counters'][name])
+        rate = data['rates'].get(name + '_per_second')
+        if rate is not None:
+            line += '  ({:.1f}/s)'.format(rate)
+        lines.append(line)
+    for name in sorted(data['hit_rates']):
+        lines.append('  {:<40} {:>13.1f}%'.format(name + ' hit rate',
+                                                  100 * data['hit_rates'][name]))
+    lines.append('  peak RSS: {:.1f} MiB (children: {:.1f} MiB)'.format(
+        data['peak_rss_bytes'] / 1048576.0,
+        data['peak_rss_children_bytes'] / 1048576.0))
+    return '\n'.join(lines)
+
+
+def handle_options(argv):
+    """Handle the --stats and --stats-json FILE command line options.
+
+    If either option is present, statistics are enabled and reported
+    when the program exits: as text on stderr for --stats and as JSON
+    written to FILE for --stats-json.
+
+    Returns:
+      argv with these options removed.
+    """
+    remaining = []
+    text = False
+    json_path = None
+    args = iter(argv)
+    for arg in args:
+        if arg == '--stats':
+            text = True
+        elif arg == '--stats-json':
+            json_path = next(args)
+        elif arg.startswith('--stats-json='):
+            json_path = arg[len('--stats-json='):]
+        else:
+            remaining.append(arg)
+
+    if text or json_path is not None:
+        enable()
+
+        def write_report():
+            data = report()
+            if text:
+                print >>sys.stderr, format_report(data)
+            if json_path is not None:
+                with open(json_path, 'w') as f:
+                    json.dump(data, f, indent=2, sort_keys=True)
+        atexit.register(write_report)
+
+    return remaining
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""Tests for go-backup's instrumentation."""
+
+import json
+import pytest
+import stats
+
+@pytest.fixture
+def enabled_stats():
+    stats.enable()
+    yield
+    stats.disable()
+
+def test_disabled_by_default():
+    assert not stats.is_enabled()
+    with stats.stage('nothing'):
+        stats.count('nothing.files')
+    stats.enable()
+    try:
+        assert stats.report()['counters'] == {}
+        assert stats.report()['stages'] == {}
+    finally:
+        stats.disable()
+
+def test_stages_and_counters(enabled_stats):
+    @stats.timed('work')
+    def work():
+        stats.count('work.files', 10)
+        stats.count('work.bytes_read', 1000)
+        stats.count('syscalls.lstat')
+
+    work()
+    work()
+    stats.count('cache.hits', 3)
+    stats.count('cache.misses', 1)
+
+    data = stats.report()
+    assert data['stages']['work']['calls'] == 2
+    assert data['counters'] == {'work.files': 20, 'work.bytes_read': 2000,
+                                'syscalls.lstat': 2, 'cache.hits': 3,
+                                'cache.misses': 1}
+    assert 'work.files_per_second' in data['rates']
+    assert data['hit_rates'] == {'cache': 0.75}
+    assert data['peak_rss_bytes'] > 0
+    # the report is valid JSON and can be formatted as text
+    json.dumps(data)
+    text = stats.format_report(data)
+    assert 'work.files' in text
+    assert 'cache hit rate' in text
+
+def test_handle_options(tmpdir):
+    argv = stats.handle_options(['prog', '--stats-json', str(tmpdir.join('s')),
+                                 'arg1', 'arg2'])
+    try:
+        assert argv == ['prog', 'arg1', 'arg2']
+        assert stats.is_enabled()
+    finally:
+        stats.disable()
+    assert stats.handle_options(['prog', 'arg']) == ['prog', 'arg']
@@ -86,3 +86,20 @@ def mkdir_p(directory):
     except OSError as e:
         if e.errno != errno.EEXIST:
             raise e
+
+
+def merge_sorted_names(first, second):
+    """Merge two sorted lists of names, yielding (name, in_first,
+    in_second) in sorted order."""
+    i = j = 0
+    while i < len(first) or j < len(second):
+        if j == len(second) or (i < len(first) and first[i] < second[j]):
+            yield first[i], True, False
+            i += 1
+        elif i == len(first) or second[j] < first[i]:
+            yield second[j], False, True
+            j += 1
+        else:
+            yield first[i], True, True
+            i += 1
+            j += 1
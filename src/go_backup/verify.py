@@ -1,8 +1,12 @@
 #!/usr/bin/env python
-import hashdeep
-import itertools
+import async_cas
+import cas_tree
+import hashing
 import metadata
 import os
+import profiling
+import stat_cache
+import stats
 import utils
 from collections import namedtuple
 
@@ -10,59 +14,16 @@ VerificationResult = namedtuple('VerificationResult', ['changed', 'missing',
                                                        'unexpected',
                                                        'scan_errors'])
 
-ScanResult = namedtuple('ScanResult', ['files', 'symlinks', 'directories',
-                                       'errors', 'ignored'])
-
-def scan_backup(rootdir):
-    files = []
-    symlinks = []
-    directories = []
-    errors = []
-    ignored = []
-
-    def listdir_onerror(error):
-        errors.append(error)
-
-    rootdir = os.path.normpath(rootdir)
-    if os.path.isdir(rootdir):
-        directories.append(os.sep)
-    else:
-        raise ValueError('The root is not a directory, which should not happen.')
-
-    # Now recursively traverse the file system
-    for root, cur_dirs, cur_files in os.walk(rootdir,
-                                             topdown=True,
-                                             onerror=listdir_onerror,
-                                             followlinks=False):
-        for f in itertools.chain(cur_files, cur_dirs):
-            native_path = os.path.join(root, f)
-            path = utils.get_path_from_native_path(rootdir, native_path)
-            if path == '/.go_backup':
-                ignored.append(path)
-            elif os.path.islink(native_path):
-                symlinks.append(path)
-            elif os.path.isfile(native_path):
-                files.append(path)
-            elif os.path.isdir(native_path):
-                directories.append(path)
-            else:
-                ignored.append(path)
-        # Also, we remove all mount points from dirs so that os.walk does not
-        # recurse into a different file system.
-        cur_dirs[:] = [d for d in cur_dirs if not os.path.ismount(os.path.join(rootdir, d))]
-
-    return ScanResult(files, symlinks, directories, errors, ignored)
-
-
 transient_metadata = ['mtime', 'user', 'group', 'permissions']
 
 def strict_metadata(mdata):
     """Returns metadata items that are not considered transient, in particular, it
-    will return hashes/sizes for files and native targets for symlinks."""
+    will return hashes/sizes for files and native targets for symlinks.
+    Children of directories are compared separately and thus omitted."""
     d = mdata._asdict()
     result = {}
     for k in d.keys():
-        if k not in transient_metadata:
+        if k not in transient_metadata and k != 'children':
             result[k] = d[k]
     return result
 
@@ -71,62 +32,273 @@ def lenient_match(mdata1, mdata2):
     return strict_metadata(mdata1) == strict_metadata(mdata2)
 
 
-def verify_backup(rootdir, mdata, num_threads=None):
-    # Results
-    changed = []
-    missing = []
-    unexpected = []
-    scan_errors = []
+def compute_digests(rootdir, files, cache, num_threads=None):
+    """Return a dict with (path, digest) for all files.
+
+    Files whose stat data matches the stat cache are not read; their
+    digest is taken from the cache. The cache is updated with the
+    stat data and digests of all files.
+
+    Args:
+      rootdir: Root of the restored tree.
+      files: List of paths of files.
+      cache: stat_cache.StatCache, or None to re-hash every file
+        without recording anything.
+      num_threads: Number of parallel hashing processes.
+    """
+    if cache is None:
+        native_paths = [utils.build_native_path(rootdir, f) for f in files]
+        return dict((utils.get_path_from_native_path(rootdir, native_path),
+                     digest)
+                    for native_path, digest in hashing.hash_list_of_files(
+                        native_paths, num_threads).iteritems())
+
+    digest_map = {}
+    stat_results = {}
+    to_hash = []
+    for f in files:
+        native_path = utils.build_native_path(rootdir, f)
+        stat_results[f] = os.lstat(native_path)
+        digest = cache.lookup(f, stat_results[f])
+        if digest is None:
+            to_hash.append(native_path)
+        else:
+            digest_map[f] = digest
+
+    if to_hash:
+        for native_path, digest in hashing.hash_list_of_files(
+                to_hash, num_threads).iteritems():
+            digest_map[utils.get_path_from_native_path(rootdir,
+                                                       native_path)] = digest
+
+    for f in files:
+        cache.record(f, stat_results[f], digest_map[f])
+    return digest_map
+
+
+"""Kinds of results produced by iter_verify."""
+CHANGED = 'changed'
+MISSING = 'missing'
+UNEXPECTED = 'unexpected'
+SCAN_ERROR = 'scan_error'
+
+"""Number of files hashed together by iter_verify."""
+HASH_BATCH_SIZE = 1000
+
+
+def _current_subtree(rootdir, path, errors):
+    """Yield the paths of all descendants of the directory at path,
+    not crossing mount points."""
+    native_path = utils.build_native_path(rootdir, path)
+    for root, cur_dirs, cur_files in os.walk(native_path, topdown=True,
+                                             onerror=errors.append,
+                                             followlinks=False):
+        cur_dirs.sort()
+        for f in sorted(cur_files + cur_dirs):
+            yield utils.get_path_from_native_path(rootdir, os.path.join(root, f))
+        cur_dirs[:] = [d for d in cur_dirs
+                       if not os.path.ismount(os.path.join(root, d))]
+
+
+def iter_verify(rootdir, root_node, cache, num_threads=None):
+    """Compare a restored tree with a snapshot, yielding differences as
+    they are found.
+
+    The file system and the expected metadata tree are walked in
+    lock-step, one directory at a time, with the entries of each
+    directory merged in sorted order. Memory use is thus bounded by the
+    size of the directories on the current path plus HASH_BATCH_SIZE
+    files waiting to be hashed, rather than by the size of the tree.
+    The exception is the stat cache, which holds an entry for every
+    file; pass None to re-hash every file in bounded memory.
 
-    # First, we get all the relevant paths
-    scan_result = scan_backup(rootdir)
-    scan_errors = scan_result.errors
-    unexpected = scan_result.ignored
+    Everything that can be decided from cheap metadata (presence,
+    type, size, symlink target) is decided before any hashing, and
+    only files that pass these checks are hashed. A heavily diverged
+    tree is thus diagnosed without reading most of its files.
 
-    # Build a dictionary with all original metdata
-    original_metadata = {}
-    for p in itertools.chain(mdata.files, mdata.symlinks, mdata.directories):
-        original_metadata[p.name] = p
+    Args:
+      rootdir: Normalized root of the restored tree.
+      root_node: Root of the metadata tree of the snapshot.
+      cache: stat_cache.StatCache, which is updated with all files
+        seen, or None.
+      num_threads: Number of parallel hashing processes.
 
-    # Build a dictionary with all current metadata
-    digest_map = hashdeep.compute_digests(rootdir, scan_result.files,
-                                          num_threads)
+    Yields:
+      Pairs (kind, path), where kind is one of CHANGED, MISSING and
+      UNEXPECTED; or pairs (SCAN_ERROR, error) for errors listing a
+      directory.
+    """
     uid_map = utils.get_uid_name_map()
     gid_map = utils.get_gid_name_map()
-    current_metadata = {}
-    for f in scan_result.files:
-        current_metadata[f] = metadata.get_file_metadata(rootdir, f, digest_map,
-                                                         uid_map, gid_map)
-    for s in scan_result.symlinks:
-        current_metadata[s] = metadata.get_symlink_metadata(rootdir, s, uid_map,
-                                                            gid_map)
-    for d in scan_result.directories:
-        current_metadata[d] = metadata.get_directory_metadata(rootdir, d,
-                                                              uid_map, gid_map)
-
-    # Find missing and unexpected files
-    all_current_paths = set(scan_result.files + scan_result.symlinks
-                                              + scan_result.directories)
-    all_original_paths = set(original_metadata.keys())
-
-    missing = sorted(list(all_original_paths - all_current_paths))
-    unexpected.extend(list(all_current_paths - all_original_paths))
-    unexpected.sort()
-
-    # Find changed files
-    for p in all_current_paths.intersection(all_original_paths):
-        if not lenient_match(current_metadata[p], original_metadata[p]):
-            changed.append(p)
+    pending = []
+
+    def flush_pending():
+        digest_map = compute_digests(rootdir, [p for p, _ in pending], cache,
+                                     num_threads)
+        for p, expected in pending:
+            current = metadata.get_file_node(rootdir, p, digest_map,
+                                             uid_map, gid_map)
+            if not lenient_match(current, expected):
+                yield CHANGED, p
+        del pending[:]
+
+    stack = [(os.sep, root_node)]
+    while stack:
+        path, expected_dir = stack.pop()
+        native_dir = utils.build_native_path(rootdir, path)
+        try:
+            current_names = sorted(os.listdir(native_dir))
+        except OSError as e:
+            yield SCAN_ERROR, e
+            continue
+        expected_children = cas_tree.transient_children(expected_dir)
+        cas_tree.prefetch_subdirectories(expected_children)
+
+        subdirectories = []
+        for name, in_current, in_expected in utils.merge_sorted_names(
+                current_names, sorted(expected_children)):
+            p = os.path.join(path, name)
+            expected = expected_children.get(name)
+            if not in_current:
+                yield MISSING, p
+                for q in cas_tree.iter_descendants(p, expected):
+                    yield MISSING, q
+                continue
+
+            native_path = os.path.join(native_dir, name)
+            if os.path.islink(native_path):
+                current = metadata.get_symlink_node(rootdir, p, uid_map, gid_map)
+            elif os.path.isfile(native_path):
+                current = None
+            elif os.path.isdir(native_path):
+                current = metadata.get_directory_node(rootdir, p, uid_map,
+                                                      gid_map)
+            else:
+                # Special files are never part of a snapshot.
+                yield UNEXPECTED, p
+                if in_expected:
+                    yield MISSING, p
+                    for q in cas_tree.iter_descendants(p, expected):
+                        yield MISSING, q
+                continue
+
+            if not in_expected:
+                yield UNEXPECTED, p
+                if current is not None and isinstance(current,
+                                                      metadata.DirectoryNode):
+                    errors = []
+                    for q in _current_subtree(rootdir, p, errors):
+                        yield UNEXPECTED, q
+                    for e in errors:
+                        yield SCAN_ERROR, e
+                continue
+
+            if current is None:
+                # A regular file. Hashing is expensive, so files are
+                # only hashed if all cheap metadata (type and size)
+                # matches.
+                if (isinstance(expected, metadata.FileNode) and
+                    os.lstat(native_path).st_size != expected.size):
+                    yield CHANGED, p
+                elif isinstance(expected, metadata.FileNode):
+                    pending.append((p, expected))
+                    if len(pending) >= HASH_BATCH_SIZE:
+                        for result in flush_pending():
+                            yield result
+                else:
+                    yield CHANGED, p
+                    for q in cas_tree.iter_descendants(p, expected):
+                        yield MISSING, q
+                continue
+            if not lenient_match(current, expected):
+                yield CHANGED, p
+
+            # Descend into matching directories. Where a directory
+            # replaced something else (or vice versa), everything
+            # below it is unexpected (or missing).
+            current_is_dir = isinstance(current, metadata.DirectoryNode)
+            expected_is_dir = isinstance(expected, metadata.DirectoryNode)
+            if current_is_dir and os.path.ismount(native_path):
+                for q in cas_tree.iter_descendants(p, expected):
+                    yield MISSING, q
+            elif current_is_dir and expected_is_dir:
+                subdirectories.append((p, expected))
+            elif current_is_dir:
+                errors = []
+                for q in _current_subtree(rootdir, p, errors):
+                    yield UNEXPECTED, q
+                for e in errors:
+                    yield SCAN_ERROR, e
+            else:
+                for q in cas_tree.iter_descendants(p, expected):
+                    yield MISSING, q
+
+        stack.extend(reversed(subdirectories))
+
+    for result in flush_pending():
+        yield result
+
+
+@stats.timed('verify')
+def verify_backup(rootdir, root_node, num_threads=None, full=False):
+    """Compare a restored tree with the snapshot it was restored from.
+
+    Args:
+      rootdir: Root of the restored tree.
+      root_node: Root of the metadata tree of the snapshot, e.g. from
+        cas_tree.CASTree.root.
+      num_threads: Number of parallel hashing processes.
+      full: Re-hash every file, neither using nor updating the stat
+        cache. By default, only files whose stat data changed since
+        the last verify or restore are re-hashed, plus a rotating
+        sample (see stat_cache).
+
+    Returns:
+      A VerificationResult. Use iter_verify directly to receive
+      results while the verification is still running.
+    """
+    rootdir = os.path.normpath(rootdir)
+    if not os.path.isdir(rootdir):
+        raise ValueError('The root is not a directory, which should not happen.')
+
+    cache = None if full else stat_cache.load(rootdir)
+    results = {CHANGED: [], MISSING: [], UNEXPECTED: [], SCAN_ERROR: []}
+    for kind, path in iter_verify(rootdir, root_node, cache, num_threads):
+        results[kind].append(path)
+
+    if cache is not None:
+        stat_cache.save(rootdir, cache)
 
     # Return the final result
-    return VerificationResult(changed, missing, unexpected, scan_errors)
+    return VerificationResult(sorted(results[CHANGED]),
+                              sorted(results[MISSING]),
+                              sorted(results[UNEXPECTED]),
+                              results[SCAN_ERROR])
+
+
+def main(argv):
+    import cas
+    argv = profiling.handle_options(stats.handle_options(argv))
+    args = [arg for arg in argv[1:] if arg != '--full']
+    if len(args) != 3:
+        print ("usage: %s [--full] [--stats] [--stats-json FILE] "
+               "[--profile DIR [--profile-memory]] rootdir cas_root hash" % argv[0])
+        return 1
+    rootdir = os.path.normpath(args[0])
+    source_cas = cas.CAS(os.path.abspath(args[1]))
+    cache = None if '--full' in argv[1:] else stat_cache.load(rootdir)
+    differences = False
+    with stats.stage('verify'), async_cas.AsyncCAS(source_cas) as async_source:
+        tree = cas_tree.CASTree(source_cas, async_source=async_source)
+        for kind, path in iter_verify(rootdir, tree.root(args[2]), cache):
+            print '{}: {}'.format(kind, path)
+            differences = True
+    if cache is not None:
+        stat_cache.save(rootdir, cache)
+    return 1 if differences else 0
 
 
 if __name__ == '__main__':
     import sys
-    rootdir = sys.argv[1]
-    metadatafile = sys.argv[2]
-    with open(metadatafile, 'r') as f:
-        mdata = metadata.read_backup_metadata(f)
-    res = verify_backup(rootdir, mdata)
-    print res
+    sys.exit(main(sys.argv))
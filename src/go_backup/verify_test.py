@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Tests for go-backup verification of restored trees."""
+
+import cas
+import cas_tree
+import hashing
+import os
+import pytest
+import restore
+import stat_cache
+import verify
+from restore_test import backup_directory, make_source
+
+def restored_tree(tmpdir):
+    """Back up and restore a test tree; return (cas, root node, restored dir)."""
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    root_hash = backup_directory(make_source(tmpdir), test_cas)
+    dest = tmpdir.mkdir('restored')
+    restore.restore(test_cas, root_hash, '/', str(dest))
+    return test_cas, cas_tree.CASTree(test_cas).root(root_hash), dest
+
+@pytest.fixture
+def hashed_files(monkeypatch):
+    """Record the files hashed by verify."""
+    hashed = []
+    class RecordingHashing(object):
+        # replaces the hashing module only as seen from verify, so
+        # that hashing by backups is not recorded
+        @staticmethod
+        def hash_list_of_files(file_list, num_processes=None):
+            hashed.extend(file_list)
+            return hashing.hash_list_of_files(file_list, num_processes)
+    monkeypatch.setattr(verify, 'hashing', RecordingHashing)
+    return hashed
+
+def test_verify_clean_restore(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    res = verify.verify_backup(str(dest), root_node)
+    assert res == verify.VerificationResult([], [], [], [])
+    # restore recorded the stat cache, so only the sample was re-hashed
+    assert len(hashed_files) <= 3
+    assert all(stat_cache.in_sample(os.sep + os.path.relpath(fn, str(dest)), 1)
+               for fn in hashed_files)
+
+def test_verify_snapshot_with_go_backup_directory(tmpdir, hashed_files):
+    test_cas = cas.CAS(tmpdir.mkdir('cas'))
+    source = make_source(tmpdir)
+    source.mkdir('.go_backup').join('stat_cache').write('not a cache')
+    root_hash = backup_directory(source, test_cas)
+    dest = tmpdir.mkdir('restored')
+    restore.restore(test_cas, root_hash, '/', str(dest))
+    assert dest.join('.go_backup', 'stat_cache').read() == 'not a cache'
+
+    root_node = cas_tree.CASTree(test_cas).root(root_hash)
+    res = verify.verify_backup(str(dest), root_node)
+    assert res == verify.VerificationResult([], [], [], [])
+    dest.join('.go_backup', 'unexpected').write('')
+    res = verify.verify_backup(str(dest), root_node)
+    assert res.unexpected == ['/.go_backup/unexpected']
+
+def test_verify_full(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    res = verify.verify_backup(str(dest), root_node, full=True)
+    assert res == verify.VerificationResult([], [], [], [])
+    assert len(hashed_files) == 3
+
+def test_verify_detects_changes(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    dest.join('sub', 'a.txt').write('file b')
+    dest.join('sub', 'deeper', 'b.sh').remove()
+    dest.join('new.txt').write('new')
+
+    res = verify.verify_backup(str(dest), root_node)
+    assert res.changed == ['/sub/a.txt']
+    assert res.missing == ['/sub/deeper/b.sh']
+    assert res.unexpected == ['/new.txt']
+    assert str(dest.join('sub', 'a.txt')) in hashed_files
+
+def test_verify_stat_cache_persists(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    verify.verify_backup(str(dest), root_node)
+    cache = stat_cache.load(str(dest))
+    assert sorted(cache.files) == ['/sub/a.txt', '/sub/deeper/b.sh', '/top.txt']
+    assert cache.run == 2
+
+    # a full verify neither uses nor records the cache
+    with open(stat_cache.cache_path(str(dest))) as f:
+        saved = f.read()
+    verify.verify_backup(str(dest), root_node, full=True)
+    with open(stat_cache.cache_path(str(dest))) as f:
+        assert f.read() == saved
+
+def test_verify_detects_type_changes(tmpdir):
+    _, root_node, dest = restored_tree(tmpdir)
+    dest.join('sub', 'deeper').remove()
+    dest.join('sub', 'deeper').write('now a file')
+    dest.join('top.txt').remove()
+    dest.mkdir('top.txt').mkdir('x').join('y').write('')
+
+    res = verify.verify_backup(str(dest), root_node)
+    assert res.changed == ['/sub/deeper', '/top.txt']
+    assert res.missing == ['/sub/deeper/b.sh']
+    assert res.unexpected == ['/top.txt/x', '/top.txt/x/y']
+
+def test_iter_verify_streams(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    dest.join('sub').remove()
+    cache = stat_cache.StatCache()
+
+    results = verify.iter_verify(str(dest), root_node, cache)
+    # missing paths are reported before any file has been hashed
+    assert next(results) == (verify.MISSING, '/sub')
+    assert hashed_files == []
+    assert sorted(results) == [(verify.MISSING, '/sub/a.txt'),
+                               (verify.MISSING, '/sub/deeper'),
+                               (verify.MISSING, '/sub/deeper/b.sh'),
+                               (verify.MISSING, '/sub/link')]
+
+def test_verify_size_mismatch_not_hashed(tmpdir, hashed_files):
+    _, root_node, dest = restored_tree(tmpdir)
+    dest.join('top.txt').write('a different length')
+
+    res = verify.verify_backup(str(dest), root_node, full=True)
+    assert res.changed == ['/top.txt']
+    assert str(dest.join('top.txt')) not in hashed_files
+    assert len(hashed_files) == 2